@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+JSON 导出内存基准：对比流式导出与旧的 fetchall 整体导出在不同数据库大小下的峰值 RSS
+
+用法:
+  python3 benchmarks/export_memory.py                 # 默认 10/50/200 MB
+  python3 benchmarks/export_memory.py 20 100 --json results.json
+"""
+
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def build_db(db_path, size_mb):
+    """生成接近 Cursor store.db 结构的测试数据库（blobs 表存放 JSON 消息）"""
+    conn = sqlite3.connect(str(db_path))
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE blobs (id TEXT PRIMARY KEY, data BLOB)")
+    payload = json.dumps({"role": "assistant", "content": "lorem ipsum dolor sit amet " * 150})
+    row_bytes = len(payload)
+    rows = size_mb * 1024 * 1024 // row_bytes
+    batch = []
+    for i in range(rows):
+        batch.append((f"msg-{i}", payload.encode()))
+        if len(batch) >= 1000:
+            conn.executemany("INSERT INTO blobs VALUES (?, ?)", batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO blobs VALUES (?, ?)", batch)
+    conn.execute("INSERT INTO meta VALUES ('agent', '{}')")
+    conn.commit()
+    conn.close()
+
+
+def naive_export(db_path, json_file):
+    """旧实现：fetchall 每张表并构建完整字典后一次性 json.dump"""
+    conn = sqlite3.connect(str(db_path))
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    all_data = {}
+    for table_name in [t[0] for t in cursor.fetchall()]:
+        cursor.execute(f"SELECT * FROM {table_name}")
+        rows = cursor.fetchall()
+        column_names = [description[0] for description in cursor.description]
+        all_data[table_name] = [dict(zip(column_names, row)) for row in rows]
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump(all_data, f, indent=2, ensure_ascii=False, default=str)
+    conn.close()
+
+
+def run_child(mode, db_path, json_file):
+    """在独立进程中执行一次导出，输出耗时和峰值 RSS"""
+    sys.path.insert(0, str(REPO_DIR))
+    started = time.perf_counter()
+    if mode == 'naive':
+        naive_export(db_path, json_file)
+    else:
+        os.environ['HOME'] = str(Path(json_file).parent)
+        import cursor_sessions
+        cursor_sessions.CursorSessionManager()._export_db_to_json(db_path, json_file)
+    elapsed = time.perf_counter() - started
+    # Linux 上 ru_maxrss 单位为 KB
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'elapsed_s': elapsed, 'peak_rss_kb': peak_kb}))
+
+
+def measure(mode, db_path, json_file):
+    out = subprocess.check_output(
+        [sys.executable, __file__, '--child', mode, str(db_path), str(json_file)]
+    )
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--child':
+        run_child(*args[1:4])
+        return
+
+    json_out = None
+    if '--json' in args:
+        idx = args.index('--json')
+        json_out = args[idx + 1]
+        del args[idx:idx + 2]
+    sizes = [int(a) for a in args] or [10, 50, 200]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="export-bench-") as tmp:
+        tmp = Path(tmp)
+        print(f"{'DB MB':>6} {'模式':>10} {'耗时(s)':>9} {'峰值RSS(MB)':>12}")
+        for size_mb in sizes:
+            db_path = tmp / f"store_{size_mb}.db"
+            build_db(db_path, size_mb)
+            for mode in ['naive', 'streaming']:
+                json_file = tmp / f"export_{size_mb}_{mode}.json"
+                r = measure(mode, db_path, json_file)
+                r.update({'db_mb': size_mb, 'mode': mode,
+                          'json_mb': json_file.stat().st_size / 1024 / 1024})
+                json_file.unlink()
+                results.append(r)
+                print(f"{size_mb:>6} {mode:>10} {r['elapsed_s']:>9.2f} {r['peak_rss_kb'] / 1024:>12.1f}")
+            db_path.unlink()
+
+    if json_out:
+        with open(json_out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n结果已写入: {json_out}")
+
+
+if __name__ == "__main__":
+    main()
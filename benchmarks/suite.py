@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+"""
+端到端性能基准：合成 ~/.cursor 目录树和已保存的会话，测量 CLI 命令与 FastAPI 接口的
+延迟（p50/p95）、吞吐、峰值 RSS 和写入字节数，结果可保存为 JSON 并与之前的结果对比
+
+每项测量在独立进程中、基于同一份合成数据的副本执行（HOME 指向临时目录），互不影响。
+接口通过 TestClient 在进程内调用；CLI 命令每次启动新进程，延迟包含解释器启动时间。
+SSE 长连接（/api/events、/api/jobs/{id}/events）不计入。
+
+用法:
+  python3 benchmarks/suite.py                                        # 默认规模
+  python3 benchmarks/suite.py --chats 20 --db-mb 20 --projects 5 --sessions 1000
+  python3 benchmarks/suite.py --only api_sessions,cli_list -n 50
+  python3 benchmarks/suite.py --json before.json
+  python3 benchmarks/suite.py --json after.json --compare before.json   # 变慢超过阈值时退出码为 1
+"""
+
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = REPO_DIR / "web-ui" / "backend"
+
+DEFAULT_CONFIG = {
+    'chats': 6,          # 聊天数据库数量（~/.cursor/chats/<hash>/<会话>/store.db）
+    'db_mb': 2.0,        # 每个聊天数据库的大小
+    'projects': 3,       # 项目数量（~/.cursor/projects/<项目>/worker.log）
+    'sessions': 150,     # 预先保存的会话数量（约三分之一为自动保存）
+    'history_days': 30,  # 已保存会话的时间分布范围
+    'iterations': 20,
+    'seed': 42
+}
+
+# 合成消息使用的词表（同时用作搜索关键词）
+WORDS = ("refactor parser cache index render layout button color bug fix test deploy "
+         "docker sqlite query async thread memory latency session restore export "
+         "颜色 布局 缓存 索引 修复 测试 部署 会话").split()
+SEARCH_TERMS = ["cache", "sqlite query", "颜色"]
+
+BENCHMARKS = {}
+
+
+def benchmark(name, kind='api', warmup=True, max_iterations=None):
+    """注册一项测量：被装饰的函数接收 Context，返回每次迭代调用的 op(i)"""
+    def register(func):
+        BENCHMARKS[name] = {'kind': kind, 'setup': func, 'warmup': warmup, 'max_iterations': max_iterations}
+        return func
+    return register
+
+
+# 合成数据
+
+def message(rng):
+    words = rng.choices(WORDS, k=rng.randint(40, 400))
+    return json.dumps({"role": rng.choice(["user", "assistant"]), "content": " ".join(words)})
+
+
+def build_chat_db(db_path, size_mb, rng):
+    """生成接近 Cursor store.db 结构的聊天数据库（blobs 表存放 JSON 消息）"""
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(db_path))
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE blobs (id TEXT PRIMARY KEY, data BLOB)")
+    conn.execute("INSERT INTO meta VALUES ('agent', ?)", (json.dumps({"name": db_path.parent.parent.name[:8]}),))
+    target = size_mb * 1024 * 1024
+    written = 0
+    i = 0
+    while written < target:
+        batch = [(f"msg-{i + k}", message(rng).encode()) for k in range(200)]
+        conn.executemany("INSERT INTO blobs VALUES (?, ?)", batch)
+        written += sum(len(data) for _, data in batch)
+        i += len(batch)
+    conn.commit()
+    conn.close()
+
+
+def mutate_chat_db(db_path, rng, rows=5):
+    """追加几条消息，模拟对话继续进行"""
+    conn = sqlite3.connect(str(db_path))
+    conn.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?)",
+                     [(f"new-{rng.getrandbits(48):x}", message(rng).encode()) for _ in range(rows)])
+    conn.commit()
+    conn.close()
+
+
+def build_cursor_tree(home, config):
+    """生成 ~/.cursor/projects 和 ~/.cursor/chats，返回 (项目列表, 聊天数据库列表)"""
+    rng = random.Random(config['seed'])
+    projects = []
+    for p in range(config['projects']):
+        worker_log = home / ".cursor" / "projects" / f"home-bench-project{p}" / "worker.log"
+        worker_log.parent.mkdir(parents=True, exist_ok=True)
+        worker_log.write_text("started\n")
+        projects.append(worker_log)
+    chat_dbs = []
+    for c in range(config['chats']):
+        db_path = home / ".cursor" / "chats" / f"{rng.getrandbits(64):016x}" / f"agent-{c}" / "store.db"
+        build_chat_db(db_path, config['db_mb'], rng)
+        chat_dbs.append(db_path)
+    return projects, chat_dbs
+
+
+def activate(worker_log, db_path, at):
+    """让指定项目和聊天数据库成为“当前”的（按 mtime 判断最近活跃）"""
+    os.utime(worker_log, (at, at))
+    os.utime(db_path, (at, at))
+
+
+def io_counters():
+    """本进程累计的 (write() 字节数, 实际写入存储的字节数)；不支持时返回 (None, None)"""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['wchar']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss_kb():
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def child_env(home):
+    env = dict(os.environ, HOME=str(home), AUTO_SAVE_ENABLED='0',
+               FRONTEND_DIR=str(REPO_DIR / "web-ui" / "frontend"))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def run_json_child(args, home):
+    """在子进程中执行本脚本的某个模式，返回其最后一行输出的 JSON"""
+    result = subprocess.run([sys.executable, __file__, *args], env=child_env(home),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args[:2])} 失败:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def populate(home, config):
+    """（子进程）通过后端保存 config['sessions'] 个会话，并把它们的时间分布到过去 history_days 天"""
+    sys.path.insert(0, str(BACKEND_DIR))
+    import app
+    from fastapi.testclient import TestClient
+
+    rng = random.Random(config['seed'] + 1)
+    client = TestClient(app.app)
+    projects = sorted((home / ".cursor" / "projects").glob("*/worker.log"))
+    chat_dbs = sorted((home / ".cursor" / "chats").glob("*/*/store.db"))
+    total = config['sessions']
+    started = time.time()
+    for i in range(total):
+        db_path = chat_dbs[i % len(chat_dbs)]
+        mutate_chat_db(db_path, rng)
+        activate(projects[i % len(projects)], db_path, started - total + i)
+        if i % 3 == 2:
+            response = client.post("/api/sessions/auto-save?wait=true")
+        else:
+            response = client.post("/api/sessions/save?wait=true",
+                                   json={"name": f"bench {i} {rng.choice(WORDS)}", "description": "benchmark"})
+        response.raise_for_status()
+
+    # 保存时间都是刚才，改写为均匀分布在过去 history_days 天内（从旧到新），让保留策略和打包有冷数据可用
+    now = datetime.now()
+    metas = sorted(app.query_sessions(), key=lambda meta: meta['timestamp'])
+    span = timedelta(days=config['history_days'])
+    for index, meta in enumerate(metas):
+        meta['datetime'] = (now - span + span * (index + 1) / (len(metas) + 1)).isoformat()
+        meta_file = meta.pop('meta_file')
+        meta.pop('project_dir')
+        app.write_metadata(meta_file, meta)
+    app.schedule_search_index().future.result()
+    app.job_manager.shutdown()
+    print(json.dumps({'sessions': len(metas), 'elapsed_s': time.time() - started}))
+
+
+# 测量上下文
+
+class Context:
+    """单项测量的运行环境：进程内 TestClient、会话 ID 列表和合成数据"""
+
+    def __init__(self, home, config):
+        sys.path.insert(0, str(BACKEND_DIR))
+        import app
+        from fastapi.testclient import TestClient
+
+        self.app = app
+        self.home = home
+        self.config = config
+        self.rng = random.Random(config['seed'] + 2)
+        self.client = TestClient(app.app)
+        self.sessions = app.query_sessions()
+        self.ids = [meta['timestamp'] for meta in self.sessions]
+        self.rng.shuffle(self.ids)
+
+    def request(self, method, url, **kwargs):
+        response = self.client.request(method, url, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {url} -> {response.status_code}: {response.text[:200]}")
+        return response
+
+    def take_ids(self, count=1):
+        """取出尚未使用的会话 ID（删除、冷导出等每次需要不同会话的测量）"""
+        if len(self.ids) < count:
+            raise RuntimeError("已保存的会话不足，请增大 --sessions 或减少 -n")
+        taken, self.ids = self.ids[:count], self.ids[count:]
+        return taken
+
+    def touch_current_db(self):
+        """修改当前聊天数据库，使下一次保存有新内容"""
+        db_path, _ = self.app.find_current_session_db()
+        mutate_chat_db(db_path, self.rng)
+
+    def cli(self, *args, stdin=''):
+        """启动一次 CLI 进程，返回其自身统计（峰值 RSS、写入字节数）"""
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as stats_file:
+            stats_path = stats_file.name
+        try:
+            subprocess.run([sys.executable, __file__, '--cli-exec', stats_path, *args],
+                           input=stdin, text=True, env=child_env(self.home),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            with open(stats_path) as f:
+                return json.load(f)
+        finally:
+            os.unlink(stats_path)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run_benchmark(name, home, config):
+    """（子进程）执行一项测量并输出结果 JSON"""
+    spec = BENCHMARKS[name]
+    ctx = Context(home, config)
+    op = spec['setup'](ctx)
+    iterations = min(config['iterations'], spec['max_iterations'] or config['iterations'])
+    if spec['warmup']:
+        op(-1)
+    baseline_kb = peak_rss_kb()
+
+    latencies = []
+    child_stats = []
+    wchar_before, disk_before = io_counters()
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        stats = op(i)
+        latencies.append(time.perf_counter() - t0)
+        if isinstance(stats, dict):
+            child_stats.append(stats)
+    total = time.perf_counter() - started
+    wchar_after, disk_after = io_counters()
+    ctx.app.job_manager.shutdown()
+
+    result = {
+        'kind': spec['kind'],
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'mean_ms': sum(latencies) / iterations * 1000,
+        'max_ms': max(latencies) * 1000,
+        'ops_per_s': iterations / total if total else None
+    }
+    if child_stats:
+        # CLI：每次都是新进程，统计取自子进程本身
+        result.update({
+            'peak_rss_mb': max(s['peak_rss_kb'] for s in child_stats) / 1024,
+            'baseline_rss_mb': None,
+            'bytes_written_per_op': (sum(s['wchar'] for s in child_stats) / iterations
+                                     if all(s['wchar'] is not None for s in child_stats) else None),
+            'disk_bytes_per_op': (sum(s['write_bytes'] for s in child_stats) / iterations
+                                  if all(s['write_bytes'] is not None for s in child_stats) else None),
+            'in_process_p50_ms': percentile([s['elapsed_s'] for s in child_stats], 0.50) * 1000
+        })
+    else:
+        result.update({
+            'peak_rss_mb': peak_rss_kb() / 1024,
+            'baseline_rss_mb': baseline_kb / 1024,
+            'bytes_written_per_op': (wchar_after - wchar_before) / iterations if wchar_before is not None else None,
+            'disk_bytes_per_op': (disk_after - disk_before) / iterations if disk_before is not None else None
+        })
+    print(json.dumps(result))
+
+
+def cli_exec(stats_path, args):
+    """（CLI 子进程）以给定参数执行 cursor_sessions.main()，并把本进程的统计写入 stats_path"""
+    sys.path.insert(0, str(REPO_DIR))
+    sys.argv = ['cursor_sessions.py', *args]
+    started = time.perf_counter()
+    import cursor_sessions
+    try:
+        cursor_sessions.main()
+    except SystemExit:
+        pass
+    except EOFError:
+        # 交互式提示比预期多时不阻塞测量
+        pass
+    elapsed = time.perf_counter() - started
+    wchar, write_bytes = io_counters()
+    with open(stats_path, 'w') as f:
+        json.dump({'elapsed_s': elapsed, 'peak_rss_kb': peak_rss_kb(), 'wchar': wchar, 'write_bytes': write_bytes}, f)
+
+
+# 接口测量
+
+@benchmark('api_root')
+def bench_root(ctx):
+    return lambda i: ctx.request("GET", "/api")
+
+
+@benchmark('api_status')
+def bench_status(ctx):
+    return lambda i: ctx.request("GET", "/api/status")
+
+
+@benchmark('api_sessions')
+def bench_sessions(ctx):
+    return lambda i: ctx.request("GET", "/api/sessions")
+
+
+@benchmark('api_sessions_filtered')
+def bench_sessions_filtered(ctx):
+    return lambda i: ctx.request("GET", "/api/sessions", params={
+        "q": "bench", "project": "home-bench-project0", "sort": "name", "limit": 50})
+
+
+@benchmark('api_sessions_page_walk')
+def bench_sessions_page_walk(ctx):
+    def op(i):
+        cursor = None
+        while True:
+            params = {"limit": 25, **({"cursor": cursor} if cursor else {})}
+            cursor = ctx.request("GET", "/api/sessions", params=params).headers.get("x-next-cursor")
+            if not cursor:
+                return
+    return op
+
+
+@benchmark('api_sessions_not_modified')
+def bench_sessions_not_modified(ctx):
+    etag = ctx.request("GET", "/api/sessions").headers["etag"]
+    return lambda i: ctx.request("GET", "/api/sessions", headers={"If-None-Match": etag})
+
+
+@benchmark('api_projects')
+def bench_projects(ctx):
+    return lambda i: ctx.request("GET", "/api/projects")
+
+
+@benchmark('api_save')
+def bench_save(ctx):
+    def op(i):
+        ctx.touch_current_db()
+        ctx.request("POST", "/api/sessions/save?wait=true", json={"name": f"bench save {i}", "description": ""})
+    return op
+
+
+@benchmark('api_auto_save')
+def bench_auto_save(ctx):
+    def op(i):
+        ctx.touch_current_db()
+        ctx.request("POST", "/api/sessions/auto-save?wait=true")
+    return op
+
+
+@benchmark('api_auto_save_unchanged')
+def bench_auto_save_unchanged(ctx):
+    return lambda i: ctx.request("POST", "/api/sessions/auto-save?wait=true")
+
+
+@benchmark('api_restore')
+def bench_restore(ctx):
+    return lambda i: ctx.request("POST", f"/api/sessions/{ctx.rng.choice(ctx.ids)}/restore?wait=true")
+
+
+@benchmark('api_undo_restore')
+def bench_undo_restore(ctx):
+    ctx.request("POST", f"/api/sessions/{ctx.ids[0]}/restore?wait=true")
+    return lambda i: ctx.request("POST", "/api/sessions/undo-restore?wait=true")
+
+
+@benchmark('api_rename')
+def bench_rename(ctx):
+    return lambda i: ctx.request("PUT", f"/api/sessions/{ctx.rng.choice(ctx.ids)}/rename",
+                                 json={"new_name": f"renamed {i}"})
+
+
+@benchmark('api_export_cold', warmup=False)
+def bench_export_cold(ctx):
+    return lambda i: ctx.request("GET", f"/api/sessions/{ctx.take_ids()[0]}/export?wait=true")
+
+
+@benchmark('api_export_cached')
+def bench_export_cached(ctx):
+    session_id = ctx.take_ids()[0]
+    return lambda i: ctx.request("GET", f"/api/sessions/{session_id}/export?wait=true")
+
+
+@benchmark('api_diff')
+def bench_diff(ctx):
+    return lambda i: ctx.request("GET", "/api/sessions/{}/diff/{}?wait=true".format(*ctx.rng.sample(ctx.ids, 2)))
+
+
+@benchmark('api_delete', warmup=False)
+def bench_delete(ctx):
+    return lambda i: ctx.request("DELETE", f"/api/sessions/{ctx.take_ids()[0]}")
+
+
+@benchmark('api_bulk_delete', warmup=False)
+def bench_bulk_delete(ctx):
+    return lambda i: ctx.request("POST", "/api/sessions/bulk-delete", json={"ids": ctx.take_ids(5)})
+
+
+@benchmark('api_bulk_export', warmup=False)
+def bench_bulk_export(ctx):
+    return lambda i: ctx.request("POST", "/api/sessions/bulk-export?wait=true", json={"ids": ctx.take_ids(5)})
+
+
+@benchmark('api_export_download')
+def bench_export_download(ctx):
+    archive = ctx.request("POST", "/api/sessions/bulk-export?wait=true", json={"ids": ctx.ids[:10]}).json()
+    return lambda i: ctx.request("GET", archive['download_url'])
+
+
+@benchmark('api_search')
+def bench_search(ctx):
+    return lambda i: ctx.request("GET", "/api/search", params={"q": SEARCH_TERMS[i % len(SEARCH_TERMS)]})
+
+
+@benchmark('api_messages')
+def bench_messages(ctx):
+    return lambda i: ctx.request("GET", f"/api/sessions/{ctx.rng.choice(ctx.ids)}/messages")
+
+
+@benchmark('api_jobs')
+def bench_jobs(ctx):
+    ctx.request("POST", "/api/sessions/auto-save?wait=true")
+    return lambda i: ctx.request("GET", "/api/jobs")
+
+
+@benchmark('api_job')
+def bench_job(ctx):
+    job_id = ctx.request("POST", "/api/sessions/auto-save").json()['job_id']
+    return lambda i: ctx.request("GET", f"/api/jobs/{job_id}")
+
+
+@benchmark('api_metrics')
+def bench_metrics(ctx):
+    return lambda i: ctx.request("GET", "/api/metrics")
+
+
+@benchmark('api_auto_save_config')
+def bench_auto_save_config(ctx):
+    return lambda i: ctx.request("GET", "/api/auto-save/config")
+
+
+@benchmark('api_auto_save_config_update')
+def bench_auto_save_config_update(ctx):
+    return lambda i: ctx.request("PUT", "/api/auto-save/config", json={"quiet_seconds": 10 + i % 5})
+
+
+@benchmark('api_retention')
+def bench_retention(ctx):
+    return lambda i: ctx.request("GET", "/api/retention")
+
+
+@benchmark('api_retention_update')
+def bench_retention_update(ctx):
+    return lambda i: ctx.request("PUT", "/api/retention", json={"daily_days": 7 + i % 2})
+
+
+@benchmark('api_retention_dry_run')
+def bench_retention_dry_run(ctx):
+    return lambda i: ctx.request("POST", "/api/retention/run?dry_run=true")
+
+
+@benchmark('api_retention_run', warmup=False, max_iterations=1)
+def bench_retention_run(ctx):
+    return lambda i: ctx.request("POST", "/api/retention/run")
+
+
+@benchmark('api_reindex')
+def bench_reindex(ctx):
+    return lambda i: ctx.request("POST", "/api/catalog/reindex?wait=true")
+
+
+@benchmark('api_recompress', warmup=False, max_iterations=2)
+def bench_recompress(ctx):
+    return lambda i: ctx.request("POST", f"/api/store/recompress?wait=true&codec={('gzip', 'lzma')[i % 2]}")
+
+
+@benchmark('api_pack', warmup=False, max_iterations=1)
+def bench_pack(ctx):
+    return lambda i: ctx.request("POST", "/api/store/pack?wait=true")
+
+
+# CLI 测量
+
+@benchmark('cli_list', kind='cli')
+def bench_cli_list(ctx):
+    return lambda i: ctx.cli('list')
+
+
+@benchmark('cli_save', kind='cli')
+def bench_cli_save(ctx):
+    def op(i):
+        ctx.touch_current_db()
+        return ctx.cli('save', stdin=f"bench cli {i}\ncli\n")
+    return op
+
+
+@benchmark('cli_restore', kind='cli')
+def bench_cli_restore(ctx):
+    return lambda i: ctx.cli('restore', ctx.rng.choice(ctx.ids), stdin="yes\n")
+
+
+@benchmark('cli_undo_restore', kind='cli')
+def bench_cli_undo_restore(ctx):
+    ctx.cli('restore', ctx.ids[0], stdin="yes\n")
+    return lambda i: ctx.cli('undo-restore')
+
+
+@benchmark('cli_export', kind='cli', warmup=False)
+def bench_cli_export(ctx):
+    return lambda i: ctx.cli('export', ctx.take_ids()[0])
+
+
+@benchmark('cli_diff', kind='cli')
+def bench_cli_diff(ctx):
+    return lambda i: ctx.cli('diff', *ctx.rng.sample(ctx.ids, 2))
+
+
+@benchmark('cli_search', kind='cli')
+def bench_cli_search(ctx):
+    return lambda i: ctx.cli('search', SEARCH_TERMS[i % len(SEARCH_TERMS)])
+
+
+@benchmark('cli_messages', kind='cli')
+def bench_cli_messages(ctx):
+    return lambda i: ctx.cli('messages', ctx.rng.choice(ctx.ids))
+
+
+@benchmark('cli_delete', kind='cli', warmup=False)
+def bench_cli_delete(ctx):
+    return lambda i: ctx.cli('delete', ctx.take_ids()[0], '-y')
+
+
+@benchmark('cli_prune_dry_run', kind='cli')
+def bench_cli_prune_dry_run(ctx):
+    return lambda i: ctx.cli('prune', '--dry-run')
+
+
+@benchmark('cli_reindex', kind='cli')
+def bench_cli_reindex(ctx):
+    return lambda i: ctx.cli('reindex')
+
+
+# 汇总与对比
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', '-C', str(REPO_DIR), 'rev-parse', '--short', 'HEAD'],
+                                         text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import zstandard  # noqa: F401
+        has_zstd = True
+    except ImportError:
+        has_zstd = False
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'zstandard': has_zstd,
+        'started_at': datetime.now().isoformat(timespec='seconds')
+    }
+
+
+def print_results(results):
+    print(f"\n{'测量项':<30} {'次数':>4} {'p50(ms)':>9} {'p95(ms)':>9} {'ops/s':>8} {'峰值RSS(MB)':>11} {'写入KB/次':>10}")
+    for name, r in results.items():
+        if 'error' in r:
+            print(f"{name:<30} ❌ {r['error'].splitlines()[-1][:80]}")
+            continue
+        written = f"{r['bytes_written_per_op'] / 1024:.1f}" if r['bytes_written_per_op'] is not None else '-'
+        print(f"{name:<30} {r['iterations']:>4} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+              f"{r['ops_per_s']:>8.1f} {r['peak_rss_mb']:>11.1f} {written:>10}")
+
+
+def compare(results, baseline, threshold):
+    """与之前的结果对比 p50，返回变慢超过 threshold 的测量项"""
+    if baseline.get('config') != results['config']:
+        print("\n⚠️  基准结果的数据规模与本次不同，对比仅供参考")
+    print(f"\n{'测量项':<30} {'之前 p50':>10} {'本次 p50':>10} {'变化':>8}")
+    regressions = []
+    for name, r in results['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before or 'error' in before or 'error' in r:
+            continue
+        change = (r['p50_ms'] - before['p50_ms']) / before['p50_ms'] if before['p50_ms'] else 0
+        flag = ''
+        if change > threshold:
+            flag = ' ⚠️'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = ' ✅'
+        print(f"{name:<30} {before['p50_ms']:>10.1f} {r['p50_ms']:>10.1f} {change * 100:>+7.0f}%{flag}")
+    return regressions
+
+
+def parse_args(args):
+    config = dict(DEFAULT_CONFIG)
+    options = {'json': None, 'compare': None, 'threshold': 0.2, 'only': None}
+    flags = {'--chats': ('chats', int), '--db-mb': ('db_mb', float), '--projects': ('projects', int),
+             '--sessions': ('sessions', int), '--history-days': ('history_days', float),
+             '-n': ('iterations', int), '--seed': ('seed', int)}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if i + 1 >= len(args):
+            sys.exit(f"❌ 未知参数或缺少值: {arg}")
+        value = args[i + 1]
+        if arg in flags:
+            key, convert = flags[arg]
+            config[key] = convert(value)
+        elif arg in ('--json', '--compare'):
+            options[arg[2:]] = value
+        elif arg == '--threshold':
+            options['threshold'] = float(value) / 100
+        elif arg == '--only':
+            options['only'] = value.split(',')
+        else:
+            sys.exit(f"❌ 未知参数: {arg}")
+        i += 2
+    return config, options
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--populate':
+        populate(Path(args[1]), json.loads(args[2]))
+        return
+    if args and args[0] == '--run':
+        run_benchmark(args[1], Path(args[2]), json.loads(args[3]))
+        return
+    if args and args[0] == '--cli-exec':
+        cli_exec(args[1], args[2:])
+        return
+
+    config, options = parse_args(args)
+    names = options['only'] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"❌ 未知的测量项: {', '.join(unknown)}（可选: {', '.join(BENCHMARKS)}）")
+
+    results = {'config': config, 'environment': environment(), 'results': {}}
+    with tempfile.TemporaryDirectory(prefix="cursor-bench-") as tmp:
+        base_home = Path(tmp) / "base"
+        started = time.time()
+        build_cursor_tree(base_home, config)
+        setup = run_json_child(['--populate', str(base_home), json.dumps(config)], base_home)
+        print(f"🏗️  合成数据: {config['chats']} 个聊天数据库 × {config['db_mb']:g} MB，"
+              f"{config['projects']} 个项目，{setup['sessions']} 个已保存会话（{time.time() - started:.1f}s）")
+        results['setup_s'] = time.time() - started
+
+        for name in names:
+            home = Path(tmp) / "run"
+            shutil.copytree(base_home, home, symlinks=True)
+            try:
+                results['results'][name] = run_json_child(['--run', name, str(home), json.dumps(config)], home)
+            except RuntimeError as e:
+                results['results'][name] = {'error': str(e)}
+            finally:
+                shutil.rmtree(home)
+            r = results['results'][name]
+            status = f"p50 {r['p50_ms']:.1f} ms" if 'error' not in r else "失败"
+            print(f"   {name}: {status}", flush=True)
+
+    print_results(results['results'])
+
+    if options['json']:
+        with open(options['json'], 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\n结果已写入: {options['json']}")
+
+    if options['compare']:
+        with open(options['compare'], 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options['threshold'])
+        if regressions:
+            print(f"\n⚠️  {len(regressions)} 项变慢超过 {options['threshold'] * 100:.0f}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
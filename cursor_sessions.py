@@ -8,19 +8,64 @@ import sqlite3
 import json
 import os
 import sys
-from datetime import datetime
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
-import shutil
+
+# 会话索引、分块存储、快照与保留策略等与 Web 后端共用同一实现（web-ui/backend/session_store.py）
+sys.path.insert(0, str(Path(__file__).resolve().parent / "web-ui" / "backend"))
+from session_store import (
+    CURSOR_DIR, SESSIONS_DIR, CHUNK_CODECS, SNAPSHOT_CODEC, PACK_COLD_DAYS, DIFF_ROW_LIMIT,
+    SNAPSHOT_ALL_WINDOW_SECONDS, SEARCH_MARK_START, SEARCH_MARK_END, MESSAGES_PAGE_SIZE,
+    query_sessions, materialize_snapshot, discard_staged, copy_file, remove_session_files,
+    rebuild_catalog, rebuild_store_refs, export_db_to_ndjson, ensure_json_export, json_export_is_fresh,
+    open_search_index, snapshot_signature, index_snapshot, sync_search_index, read_snapshot_messages,
+    search_sessions, load_auto_save_config, load_retention_policy, plan_retention, reclaimable_kb,
+    assign_chat_projects, auto_save_snapshot, save_snapshot, restore_into, restore_undo_records, revert_restore, diff_snapshots,
+    pack_targets, pack_project, recompress_snapshots,
+)
+
+# save --all-active：同时保存的项目数（与 Web 后端的 JOB_WORKERS 相同）
+SNAPSHOT_ALL_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# 命令行搜索结果每页条数
+SEARCH_PAGE_SIZE = 10
+
+RETENTION_REASONS = {'tier': '分层', 'count': '数量上限', 'project_size': '项目大小上限', 'total_size': '总大小上限'}
 
 class CursorSessionManager:
     def __init__(self):
         # 会话存储目录（独立于项目）
-        self.manager_dir = Path.home() / "cursor-session-manager"
-        self.sessions_dir = self.manager_dir / "saved_sessions"
-        self.sessions_dir.mkdir(parents=True, exist_ok=True)
+        self.sessions_dir = SESSIONS_DIR
         
         # Cursor 配置目录
-        self.cursor_dir = Path.home() / ".cursor"
+        self.cursor_dir = CURSOR_DIR
+    
+    def reindex(self):
+        """从 .meta.json 文件完整重建会话索引"""
+        print("\n🔄 正在重建会话索引...")
+        count = rebuild_catalog()
+        print(f"✅ 索引重建完成，共 {count} 个会话")
+        
+        chunks, freed = rebuild_store_refs()
+        print(f"✅ 分块引用计数已重建: {chunks} 个分块，清理 {freed} 个无引用分块")
+        return count
+    
+    def recompress(self, codec=None):
+        """将旧的完整 .db 快照转为压缩分块，并把其他格式的分块重新压缩为 codec"""
+        codec = codec or SNAPSHOT_CODEC
+        if codec != 'none' and codec not in CHUNK_CODECS:
+            print(f"❌ 不支持的压缩格式: {codec}（可选: none, {', '.join(CHUNK_CODECS)}）")
+            return False
+        print(f"\n🗜️  正在重新压缩快照存储（{codec}）...")
+        
+        result = recompress_snapshots(codec)
+        print(f"✅ 旧快照已转为分块存储: {result['snapshots_converted']} 个")
+        print(f"✅ 分块已重新压缩: {result['chunks_recompressed']} 个，"
+              f"{result['bytes_before'] / 1024:.1f} KB → {result['bytes_after'] / 1024:.1f} KB")
+        return True
     
     def get_current_project_info(self):
         """获取当前工作的项目信息"""
@@ -104,81 +149,272 @@ class CursorSessionManager:
             if not description:
                 description = "无描述"
         
-        # 生成文件名
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_name = "".join(c for c in session_name if c.isalnum() or c in (' ', '-', '_', '中', '文')).strip()
-        safe_name = safe_name.replace(' ', '_')[:50]  # 限制长度
-        
-        base_name = f"{timestamp}_{safe_name}"
-        
-        # 创建项目子目录
-        project_sessions_dir = self.sessions_dir / (project_name or "unknown_project")
-        project_sessions_dir.mkdir(exist_ok=True)
-        
-        # 保存数据库
-        backup_file = project_sessions_dir / f"{base_name}.db"
-        shutil.copy2(current_db, backup_file)
-        print(f"✅ 数据库已保存: {backup_file}")
-        
-        # 导出 JSON
-        json_file = project_sessions_dir / f"{base_name}.json"
-        self._export_db_to_json(current_db, json_file)
-        print(f"✅ 数据已导出: {json_file}")
-        
-        # 保存元数据
-        metadata = {
-            'name': session_name,
-            'description': description,
-            'timestamp': timestamp,
-            'datetime': datetime.now().isoformat(),
-            'project': project_name,
-            'hash_folder': hash_folder,
-            'db_file': backup_file.name,
-            'json_file': json_file.name,
-            'size_kb': current_db.stat().st_size / 1024,
-            'original_path': str(current_db)
-        }
-        
-        meta_file = project_sessions_dir / f"{base_name}.meta.json"
-        with open(meta_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
-        
-        print(f"✅ 元数据已保存: {meta_file}")
+        # 先通过在线备份得到一致性快照，再写入分块存储（JSON 导出改为按需生成）
+        project_name = project_name or "unknown_project"
+        try:
+            result = save_snapshot(current_db, hash_folder, project_name, session_name, description)
+        except Exception as e:
+            print(f"❌ {e}")
+            return False
+        print(f"✅ 数据库已保存（{result['session_id']}）")
+        print(f"   压缩: {result['codec']}，{result['size_kb']:.2f} KB → {result['stored_kb']:.2f} KB")
         
         print("\n" + "="*70)
         print("✅ 会话保存完成！")
         print("="*70)
-        print(f"\n保存位置: {project_sessions_dir}")
-        print(f"会话ID: {timestamp}")
+        print(f"\n保存位置: {self.sessions_dir / project_name}")
+        print(f"会话ID: {result['session_id']}")
         print()
         
         return True
     
-    def _export_db_to_json(self, db_path, json_file):
-        """导出数据库到 JSON"""
+    def _active_chat_dbs(self, window_seconds):
+        """最近 window_seconds 内有写入的所有会话数据库及其所属项目，返回 [(数据库, 项目)]（从新到旧）"""
+        since = time.time() - window_seconds
+        active = {}
+        for db_file in (self.cursor_dir / "chats").glob("*/*/store.db"):
+            try:
+                mtime = db_file.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            # WAL 模式下写入只改变 -wal 文件的 mtime
+            wal_file = Path(str(db_file) + '-wal')
+            if wal_file.exists():
+                mtime = max(mtime, wal_file.stat().st_mtime)
+            if mtime >= since:
+                active[db_file] = mtime
+        
+        activity = {worker_log.parent.name: worker_log.stat().st_mtime
+                    for worker_log in (self.cursor_dir / "projects").glob("*/worker.log")}
+        return assign_chat_projects(active, activity)
+    
+    def save_all_active(self, window_seconds=SNAPSHOT_ALL_WINDOW_SECONDS):
+        """保存最近 window_seconds 内有写入的所有会话数据库：不同项目并行（最多 SNAPSHOT_ALL_WORKERS 个），同一项目依次执行
+
+        与 Web 端自动保存走同一路径：指纹和内容无变化时跳过，按自动保存配置写入增量快照
+        """
+        print("\n" + "="*70)
+        print("💾 保存所有活跃的 Cursor 会话")
+        print("="*70)
+        
+        targets = self._active_chat_dbs(window_seconds)
+        if not targets:
+            print(f"❌ 最近 {window_seconds:g} 秒内没有活跃的会话数据库")
+            return False
+        
+        groups = {}
+        for db_file, project in targets:
+            groups.setdefault(project, []).append(db_file)
+        print(f"🔍 发现 {len(targets)} 个活跃的会话数据库，分属 {len(groups)} 个项目")
+        
+        delta = load_auto_save_config()['delta']
+        
+        def snapshot_group(item):
+            project, db_files = item
+            results = []
+            for db_file in db_files:
+                try:
+                    result = auto_save_snapshot(db_file, db_file.parent.parent.name, project, delta)
+                except Exception as e:
+                    result = {'status': 'failed', 'error': str(e)}
+                results.append((db_file, result))
+            return project, results
+        
+        with ThreadPoolExecutor(max_workers=max(min(len(groups), SNAPSHOT_ALL_WORKERS), 1)) as pool:
+            reports = list(pool.map(snapshot_group, groups.items()))
+        
+        counts = Counter()
+        for project, results in reports:
+            print(f"\n📁 {project}")
+            by_hash = {}
+            for db_file, result in results:
+                by_hash.setdefault(db_file.parent.parent.name, []).append((db_file, result))
+            for hash_folder, entries in by_hash.items():
+                print(f"   📂 {hash_folder}")
+                for db_file, result in entries:
+                    counts[result['status']] += 1
+                    if result['status'] == 'success':
+                        print(f"      ✅ {db_file.parent.name} → {result['session_id']}"
+                              f"（{result['size_kb']:.1f} KB → {result['stored_kb']:.1f} KB）")
+                    elif result['status'] == 'skipped':
+                        print(f"      ⏭️  {db_file.parent.name} 无变化（{result['session_id']}）")
+                    else:
+                        print(f"      ❌ {db_file.parent.name} 失败: {result['error']}")
+        
+        print("\n" + "="*70)
+        print(f"✅ 已保存 {counts['success']} 个，{counts['skipped']} 个无变化"
+              + (f"，❌ {counts['failed']} 个失败" if counts['failed'] else ""))
+        print("="*70)
+        print()
+        return not counts['failed']
+    
+    def export_session(self, identifier, ndjson=False, output=None):
+        """导出指定会话：JSON 按需生成并缓存，NDJSON 按表导出到指定位置"""
+        matches = query_sessions(session_id=identifier)
+        if not matches:
+            print(f"❌ 未找到 ID 为 {identifier} 的会话")
+            return False
+        
+        session = matches[0]
         try:
-            conn = sqlite3.connect(str(db_path))
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = cursor.fetchall()
+            if not ndjson:
+                cached = json_export_is_fresh(session)
+                json_file = ensure_json_export(session)
+                if output:
+                    copy_file(json_file, Path(output))
+                    json_file = Path(output)
+                print(f"✅ 会话已导出{'（使用缓存）' if cached else ''}: {json_file}")
+                return True
             
-            all_data = {}
-            for table_name in [t[0] for t in tables]:
+            base_name = session['meta_file'].name[:-len('.meta.json')]
+            target = Path(output) if output else session['project_dir'] / f"{base_name}.ndjson"
+            staged_db = session['project_dir'] / f".export_{session['timestamp']}.staging.db"
+            try:
+                materialize_snapshot(session, staged_db)
+                export_db_to_ndjson(staged_db, target)
+            finally:
+                discard_staged(staged_db)
+        except Exception as e:
+            print(f"❌ 导出失败: {e}")
+            return False
+        
+        print(f"✅ 会话已导出: {target}")
+        return True
+    
+    def diff_sessions(self, identifier_a, identifier_b, limit=DIFF_ROW_LIMIT, as_json=False):
+        """逐表比较两个快照（第一个为旧版本），列出新增、删除和修改的行"""
+        sessions = []
+        for identifier in (identifier_a, identifier_b):
+            matches = query_sessions(session_id=identifier)
+            if not matches:
+                print(f"❌ 未找到 ID 为 {identifier} 的会话")
+                return False
+            sessions.append(matches[0])
+        session_a, session_b = sessions
+        
+        try:
+            diff = diff_snapshots(session_a, session_b, limit)
+        except Exception as e:
+            print(f"❌ {e}")
+            return False
+        
+        if as_json:
+            print(json.dumps({"summary": diff['summary'], "tables": diff['tables'],
+                              "from": session_a['timestamp'], "to": session_b['timestamp']},
+                             indent=2, ensure_ascii=False))
+            return True
+        
+        summary = diff['summary']
+        print(f"\n🔍 {session_a['name']} ({session_a['timestamp']}) → {session_b['name']} ({session_b['timestamp']})")
+        if session_a.get('original_path') != session_b.get('original_path'):
+            print("⚠️  两个快照来自不同的会话数据库")
+        if diff['identical']:
+            print("✅ 两个快照内容相同")
+            return True
+        
+        print(f"📊 新增 {summary['added']} 行，删除 {summary['removed']} 行，修改 {summary['changed']} 行")
+        for table_name in summary['tables_added']:
+            print(f"   ➕ 新表: {table_name}")
+        for table_name in summary['tables_removed']:
+            print(f"   ➖ 删除的表: {table_name}")
+        for table_name in summary['tables_skipped']:
+            print(f"   ⚠️  {table_name}: {diff['tables'][table_name]['skipped']}")
+        for table_name, table in diff['tables'].items():
+            if not (table['added'] or table['removed'] or table['changed']):
+                continue
+            print(f"\n📋 {table_name}（键: {', '.join(table['key'])}）: "
+                  f"+{table['added']} -{table['removed']} ~{table['changed']}，未变 {table['unchanged']}")
+            for symbol, kind, label in (('+', 'added', '新增'), ('-', 'removed', '删除'), ('~', 'changed', '修改')):
+                for row in table['rows'][kind]:
+                    key_text = ", ".join(f"{k}={v}" for k, v in row['key'].items())
+                    detail = f"（{', '.join(row['columns'])}）" if kind == 'changed' else ""
+                    print(f"   {symbol} {key_text}{detail}")
+                hidden = table[kind] - len(table['rows'][kind])
+                if hidden > 0:
+                    print(f"   … 另有 {hidden} 行{label}")
+        print()
+        return True
+    
+    def search(self, query, page=1, page_size=SEARCH_PAGE_SIZE):
+        """全文搜索所有快照的对话内容，按快照聚合并按相关度排序"""
+        if not query.split():
+            print("❌ 搜索内容不能为空")
+            return []
+        
+        # 命令行没有后台任务，搜索前先增量更新索引（Web 端在每次保存后于后台完成）
+        synced = sync_search_index()
+        if synced['indexed'] or synced['removed']:
+            print(f"🔄 搜索索引已更新: 新增 {synced['indexed']} 个快照，移除 {synced['removed']} 个")
+        
+        try:
+            total, rows = search_sessions(query, page, page_size)
+        except sqlite3.OperationalError as e:
+            print(f"❌ 搜索失败: {e}")
+            return []
+        
+        print("\n" + "="*70)
+        print(f"🔍 搜索: {query}（共 {total} 个快照，第 {page} 页）")
+        print("="*70)
+        
+        sessions = {(s['project_dir'].name, s['meta_file'].name): s for s in query_sessions()} if rows else {}
+        results = []
+        for idx, row in enumerate(rows, (page - 1) * page_size + 1):
+            session = sessions.get((row['project_dir'], row['meta_file']))
+            if session is None:
+                continue
+            snippet = row['snippet'].replace(SEARCH_MARK_START, '【').replace(SEARCH_MARK_END, '】')
+            print(f"\n{idx}. 📅 {session['name']}  [{session.get('project', 'unknown')}]")
+            print(f"   ID: {session['timestamp']}  时间: {session['datetime'][:19]}  匹配: {row['hits']} 条")
+            print(f"   {' '.join(snippet.split())}")
+            results.append(session)
+        
+        if total > page * page_size:
+            print(f"\n➡️  更多结果: --page {page + 1}")
+        print("\n" + "="*70)
+        return results
+    
+    def show_messages(self, identifier, offset=0, limit=MESSAGES_PAGE_SIZE):
+        """分页显示快照的对话（从消息存储读取，快照尚未提取时先提取）"""
+        matches = query_sessions(session_id=identifier)
+        if not matches:
+            print(f"❌ 未找到 ID 为 {identifier} 的会话")
+            return False
+        
+        session = matches[0]
+        try:
+            page = read_snapshot_messages(session, offset, limit)
+            if page is None:
+                conn = open_search_index()
                 try:
-                    cursor.execute(f"SELECT * FROM {table_name}")
-                    rows = cursor.fetchall()
-                    column_names = [description[0] for description in cursor.description]
-                    all_data[table_name] = [dict(zip(column_names, row)) for row in rows]
-                except sqlite3.Error:
-                    pass
-            
-            with open(json_file, 'w', encoding='utf-8') as f:
-                json.dump(all_data, f, indent=2, ensure_ascii=False, default=str)
-            
-            conn.close()
+                    index_snapshot(conn, session, snapshot_signature(session))
+                finally:
+                    conn.close()
+                page = read_snapshot_messages(session, offset, limit)
         except Exception as e:
-            print(f"⚠️  JSON 导出警告: {e}")
+            print(f"❌ 读取对话失败: {e}")
+            return False
+        
+        print("\n" + "="*70)
+        print(f"💬 {session['name']}（共 {page['total']} 条消息）")
+        print("="*70)
+        icons = {'user': '🧑', 'assistant': '🤖', 'tool': '🔧', 'system': '⚙️'}
+        for message in page['messages']:
+            header = f"\n#{message['seq'] + 1} {icons.get(message['role'], '•')} {message['role']}"
+            if message['created_at']:
+                header += f"  {message['created_at'][:19]}"
+            header += f"  {'~' if message['tokens_estimated'] else ''}{message['tokens']} tokens"
+            print(header)
+            if message['text']:
+                print(message['text'])
+            for attachment in message['attachments']:
+                label = attachment.get('toolName') or attachment.get('name') or attachment.get('filename') \
+                    or attachment.get('path') or ''
+                print(f"   📎 {attachment['type']} {label}".rstrip())
+        
+        if offset + len(page['messages']) < page['total']:
+            print(f"\n➡️  更多消息: --offset {offset + len(page['messages'])}")
+        print("\n" + "="*70)
+        return True
     
     def list_sessions(self, project_filter=None):
         """列出所有保存的会话"""
@@ -186,25 +422,8 @@ class CursorSessionManager:
         print("📋 已保存的会话列表")
         print("="*70 + "\n")
         
-        all_sessions = []
-        
-        # 遍历所有项目目录
-        for project_dir in self.sessions_dir.iterdir():
-            if not project_dir.is_dir():
-                continue
-            
-            if project_filter and project_dir.name != project_filter:
-                continue
-            
-            for meta_file in project_dir.glob("*.meta.json"):
-                try:
-                    with open(meta_file, 'r', encoding='utf-8') as f:
-                        meta = json.load(f)
-                        meta['meta_file'] = meta_file
-                        meta['project_dir'] = project_dir
-                        all_sessions.append(meta)
-                except Exception as e:
-                    print(f"⚠️  读取 {meta_file.name} 失败: {e}")
+        # 从索引读取（已按时间倒序）
+        all_sessions = query_sessions(project_dir=project_filter)
         
         if not all_sessions:
             print("   (暂无保存的会话)")
@@ -225,14 +444,13 @@ class CursorSessionManager:
             print(f"\n📁 项目: {proj}")
             print("-" * 70)
             
-            sessions.sort(key=lambda x: x['datetime'], reverse=True)
-            
             for session in sessions:
                 print(f"\n{idx}. 📅 {session['name']}")
                 print(f"   时间: {session['datetime'][:19]}")
                 print(f"   描述: {session['description']}")
                 print(f"   ID: {session['timestamp']}")
-                print(f"   大小: {session['size_kb']:.2f} KB")
+                stored_kb = session.get('stored_kb', session['size_kb'])
+                print(f"   大小: {session['size_kb']:.2f} KB（磁盘 {stored_kb:.2f} KB，{session.get('codec', 'none')}）")
                 
                 all_sessions_ordered.append(session)
                 idx += 1
@@ -291,14 +509,7 @@ class CursorSessionManager:
             print("❌ 已取消")
             return False
         
-        # 自动备份当前会话
-        print("\n💾 正在自动备份当前会话...")
-        self.save_session(
-            session_name=f"自动备份_{datetime.now().strftime('%H%M%S')}",
-            description="恢复会话前的自动备份"
-        )
-        
-        # 恢复
+        # 恢复：先还原到目标目录中的临时文件，再原子替换，替换前的数据库保留为撤销点
         backup_file = selected['project_dir'] / selected['db_file']
         if not backup_file.exists():
             print(f"❌ 备份文件不存在: {backup_file}")
@@ -306,65 +517,169 @@ class CursorSessionManager:
         
         try:
             print(f"\n📋 正在恢复到: {current_db}")
-            shutil.copy2(backup_file, current_db)
-            
-            # 清理 WAL 和 SHM 文件
-            for ext in ['-wal', '-shm']:
-                extra = Path(str(current_db) + ext)
-                if extra.exists():
-                    extra.unlink()
-            
-            print("\n" + "="*70)
-            print("✅ 会话恢复成功！")
-            print("="*70)
-            print("\n📌 下一步操作：")
-            print("   1. 关闭 Cursor（如果正在运行）")
-            print("   2. 重新打开 Cursor")
-            print("   3. 打开相应的项目")
-            print("   4. 您将看到恢复后的会话历史")
-            print()
-            
-            return True
-            
+            restore_into(selected, current_db, self.get_current_project_info()[0] or "unknown")
         except Exception as e:
-            print(f"❌ 恢复失败: {e}")
-            import traceback
-            traceback.print_exc()
+            print(f"❌ {e}")
             return False
+        
+        print("\n" + "="*70)
+        print("✅ 会话恢复成功！")
+        print("="*70)
+        print("\n↩️  恢复前的会话已保留，如需撤销: python3 cursor_sessions.py undo-restore")
+        print("\n📌 下一步操作：")
+        print("   1. 关闭 Cursor（如果正在运行）")
+        print("   2. 重新打开 Cursor")
+        print("   3. 打开相应的项目")
+        print("   4. 您将看到恢复后的会话历史")
+        print()
+        
+        return True
+    
+    def undo_restore(self, db=None):
+        """撤销最近一次恢复（或指定数据库的恢复）：与保留的恢复前数据库交换，再次执行即重新应用恢复"""
+        candidates = restore_undo_records(db)
+        if not candidates:
+            print("\n❌ 没有可撤销的恢复")
+            return False
+        
+        try:
+            result = revert_restore(candidates[0]['db'])
+        except (LookupError, RuntimeError) as e:
+            print(f"❌ {e}")
+            return False
+        
+        if result['state'] == "undone":
+            print(f"\n✅ 已撤销恢复「{result['session_name']}」: {result['db']}")
+            print("   再次执行 undo-restore 可重新应用这次恢复")
+        else:
+            print(f"\n✅ 已重新应用恢复「{result['session_name']}」: {result['db']}")
+        print("   请重启 Cursor 以加载会话")
+        return True
+    
+    def _delete_groups(self, groups):
+        """按项目并行删除会话（各组应按时间倒序），返回 (删除数, [(ID, 异常)], 释放 KB)"""
+        def delete_group(sessions):
+            deleted, failed, freed_kb = 0, [], 0.0
+            for session in sessions:
+                try:
+                    # 只计引用计数降为 0 的分块，仍被其他快照共用的分块不算释放
+                    freed_kb += remove_session_files(session) / 1024
+                except Exception as e:
+                    failed.append((session['timestamp'], e))
+                    continue
+                deleted += 1
+            return deleted, failed, freed_kb
+        
+        # 不同项目的文件互不相关，可以并行删除；共享的分块引用计数由分块索引的事务保证一致
+        with ThreadPoolExecutor(max_workers=max(min(len(groups), os.cpu_count() or 4), 1)) as pool:
+            results = list(pool.map(delete_group, groups.values()))
+        
+        return (sum(r[0] for r in results),
+                [item for r in results for item in r[1]],
+                sum(r[2] for r in results))
+    
+    def pack(self, older_than=PACK_COLD_DAYS, project=None):
+        """把冷快照（早于 older_than 天）的散放分块打包进各项目的包文件，并删除冷快照的 JSON 导出缓存"""
+        print(f"\n📦 正在打包早于 {older_than:g} 天的快照...")
+        cold = 0
+        for name in pack_targets(project):
+            result = pack_project(name, older_than)
+            cold += result['cold_snapshots']
+            if not result['cold_snapshots'] and not result['compacted']:
+                continue
+            print(f"   📁 {name}: {result['cold_snapshots']} 个冷快照，打包 {result['chunks_packed']} 个分块，"
+                  f"删除 {result['json_removed']} 个 JSON 缓存，包文件 {result['pack_kb'] / 1024:.1f} MB"
+                  + ("（已改写去除死记录）" if result['compacted'] else ""))
+        if not cold:
+            print(f"📭 没有早于 {older_than:g} 天的快照")
+        print("✅ 打包完成")
+        return True
+    
+    def prune(self, dry_run=False):
+        """按保留策略清理旧的自动保存（dry_run 时只列出将删除的会话）"""
+        summary, groups = plan_retention(load_retention_policy())
+        print("\n" + "="*70)
+        print("🧹 保留策略" + ("（预演，不会删除）" if dry_run else ""))
+        print("="*70)
+        for project, info in summary['projects'].items():
+            if not info['pruned']:
+                continue
+            print(f"\n📁 {project}: 保留 {info['kept']} 个，删除 {len(info['pruned'])} 个"
+                  f"（约 {info['reclaimed_kb'] / 1024:.1f} MB）")
+            for item in info['pruned']:
+                print(f"   - {item['id']}  {item['name'] or ''}  [{RETENTION_REASONS[item['reason']]}]")
+        
+        if not summary['pruned']:
+            print("\n✅ 没有需要清理的自动保存")
+            return True
+        if dry_run:
+            print(f"\n共 {summary['pruned']} 个自动保存将被删除，可回收约 {summary['reclaimed_kb'] / 1024:.1f} MB")
+            return True
+        
+        deleted, failed, freed_kb = self._delete_groups(groups)
+        for identifier, error in failed:
+            print(f"❌ 删除 {identifier} 失败: {error}")
+        print(f"\n✅ 已删除 {deleted} 个自动保存，回收约 {freed_kb / 1024:.1f} MB")
+        return not failed
     
     def delete_session(self, identifier):
         """删除指定的会话"""
-        all_sessions = self.list_sessions()
-        
-        selected = None
-        for session in all_sessions:
-            if session['timestamp'] == identifier:
-                selected = session
-                break
+        return self.delete_sessions(identifiers=[identifier])
+    
+    def delete_sessions(self, identifiers=None, older_than=None, project=None, assume_yes=False):
+        """批量删除会话：一次索引查询选出会话，确认一次后按项目并行删除
+
+        older_than 为天数或 ISO 日期/时间，选择早于该时刻的会话；各条件同时满足
+        """
+        before = None
+        if older_than:
+            try:
+                before = (datetime.now() - timedelta(days=float(older_than))).isoformat()
+            except ValueError:
+                try:
+                    before = datetime.fromisoformat(older_than).isoformat()
+                except ValueError:
+                    print(f"❌ 无效的时间: {older_than}（应为天数或日期，如 30 或 2025-10-01）")
+                    return False
         
-        if not selected:
+        selected = query_sessions(project_dir=project, session_ids=identifiers, before=before)
+        missing = sorted(set(identifiers or []) - {s['timestamp'] for s in selected})
+        for identifier in missing:
             print(f"❌ 未找到 ID 为 {identifier} 的会话")
+        if not selected:
+            if not missing:
+                print("📭 没有符合条件的会话")
             return False
         
-        print(f"\n准备删除会话: {selected['name']}")
-        confirm = input("确认删除？(yes/no): ").strip().lower()
+        # 按项目分组（查询结果已按时间倒序，组内从新到旧删除，增量快照链不会为即将删除的快照重建关键帧）
+        groups = {}
+        for session in selected:
+            groups.setdefault(session['project_dir'].name, []).append(session)
         
-        if confirm not in ['yes', 'y']:
-            print("❌ 已取消")
-            return False
+        if len(selected) == 1:
+            print(f"\n准备删除会话: {selected[0]['name']}")
+        else:
+            print(f"\n准备删除 {len(selected)} 个会话（预计释放约 {reclaimable_kb(selected) / 1024:.1f} MB）:")
+            for name, sessions in groups.items():
+                print(f"   📁 {name}: {len(sessions)} 个")
+        
+        if not assume_yes:
+            confirm = input("确认删除？(yes/no): ").strip().lower()
+            if confirm not in ['yes', 'y']:
+                print("❌ 已取消")
+                return False
         
-        # 删除文件
-        try:
-            for ext in ['.db', '.json', '.meta.json']:
-                file_path = selected['project_dir'] / (selected['timestamp'] + '_' + selected['name'] + ext)
-                if file_path.exists():
-                    file_path.unlink()
-            
-            print("✅ 会话已删除")
-            return True
-        except Exception as e:
-            print(f"❌ 删除失败: {e}")
-            return False
+        deleted, failed, freed_kb = self._delete_groups(groups)
+        for identifier, error in failed:
+            print(f"❌ 删除 {identifier} 失败: {error}")
+        
+        if len(selected) == 1:
+            if not failed:
+                print("✅ 会话已删除")
+        else:
+            print(f"✅ 已删除 {deleted} 个会话，释放约 {freed_kb / 1024:.1f} MB"
+                  + (f"，{len(failed)} 个失败" if failed else ""))
+        return not failed and not missing
 
 def main():
     manager = CursorSessionManager()
@@ -375,10 +690,31 @@ def main():
         print("="*70)
         print("\n用法:")
         print("  python3 cursor_sessions.py save              - 保存当前会话")
+        print("  python3 cursor_sessions.py save --all-active [--window 秒数]")
+        print("                                               - 保存最近有写入的所有会话（无变化的跳过）")
         print("  python3 cursor_sessions.py list              - 列出所有会话")
         print("  python3 cursor_sessions.py restore           - 恢复会话（交互式）")
         print("  python3 cursor_sessions.py restore <ID>      - 恢复指定会话")
-        print("  python3 cursor_sessions.py delete <ID>       - 删除指定会话")
+        print("  python3 cursor_sessions.py undo-restore [数据库路径]")
+        print("                                               - 撤销最近一次恢复（再次执行即重新应用）")
+        print("  python3 cursor_sessions.py delete <ID>...    - 删除指定会话")
+        print("  python3 cursor_sessions.py delete [--older-than 天数|日期] [--project 项目名] [-y]")
+        print("                                               - 批量删除符合条件的会话")
+        print("  python3 cursor_sessions.py export <ID>       - 导出会话为 JSON")
+        print("  python3 cursor_sessions.py export <ID> --ndjson [--output 路径]")
+        print("                                               - 按表导出为 NDJSON")
+        print("  python3 cursor_sessions.py diff <ID1> <ID2> [--limit N] [--json]")
+        print("                                               - 比较两个快照（逐表列出新增、删除和修改的行）")
+        print("  python3 cursor_sessions.py reindex           - 重建会话索引")
+        print("  python3 cursor_sessions.py search <关键词> [--page N]")
+        print("                                               - 全文搜索所有快照的对话内容")
+        print("  python3 cursor_sessions.py messages <ID> [--offset N] [--limit N]")
+        print("                                               - 分页查看快照中的对话")
+        print("  python3 cursor_sessions.py prune [--dry-run]  - 按保留策略清理旧的自动保存")
+        print("  python3 cursor_sessions.py pack [--older-than 天数] [--project 项目名]")
+        print("                                               - 把冷快照的分块打包进项目包文件")
+        print("  python3 cursor_sessions.py recompress [--codec zstd|gzip|lzma|none]")
+        print("                                               - 重新压缩已保存的快照")
         print("\n示例:")
         print("  python3 cursor_sessions.py save")
         print("  python3 cursor_sessions.py list")
@@ -392,17 +728,147 @@ def main():
     command = sys.argv[1].lower()
     
     if command == 'save':
-        manager.save_session()
+        args = sys.argv[2:]
+        if '--all-active' in args:
+            window = SNAPSHOT_ALL_WINDOW_SECONDS
+            if '--window' in args:
+                idx = args.index('--window')
+                try:
+                    window = float(args[idx + 1])
+                except (IndexError, ValueError):
+                    print("❌ --window 需要指定秒数")
+                    sys.exit(1)
+            if not manager.save_all_active(window):
+                sys.exit(1)
+        else:
+            manager.save_session()
     elif command == 'list':
         manager.list_sessions()
     elif command == 'restore':
         identifier = sys.argv[2] if len(sys.argv) > 2 else None
         manager.restore_session(identifier)
+    elif command == 'undo-restore':
+        db = sys.argv[2] if len(sys.argv) > 2 else None
+        if not manager.undo_restore(db):
+            sys.exit(1)
     elif command == 'delete':
-        if len(sys.argv) < 3:
-            print("❌ 请指定要删除的会话 ID")
+        args = sys.argv[2:]
+        options = {}
+        for option in ('--older-than', '--project'):
+            if option in args:
+                idx = args.index(option)
+                if idx + 1 >= len(args):
+                    print(f"❌ {option} 需要指定值")
+                    sys.exit(1)
+                options[option] = args[idx + 1]
+                del args[idx:idx + 2]
+        assume_yes = '-y' in args or '--yes' in args
+        identifiers = [arg for arg in args if arg not in ('-y', '--yes')]
+        if not identifiers and not options:
+            print("❌ 请指定要删除的会话 ID，或使用 --older-than / --project 选择会话")
+            sys.exit(1)
+        if not manager.delete_sessions(identifiers=identifiers or None,
+                                       older_than=options.get('--older-than'),
+                                       project=options.get('--project'),
+                                       assume_yes=assume_yes):
+            sys.exit(1)
+    elif command == 'export':
+        args = sys.argv[2:]
+        if not args or args[0].startswith('--'):
+            print("❌ 请指定要导出的会话 ID")
+            sys.exit(1)
+        output = None
+        if '--output' in args:
+            idx = args.index('--output')
+            if idx + 1 >= len(args):
+                print("❌ --output 需要指定路径")
+                sys.exit(1)
+            output = args[idx + 1]
+        if not manager.export_session(args[0], ndjson='--ndjson' in args, output=output):
+            sys.exit(1)
+    elif command == 'diff':
+        args = sys.argv[2:]
+        limit = DIFF_ROW_LIMIT
+        if '--limit' in args:
+            idx = args.index('--limit')
+            try:
+                limit = max(int(args[idx + 1]), 0)
+            except (IndexError, ValueError):
+                print("❌ --limit 需要指定行数")
+                sys.exit(1)
+            del args[idx:idx + 2]
+        as_json = '--json' in args
+        identifiers = [arg for arg in args if arg != '--json']
+        if len(identifiers) != 2:
+            print("❌ 请指定要比较的两个会话 ID（旧版本在前）")
+            sys.exit(1)
+        if not manager.diff_sessions(identifiers[0], identifiers[1], limit=limit, as_json=as_json):
+            sys.exit(1)
+    elif command == 'reindex':
+        manager.reindex()
+    elif command == 'search':
+        args = sys.argv[2:]
+        page = 1
+        if '--page' in args:
+            idx = args.index('--page')
+            try:
+                page = max(int(args[idx + 1]), 1)
+            except (IndexError, ValueError):
+                print("❌ --page 需要指定页码")
+                sys.exit(1)
+            del args[idx:idx + 2]
+        if not args:
+            print("❌ 请指定搜索关键词")
+            sys.exit(1)
+        manager.search(' '.join(args), page=page)
+    elif command == 'messages':
+        args = sys.argv[2:]
+        options = {'--offset': 0, '--limit': MESSAGES_PAGE_SIZE}
+        for option in options:
+            if option in args:
+                idx = args.index(option)
+                try:
+                    options[option] = max(int(args[idx + 1]), 0)
+                except (IndexError, ValueError):
+                    print(f"❌ {option} 需要指定数字")
+                    sys.exit(1)
+                del args[idx:idx + 2]
+        if not args:
+            print("❌ 请指定要查看的会话 ID")
+            sys.exit(1)
+        if not manager.show_messages(args[0], offset=options['--offset'], limit=max(options['--limit'], 1)):
+            sys.exit(1)
+    elif command == 'pack':
+        args = sys.argv[2:]
+        options = {}
+        for option in ('--older-than', '--project'):
+            if option in args:
+                idx = args.index(option)
+                if idx + 1 >= len(args):
+                    print(f"❌ {option} 需要指定值")
+                    sys.exit(1)
+                options[option] = args[idx + 1]
+        try:
+            older_than = float(options.get('--older-than', PACK_COLD_DAYS))
+        except ValueError:
+            print("❌ --older-than 需要指定天数")
+            sys.exit(1)
+        if not manager.pack(older_than, project=options.get('--project')):
+            sys.exit(1)
+    elif command == 'prune':
+        if not manager.prune(dry_run='--dry-run' in sys.argv[2:]):
+            sys.exit(1)
+    elif command == 'recompress':
+        args = sys.argv[2:]
+        codec = None
+        if '--codec' in args:
+            idx = args.index('--codec')
+            if idx + 1 >= len(args):
+                print("❌ --codec 需要指定压缩格式")
+                sys.exit(1)
+            codec = args[idx + 1]
+        if not manager.recompress(codec):
             sys.exit(1)
-        manager.delete_session(sys.argv[2])
     else:
         print(f"❌ 未知命令: {command}")
         sys.exit(1)
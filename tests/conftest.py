@@ -0,0 +1,80 @@
+"""
+pytest 公共夹具：每个测试使用独立的 HOME（~/.cursor 与 saved_sessions 都在临时目录中），
+并重新导入后端模块，使模块级路径和配置指向该目录
+"""
+
+import json
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = REPO_DIR / "web-ui" / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# 会改变默认配置的环境变量，测试中一律使用代码中的默认值
+CONFIG_ENV = ('SNAPSHOT_CODEC', 'DELTA_KEYFRAME_INTERVAL', 'AUTO_SAVE_ENABLED', 'AUTO_SAVE_DELTA',
+              'AUTO_SAVE_MAX_KEEP', 'RETENTION_ENABLED', 'RETENTION_PROJECT_MAX_MB', 'RETENTION_TOTAL_MAX_MB')
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    for name in CONFIG_ENV:
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+@pytest.fixture
+def store(home):
+    """重新导入的 session_store 模块"""
+    sys.modules.pop('app', None)
+    sys.modules.pop('session_store', None)
+    import session_store
+    return session_store
+
+
+@pytest.fixture
+def backend(store):
+    """重新导入的 app 模块（不触发启动事件，不启动后台监听和保留策略）"""
+    import app
+    yield app
+    app.job_manager.shutdown()
+    app.message_readers.close()
+
+
+@pytest.fixture
+def client(backend):
+    from fastapi.testclient import TestClient
+    return TestClient(backend.app)
+
+
+@pytest.fixture
+def chat_db(home):
+    """在 ~/.cursor 下创建（或追加写入）一个聊天数据库，返回数据库路径
+
+    rows 条消息写入 blobs 表，payload 为每条消息附加的字节（默认随机，不可压缩）
+    """
+    def make(rows=50, project="home-user-demo", chat="abc123", session="s1", start=0, payload=None):
+        project_dir = home / ".cursor" / "projects" / project
+        project_dir.mkdir(parents=True, exist_ok=True)
+        with open(project_dir / "worker.log", "a") as f:
+            f.write("x\n")
+        db_dir = home / ".cursor" / "chats" / chat / session
+        db_dir.mkdir(parents=True, exist_ok=True)
+        db_path = db_dir / "store.db"
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, data BLOB)")
+        for i in range(start, start + rows):
+            message = {"role": "user" if i % 2 else "assistant", "content": f"message {i}"}
+            data = json.dumps(message).encode() + (payload if payload is not None else os.urandom(1000))
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (f"id{i}", data))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('agent', ?)", (json.dumps({"name": "demo"}),))
+        conn.commit()
+        conn.close()
+        return db_path
+    return make
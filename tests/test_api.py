@@ -0,0 +1,114 @@
+"""Web 接口：保存、列表、比较、删除，以及保留策略与自动保存配置"""
+
+import sqlite3
+
+import pytest
+
+PROJECT = "home-user-demo"
+
+
+def add_message(db_path, blob_id):
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO blobs VALUES (?, ?)", (blob_id, b'{"role": "user", "content": "new"}'))
+    conn.commit()
+    conn.close()
+
+
+def save(client, name):
+    response = client.post("/api/sessions/save?wait=true", json={"name": name, "description": ""})
+    assert response.status_code == 200, response.text
+    return response.json()["session_id"]
+
+
+def store_kb(backend) -> float:
+    conn = backend.open_store()
+    try:
+        return conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM chunks").fetchone()[0] / 1024
+    finally:
+        conn.close()
+
+
+def test_save_list_and_diff(client, chat_db):
+    db_path = chat_db(rows=20)
+    old_id = save(client, "before")
+    add_message(db_path, "added")
+    new_id = save(client, "after")
+
+    sessions = client.get("/api/sessions").json()
+    assert [s["name"] for s in sessions] == ["after", "before"]
+    assert all(s["project"] == PROJECT for s in sessions)
+
+    diff = client.get(f"/api/sessions/{old_id}/diff/{new_id}?wait=true").json()
+    assert diff["summary"]["added"] == 1
+    assert diff["tables"]["blobs"]["rows"]["added"][0]["key"] == {"id": "added"}
+    assert client.get(f"/api/sessions/{old_id}/diff/missing?wait=true").status_code == 404
+
+
+def test_delete_and_projects_report_deduplicated_usage(client, backend, chat_db):
+    db_path = chat_db(rows=100)
+    ids = []
+    for i in range(3):
+        add_message(db_path, f"m{i}")
+        ids.append(save(client, f"s{i}"))
+
+    project = next(p for p in client.get("/api/projects").json() if p["name"] == PROJECT)
+    assert project["sessions_count"] == 3
+    assert project["stored_kb"] == pytest.approx(store_kb(backend), abs=0.1)
+    assert project["logical_kb"] > project["stored_kb"] and project["savings_percent"] > 0
+
+    before = store_kb(backend)
+    result = client.post("/api/sessions/bulk-delete", json={"ids": ids[:2]}).json()
+    assert len(result["deleted"]) == 2
+    assert result["freed_kb"] == pytest.approx(before - store_kb(backend), abs=0.1)
+
+    metrics = client.get("/api/metrics").text
+    assert f'cursor_sessions_sessions{{project="{PROJECT}"}} 1' in metrics
+    assert f'cursor_sessions_store_bytes{{kind="stored",project="{PROJECT}"}} {round(store_kb(backend) * 1024)}' in metrics
+
+    assert client.delete(f"/api/sessions/{ids[2]}").status_code == 200
+    assert client.delete(f"/api/sessions/{ids[2]}").status_code == 404
+    assert store_kb(backend) == 0
+
+
+def test_retention_caps_can_be_cleared(client):
+    caps = {"max_keep": 50, "project_max_mb": 500.0, "total_max_mb": 2000.0}
+    project_caps = {"max_keep": 5, "project_max_mb": 10.0}
+    policy = client.put("/api/retention", json=dict(caps, projects={PROJECT: project_caps})).json()
+    assert {key: policy[key] for key in caps} == caps and policy["projects"] == {PROJECT: project_caps}
+
+    # 显式的 null 取消上限，省略的字段保持不变
+    cleared = {"max_keep": None, "project_max_mb": None, "total_max_mb": None}
+    policy = client.put("/api/retention", json=dict(cleared, projects={PROJECT: {"max_keep": None}})).json()
+    assert {key: policy[key] for key in caps} == cleared
+    assert policy["projects"] == {PROJECT: {"max_keep": None}}
+    assert client.get("/api/retention").json()["max_keep"] is None
+
+    assert client.put("/api/retention", json={"daily_days": None}).status_code == 400
+    assert client.put("/api/retention", json={"projects": {PROJECT: {"bogus": 1}}}).status_code == 400
+    assert client.put("/api/retention", json={"projects": None}).json()["projects"] == {}
+
+
+def test_retention_dry_run_does_not_delete(client, backend, chat_db):
+    db_path = chat_db(rows=50)
+    for i in range(3):
+        add_message(db_path, f"m{i}")
+        assert client.post("/api/sessions/auto-save?wait=true").json()["status"] == "success"
+    client.put("/api/retention", json={"max_keep": 1})
+
+    dry = client.post("/api/retention/run?dry_run=true").json()
+    assert dry["dry_run"] and dry["pruned"] == 2
+    assert len(backend.query_sessions()) == 3
+
+    result = client.post("/api/retention/run").json()
+    assert result["deleted"] == 2 and result["failed"] == []
+    assert len(backend.query_sessions()) == 1
+
+
+def test_auto_save_config(client):
+    config = client.get("/api/auto-save/config").json()
+    assert config["enabled"] is False and "watcher" in config
+
+    config = client.put("/api/auto-save/config", json={"enabled": True, "max_latency_seconds": 300}).json()
+    assert config["enabled"] is True and config["max_latency_seconds"] == 300
+    # 省略的字段保持不变
+    assert client.put("/api/auto-save/config", json={"quiet_seconds": 5}).json()["max_latency_seconds"] == 300
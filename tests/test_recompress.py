@@ -0,0 +1,85 @@
+"""重新压缩分块：提交后才删除旧文件，失败时回滚并删除新写入的文件"""
+
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def saved(store, chat_db, monkeypatch):
+    """以不压缩的格式保存三个快照，返回会话列表"""
+    monkeypatch.setattr(store, 'SNAPSHOT_CODEC', 'none')
+    db_path = chat_db(rows=300, payload=b"a" * 1000)
+    for i in range(3):
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (f"x{i}", b"b" * 3000))
+        conn.commit()
+        conn.close()
+        store.save_snapshot(db_path, "abc123", "home-user-demo", f"s{i}", "")
+    return store.query_sessions()
+
+
+def chunk_files(store) -> list:
+    return [f for f in (store.STORE_DIR / "chunks").rglob("*") if f.is_file()]
+
+
+def chunk_codecs(store) -> dict:
+    conn = store.open_store()
+    try:
+        return dict(conn.execute("SELECT hash, codec FROM chunks"))
+    finally:
+        conn.close()
+
+
+def assert_readable(store, metas, tmp_path):
+    conn = store.open_store()
+    try:
+        for chunk_hash in chunk_codecs(store):
+            store.read_chunk(conn, chunk_hash)
+    finally:
+        conn.close()
+    for meta in metas:
+        store.materialize_snapshot(meta, tmp_path / "restored.db")
+        conn = sqlite3.connect(tmp_path / "restored.db")
+        try:
+            # 第 i 个快照（名称 s{i}）有 300 条原始消息和 i + 1 条新消息
+            assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 301 + int(meta['name'][1:])
+        finally:
+            conn.close()
+
+
+def test_recompress_replaces_files(store, saved, tmp_path):
+    files_before = len(chunk_files(store))
+    result = store.recompress_chunks('gzip')
+    assert result['chunks_recompressed'] == files_before
+    assert result['bytes_after'] < result['bytes_before']
+    assert set(chunk_codecs(store).values()) == {'gzip'}
+    # 旧格式的文件在提交后删除，每个分块只剩一个文件
+    assert len(chunk_files(store)) == files_before
+    assert all(f.name.endswith(".gz") for f in chunk_files(store))
+    assert_readable(store, saved, tmp_path)
+
+
+def test_failed_batch_rolls_back(store, saved, tmp_path, monkeypatch):
+    files_before = sorted(chunk_files(store))
+    codecs_before = chunk_codecs(store)
+    write_encoded_chunk = store.write_encoded_chunk
+    calls = []
+
+    def flaky(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise OSError("disk full")
+        return write_encoded_chunk(*args)
+    monkeypatch.setattr(store, 'write_encoded_chunk', flaky)
+
+    with pytest.raises(OSError):
+        store.recompress_chunks('gzip')
+    # 回滚后索引、旧文件不变，本批新写入的文件已删除
+    assert chunk_codecs(store) == codecs_before
+    assert sorted(chunk_files(store)) == files_before
+    assert_readable(store, saved, tmp_path)
+
+    monkeypatch.setattr(store, 'write_encoded_chunk', write_encoded_chunk)
+    assert store.recompress_chunks('gzip')['chunks_recompressed'] == len(files_before)
+    assert_readable(store, saved, tmp_path)
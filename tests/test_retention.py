@@ -0,0 +1,93 @@
+"""保留策略：按分块去重后的实际占用计算大小上限和可回收空间"""
+
+import os
+import sqlite3
+
+import pytest
+
+PROJECT = "home-user-demo"
+
+
+@pytest.fixture
+def snapshots(store, chat_db, monkeypatch):
+    """自动保存 count 次，每次写入新的随机数据，返回会话列表（按时间倒序）"""
+    # 不压缩：新写入分块的估算大小与实际一致
+    monkeypatch.setattr(store, 'SNAPSHOT_CODEC', 'none')
+    db_path = chat_db(rows=300)
+
+    def save(count, delta=False, start=0):
+        for i in range(start, start + count):
+            conn = sqlite3.connect(db_path)
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (f"new{i}", os.urandom(3000)))
+            conn.commit()
+            conn.close()
+            assert store.auto_save_snapshot(db_path, "abc123", PROJECT, delta=delta)['status'] == 'success'
+        return store.query_sessions(auto_saved=True)
+    save.db_path = db_path
+    return save
+
+
+def store_bytes(store) -> int:
+    conn = store.open_store()
+    try:
+        return conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM chunks").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def policy(store, **rules):
+    return dict(store.load_retention_policy(), **rules)
+
+
+def prune(store, deletions) -> int:
+    """执行删除，返回存储实际减少的字节数"""
+    before = store_bytes(store)
+    for sessions in deletions.values():
+        for meta in sessions:
+            store.remove_session_files(meta)
+    return before - store_bytes(store)
+
+
+@pytest.mark.parametrize("delta", [False, True])
+def test_reclaimed_matches_freed_space(store, snapshots, delta):
+    snapshots(5, delta=delta)
+    summary, deletions = store.plan_retention(policy(store, max_keep=1))
+    assert summary['pruned'] == 4
+    assert summary['reclaimed_kb'] == summary['projects'][PROJECT]['reclaimed_kb']
+    freed_kb = prune(store, deletions) / 1024
+    assert summary['reclaimed_kb'] == pytest.approx(freed_kb, abs=1)
+    assert len(store.query_sessions()) == 1
+
+
+def test_preview_matches_freed_space(store, snapshots):
+    metas = snapshots(4)
+    selected = metas[1:3]
+    expected_kb = store.reclaimable_kb(selected)
+    assert expected_kb == pytest.approx(prune(store, {PROJECT: selected}) / 1024, abs=1)
+
+
+def test_project_cap_uses_deduplicated_usage(store, snapshots):
+    metas = snapshots(4)
+    used_mb = store_bytes(store) / 1024 / 1024
+    # 各快照的 stored_kb 之和远大于实际占用，上限只要高于去重后的占用就不删除
+    assert sum(meta['stored_kb'] for meta in metas) / 1024 > 2 * used_mb
+    summary, _ = store.plan_retention(policy(store, project_max_mb=used_mb * 1.01))
+    assert summary['pruned'] == 0
+
+    limit_mb = used_mb - 5 / 1024
+    summary, deletions = store.plan_retention(policy(store, project_max_mb=limit_mb))
+    assert 1 <= summary['pruned'] < 4
+    assert {item['reason'] for item in summary['projects'][PROJECT]['pruned']} == {'project_size'}
+    prune(store, deletions)
+    assert store_bytes(store) / 1024 / 1024 <= limit_mb
+
+
+def test_chunks_shared_with_manual_saves_are_not_reclaimed(store, snapshots):
+    snapshots(1)
+    store.save_snapshot(snapshots.db_path, "abc123", PROJECT, "manual", "")
+    snapshots(1, start=1)
+    summary, deletions = store.plan_retention(policy(store, max_keep=1))
+    # 被删除的自动保存与手动保存内容相同，分块全部仍被引用
+    assert summary['pruned'] == 1 and summary['reclaimed_kb'] == 0
+    assert prune(store, deletions) == 0
+    assert len(store.query_sessions(auto_saved=False)) == 1
@@ -0,0 +1,127 @@
+"""分块存储：引用计数、增量快照链与删除快照时的链压缩"""
+
+import sqlite3
+from collections import Counter
+
+
+def chunk_refs(store) -> dict:
+    conn = store.open_store()
+    try:
+        return dict(conn.execute("SELECT hash, refs FROM chunks"))
+    finally:
+        conn.close()
+
+
+def manifest_refs(store) -> Counter:
+    """所有快照清单对分块的引用次数（引用计数应与之一致）"""
+    refs = Counter()
+    for manifest_file in store.SESSIONS_DIR.rglob("*.manifest.json"):
+        refs.update(store.manifest_chunks(store.load_manifest(manifest_file)))
+    return refs
+
+
+def stored_bytes(store) -> int:
+    conn = store.open_store()
+    try:
+        return conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM chunks").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def db_rows(db_path) -> list:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT id, data FROM blobs ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def append_rows(db_path, start, rows=5):
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO blobs VALUES (?, ?)",
+                     [(f"extra{i}", b"x" * 500) for i in range(start, start + rows)])
+    conn.commit()
+    conn.close()
+
+
+def test_shared_chunks_are_counted_and_freed_once(store, chat_db):
+    db_path = chat_db(rows=200)
+    manifests = store.SESSIONS_DIR / "demo"
+    manifests.mkdir()
+    first = store.store_snapshot(db_path, manifests / "a.manifest.json")
+    second = store.store_snapshot(db_path, manifests / "b.manifest.json")
+
+    assert first['chunks'] == second['chunks']
+    total = stored_bytes(store)
+    assert chunk_refs(store) == manifest_refs(store)
+    assert set(chunk_refs(store).values()) == {2}
+
+    # 仍被另一个快照引用的分块不释放，最后一个引用释放时返回实际删除的字节数
+    assert store.release_snapshot(manifests / "a.manifest.json") == 0
+    assert set(chunk_refs(store).values()) == {1}
+    assert store.release_snapshot(manifests / "b.manifest.json") == total > 0
+    assert chunk_refs(store) == {}
+    assert not [f for f in (store.STORE_DIR / "chunks").rglob("*") if f.is_file()]
+
+
+def test_delta_chain_restores_each_snapshot(store, chat_db, tmp_path):
+    db_path = chat_db(rows=200)
+    manifests = store.SESSIONS_DIR / "demo"
+    manifests.mkdir()
+    expected = {"k.manifest.json": db_path.read_bytes()}
+    store.store_snapshot(db_path, manifests / "k.manifest.json")
+    base = "k.manifest.json"
+    for i in range(3):
+        append_rows(db_path, i * 5)
+        name = f"d{i}.manifest.json"
+        delta = store.store_delta_snapshot(db_path, manifests / base, manifests / name)
+        assert delta['type'] == 'delta' and delta['base'] == base
+        assert 0 < len(delta['pages']) < delta['size'] // delta['page_size']
+        expected[name] = db_path.read_bytes()
+        base = name
+
+    assert len(store.load_chain(manifests / "d2.manifest.json")) == 4
+    assert chunk_refs(store) == manifest_refs(store)
+    for name, content in expected.items():
+        store.restore_snapshot(manifests / name, tmp_path / "restored.db")
+        assert (tmp_path / "restored.db").read_bytes() == content
+
+
+def test_delta_falls_back_to_keyframe(store, chat_db, monkeypatch):
+    db_path = chat_db(rows=200)
+    manifests = store.SESSIONS_DIR / "demo"
+    manifests.mkdir()
+    assert store.store_delta_snapshot(db_path, manifests / "missing.manifest.json", manifests / "d.manifest.json") is None
+
+    store.store_snapshot(db_path, manifests / "k.manifest.json")
+    monkeypatch.setattr(store, 'DELTA_KEYFRAME_INTERVAL', 1)
+    append_rows(db_path, 0)
+    assert store.store_delta_snapshot(db_path, manifests / "k.manifest.json", manifests / "d.manifest.json") is None
+    assert not (manifests / "d.manifest.json").exists()
+    assert chunk_refs(store) == manifest_refs(store)
+
+
+def test_deleting_from_a_chain_keeps_the_rest_restorable(store, chat_db, tmp_path):
+    db_path = chat_db(rows=200)
+    contents = []
+    for i in range(4):
+        append_rows(db_path, i * 5)
+        result = store.auto_save_snapshot(db_path, "abc123", "home-user-demo", delta=True)
+        assert result['status'] == 'success'
+        contents.append(db_rows(db_path))
+    metas = list(reversed(store.query_sessions()))
+    types = [store.load_manifest(m['project_dir'] / m['db_file']).get('type') for m in metas]
+    assert types == [None, 'delta', 'delta', 'delta']
+
+    # 删除中间的增量快照（页并入子快照），再删除关键帧（子快照重新存为关键帧）
+    for index in (1, 0):
+        store.remove_session_files(metas[index])
+        assert chunk_refs(store) == manifest_refs(store)
+    assert store.load_manifest(metas[2]['project_dir'] / metas[2]['db_file']).get('type') is None
+    for meta, content in zip(metas[2:], contents[2:]):
+        store.materialize_snapshot(meta, tmp_path / "restored.db")
+        assert db_rows(tmp_path / "restored.db") == content
+
+    for meta in metas[2:]:
+        store.remove_session_files(meta)
+    assert chunk_refs(store) == {}
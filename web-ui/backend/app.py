@@ -4,19 +4,54 @@ Cursor Session Manager - Web API Backend
 提供 RESTful API 用于管理 Cursor 会话
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List, Optional
 import sqlite3
 import json
 import os
-from datetime import datetime
+import asyncio
+import uuid
+import base64
+import hashlib
+import html
+import re
+import tempfile
+import threading
+import time
+import zipfile
+import contextvars
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 import shutil
 import uvicorn
 
+try:
+    import watchfiles  # 随 uvicorn[standard] 安装，基于 inotify 等系统事件
+except ImportError:
+    watchfiles = None
+
+# 会话索引、分块存储、快照与保留策略等与 CLI 共用的实现
+from session_store import (
+    CURSOR_DIR, SESSIONS_DIR, AUTO_SAVE_CONFIG_FILE, RETENTION_FILE, RETENTION_PROJECT_RULES,
+    RETENTION_NULLABLE, CHUNK_CODECS, SNAPSHOT_CODEC, PACK_COLD_DAYS, DIFF_ROW_LIMIT,
+    SNAPSHOT_ALL_WINDOW_SECONDS, SEARCH_PAGE_SIZE, SEARCH_MARK_START, SEARCH_MARK_END, MESSAGES_PAGE_SIZE,
+    MESSAGES_MAX_PAGE_SIZE, REQUEST_TIMINGS, metrics,
+    open_catalog, sync_catalog, query_sessions, write_metadata, open_store, discard_staged,
+    materialize_snapshot, remove_session_files, rebuild_catalog, rebuild_store_refs,
+    export_db_to_json, snapshot_signature, ensure_json_export, json_export_is_fresh,
+    decode_message, conversation_blob_ids, sync_search_index, read_snapshot_messages, search_sessions,
+    load_auto_save_config, load_retention_policy, plan_retention, project_usage, assign_chat_projects,
+    auto_save_snapshot, save_snapshot, restore_into, restore_undo_records, revert_restore, diff_snapshots,
+    pack_targets, pack_project, recompress_chunks, recompress_targets, recompress_project
+)
+
 app = FastAPI(title="Cursor Session Manager API")
 
 # CORS 配置
@@ -26,12 +61,54 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Total-Count", "X-Next-Cursor", "Server-Timing"],
 )
 
 # 配置路径
-CURSOR_DIR = Path.home() / ".cursor"
-SESSIONS_DIR = Path.home() / "cursor-session-manager" / "saved_sessions"
-SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
+# 前端静态文件：容器内位于 /app/frontend，本地运行（如 benchmarks/suite.py）时使用仓库中的 web-ui/frontend
+FRONTEND_DIR = Path(os.environ.get('FRONTEND_DIR') or (
+    "/app/frontend" if Path("/app/frontend").is_dir() else Path(__file__).resolve().parent.parent / "frontend"))
+# 批量导出生成的压缩包，超过 EXPORT_ARCHIVE_TTL 秒后在下次批量导出时清理
+EXPORTS_DIR = SESSIONS_DIR / ".exports"
+EXPORT_ARCHIVE_TTL = 3600
+
+# 后台自动保存：inotify 不可用时的轮询间隔
+AUTO_SAVE_POLL_SECONDS = float(os.environ.get('AUTO_SAVE_POLL_SECONDS', 5))
+# 保留策略：启动后首次执行前的等待时间
+RETENTION_STARTUP_DELAY = 60
+
+# 后台任务：耗时操作在有界线程池中执行，同一项目的任务按提交顺序串行
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_HISTORY = 200
+JOB_POLL_INTERVAL = 0.25
+
+# 对话消息：尚未提取的快照直接只读打开，保持打开的快照数（翻页时复用连接和已解析的对话顺序）
+MESSAGE_READERS = int(os.environ.get('MESSAGE_READERS', 4))
+# 分块/增量快照要拼装为临时数据库才能打开：保持打开的临时数据库总大小上限（MB）
+MESSAGE_READERS_MAX_MB = float(os.environ.get('MESSAGE_READERS_MAX_MB', 256))
+
+# 会话列表分页：默认每页条数、上限，以及允许的排序列（空值按空字符串排序，保证键集分页稳定）
+SESSIONS_PAGE_SIZE = 100
+SESSIONS_MAX_PAGE_SIZE = 500
+SESSION_SORT_COLUMNS = {
+    'datetime': "datetime",
+    'name': "COALESCE(name, '')",
+    'project': "COALESCE(project, '')",
+    'size_kb': "size_kb"
+}
+
+# /api/events 推送：任务进度检查间隔、状态检查间隔（有订阅者时才检查）、心跳间隔和每个订阅者的队列长度
+EVENTS_JOB_INTERVAL = 0.5
+EVENTS_STATUS_INTERVAL = float(os.environ.get('EVENTS_STATUS_INTERVAL', 5))
+EVENTS_HEARTBEAT_SECONDS = 15
+EVENTS_QUEUE_SIZE = 256
+
+# 活跃会话发现：后台监听运行时的全量校验间隔
+DISCOVERY_VALIDATE_SECONDS = 60
+
+# /api/metrics：SERVER_TIMING=1 时所有响应都带 Server-Timing 头，
+# 否则只有带 X-Server-Timing: 1 请求头的请求才带
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
 
 # 数据模型
 class SessionInfo(BaseModel):
@@ -41,7 +118,10 @@ class SessionInfo(BaseModel):
     project: str
     datetime: str
     size_kb: float
+    stored_kb: Optional[float] = None
+    codec: Optional[str] = None
     db_file: str
+    json_file: Optional[str] = None
 
 class SessionRename(BaseModel):
     new_name: str
@@ -51,78 +131,782 @@ class SessionSave(BaseModel):
     name: str
     description: str
 
+class BulkSelection(BaseModel):
+    """批量操作选择的会话：各条件同时满足（before 为 ISO 日期或时间，选择早于该时刻的会话）"""
+    ids: Optional[List[str]] = None
+    project: Optional[str] = None
+    before: Optional[str] = None
+    auto_saved: Optional[bool] = None
+
+class AutoSaveConfig(BaseModel):
+    enabled: Optional[bool] = None
+    quiet_seconds: Optional[float] = None
+    max_latency_seconds: Optional[float] = None
+    delta: Optional[bool] = None
+
+class RetentionPolicy(BaseModel):
+    enabled: Optional[bool] = None
+    interval_seconds: Optional[float] = None
+    keep_all_hours: Optional[float] = None
+    hourly_hours: Optional[float] = None
+    daily_days: Optional[float] = None
+    weekly_weeks: Optional[float] = None
+    max_keep: Optional[int] = None
+    project_max_mb: Optional[float] = None
+    total_max_mb: Optional[float] = None
+    projects: Optional[dict] = None
+
 # 工具函数
+class TrackedFiles:
+    """跟踪 root 下固定深度的同名文件（如 chats/*/*/store.db）及其 mtime，目录 mtime 未变化时不重新列举"""
+    
+    def __init__(self, root: Path, depth: int, filename: str):
+        self.root = root
+        self.depth = depth
+        self.filename = filename
+        self.dirs = {}   # 已列举的目录 -> (mtime_ns, 子目录列表)
+        self.files = {}  # 文件路径 -> mtime
+    
+    def _list_dirs(self, directory: Path, level: int, visited: set):
+        try:
+            mtime = directory.stat().st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        
+        visited.add(directory)
+        cached = self.dirs.get(directory)
+        if cached and cached[0] == mtime:
+            children = cached[1]
+        else:
+            children = [p for p in directory.iterdir() if p.is_dir()]
+            self.dirs[directory] = (mtime, children)
+        
+        if level + 1 == self.depth:
+            return children
+        leaf_dirs = []
+        for child in children:
+            leaf_dirs.extend(self._list_dirs(child, level + 1, visited))
+        return leaf_dirs
+    
+    def refresh(self):
+        """按目录 mtime 增量更新目录结构，并刷新所有文件的 mtime"""
+        visited = set()
+        files = {}
+        for leaf_dir in self._list_dirs(self.root, 0, visited):
+            file_path = leaf_dir / self.filename
+            try:
+                files[file_path] = file_path.stat().st_mtime
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        self.files = files
+        for gone in set(self.dirs) - visited:
+            del self.dirs[gone]
+    
+    def touch(self, file_path: Path):
+        """文件监听通知某个文件发生变化"""
+        try:
+            self.files[file_path] = file_path.stat().st_mtime
+        except (FileNotFoundError, NotADirectoryError):
+            self.files.pop(file_path, None)
+    
+    def latest(self) -> Optional[Path]:
+        if not self.files:
+            return None
+        return max(self.files, key=self.files.get)
+
+class SessionDiscovery:
+    """活跃会话发现：缓存会话数据库和项目 worker.log
+    
+    没有文件监听时每次查询按目录 mtime 增量校验；后台监听运行时由它推送变化，
+    查询直接返回缓存结果，只每隔 DISCOVERY_VALIDATE_SECONDS 全量校验一次。
+    """
+    
+    def __init__(self):
+        self.chat_dbs = TrackedFiles(CURSOR_DIR / "chats", 2, "store.db")
+        self.worker_logs = TrackedFiles(CURSOR_DIR / "projects", 1, "worker.log")
+        self.lock = threading.Lock()
+        self.watched = False
+        self.validated_at = 0.0
+    
+    def set_watched(self, watched: bool):
+        with self.lock:
+            self.watched = watched
+            # 监听建立前的变化可能被漏掉，下次查询强制全量校验
+            self.validated_at = 0.0
+    
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+    
+    def _refresh(self):
+        self.chat_dbs.refresh()
+        self.worker_logs.refresh()
+        self.validated_at = time.monotonic()
+    
+    def _ensure_fresh(self):
+        if not self.watched or time.monotonic() - self.validated_at >= DISCOVERY_VALIDATE_SECONDS:
+            self._refresh()
+    
+    def touch(self, path: Path):
+        with self.lock:
+            if path.name == "store.db":
+                self.chat_dbs.touch(path)
+            elif path.name == "worker.log":
+                self.worker_logs.touch(path)
+    
+    def chat_db_files(self) -> List[Path]:
+        with self.lock:
+            self._ensure_fresh()
+            return list(self.chat_dbs.files)
+    
+    def current_db(self) -> Optional[Path]:
+        with self.lock:
+            self._ensure_fresh()
+            return self.chat_dbs.latest()
+    
+    def current_project(self) -> Optional[str]:
+        with self.lock:
+            self._ensure_fresh()
+            worker_log = self.worker_logs.latest()
+            return worker_log.parent.name if worker_log else None
+    
+    def active_chat_dbs(self, since: float) -> dict:
+        """since 之后有写入的会话数据库 -> 最近写入时间（WAL 模式下写入只改变 -wal 文件的 mtime）"""
+        with self.lock:
+            self._ensure_fresh()
+            files = dict(self.chat_dbs.files)
+        active = {}
+        for db_path, mtime in files.items():
+            try:
+                mtime = max(mtime, Path(str(db_path) + '-wal').stat().st_mtime)
+            except FileNotFoundError:
+                pass
+            if mtime >= since:
+                active[db_path] = mtime
+        return active
+    
+    def project_activity(self) -> dict:
+        """项目 -> worker.log 最近修改时间"""
+        with self.lock:
+            self._ensure_fresh()
+            return {worker_log.parent.name: mtime for worker_log, mtime in self.worker_logs.files.items()}
+
+session_discovery = SessionDiscovery()
+
 def find_current_session_db():
     """查找当前活跃的会话数据库"""
-    chats_dir = CURSOR_DIR / "chats"
-    if not chats_dir.exists():
+    latest_db = session_discovery.current_db()
+    if latest_db is None:
         return None, None
     
-    latest_db = None
-    latest_time = 0
-    hash_folder = None
-    
-    for hash_dir in chats_dir.iterdir():
-        if hash_dir.is_dir():
-            for session_dir in hash_dir.iterdir():
-                if session_dir.is_dir():
-                    db_file = session_dir / "store.db"
-                    if db_file.exists():
-                        mtime = db_file.stat().st_mtime
-                        if mtime > latest_time:
-                            latest_time = mtime
-                            latest_db = db_file
-                            hash_folder = hash_dir.name
-    
-    return latest_db, hash_folder
+    return latest_db, latest_db.parent.parent.name
 
 def get_current_project():
     """获取当前项目名称"""
-    projects_dir = CURSOR_DIR / "projects"
-    if not projects_dir.exists():
-        return "unknown"
-    
-    latest_project = None
-    latest_time = 0
-    
-    for project_dir in projects_dir.iterdir():
-        if project_dir.is_dir():
-            worker_log = project_dir / "worker.log"
-            if worker_log.exists():
-                mtime = worker_log.stat().st_mtime
-                if mtime > latest_time:
-                    latest_time = mtime
-                    latest_project = project_dir.name
-    
-    return latest_project or "unknown"
-
-def export_db_to_json(db_path, json_file):
-    """导出数据库到 JSON"""
+    return session_discovery.current_project() or "unknown"
+
+def discover_active_chat_dbs(window_seconds: float) -> List[tuple]:
+    """最近 window_seconds 内有写入的所有会话数据库及其所属项目，返回 [(数据库, 项目)]（从新到旧）"""
+    active = session_discovery.active_chat_dbs(time.time() - window_seconds)
+    return assign_chat_projects(active, session_discovery.project_activity())
+
+def catalog_generation() -> int:
+    """同步索引并返回索引代数（同步只检查各项目目录的 mtime，目录未变化时不读取任何会话）"""
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        row = conn.execute("SELECT value FROM catalog_state WHERE name = 'generation'").fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+def catalog_etag(generation: int, *parts) -> str:
+    """列表响应的强 ETag：由索引代数和规范化后的查询参数决定"""
+    digest = hashlib.sha256(json.dumps([generation, *parts], ensure_ascii=False).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    tags = {tag.strip() for tag in header.split(',')}
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    if not isinstance(values, list) or len(values) != 3:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    return values
+
+def parse_date_bound(value: str, end: bool = False) -> str:
+    """解析日期过滤条件，返回可直接与索引中 ISO 时间比较的字符串；只给日期的结束条件包含当天"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"无效的日期: {value}")
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed.isoformat()
+
+def query_session_page(filters: dict, sort: str, descending: bool, after: Optional[list], limit: int):
+    """按 (排序列, project_dir, meta_file) 键集分页查询会话列表，只取出列表需要的字段
+
+    返回 (过滤后的总数, 当前页, 下一页游标值)；调用前应已同步索引
+    """
+    column = SESSION_SORT_COLUMNS[sort]
+    clauses, params = [], []
+    if filters.get('project'):
+        clauses.append("project_dir = ?")
+        params.append(filters['project'])
+    if filters.get('auto_saved') is not None:
+        clauses.append("auto_saved = ?")
+        params.append(1 if filters['auto_saved'] else 0)
+    if filters.get('since'):
+        clauses.append("datetime >= ?")
+        params.append(filters['since'])
+    if filters.get('until'):
+        # 只给日期时 until 已被推到次日零点，因此不包含该时刻
+        clauses.append("datetime < ?" if filters['until_exclusive'] else "datetime <= ?")
+        params.append(filters['until'])
+    if filters.get('q'):
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', filters['q']) + '%'
+        clauses.append("(name LIKE ? ESCAPE '\\' OR json_extract(meta, '$.description') LIKE ? ESCAPE '\\')")
+        params.extend([pattern, pattern])
+    
+    page_clauses, page_params = list(clauses), list(params)
+    if after:
+        page_clauses.append(f"({column}, project_dir, meta_file) {'<' if descending else '>'} (?, ?, ?)")
+        page_params.extend(after)
+    direction = "DESC" if descending else "ASC"
+    
+    conn = open_catalog()
     try:
-        conn = sqlite3.connect(str(db_path))
-        cursor = conn.cursor()
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        total = conn.execute(f"SELECT COUNT(*) FROM sessions{where}", params).fetchone()[0]
+        page_where = " WHERE " + " AND ".join(page_clauses) if page_clauses else ""
+        rows = conn.execute(
+            f"SELECT {column} AS sort_key, project_dir, meta_file, id, "
+            "COALESCE(name, '') AS name, COALESCE(project, '') AS project, datetime, size_kb, "
+            "COALESCE(json_extract(meta, '$.description'), '') AS description, "
+            "COALESCE(json_extract(meta, '$.stored_kb'), size_kb) AS stored_kb, "
+            "COALESCE(json_extract(meta, '$.codec'), 'none') AS codec, "
+            "json_extract(meta, '$.db_file') AS db_file, json_extract(meta, '$.json_file') AS json_file "
+            f"FROM sessions{page_where} "
+            f"ORDER BY sort_key {direction}, project_dir {direction}, meta_file {direction} LIMIT ?",
+            page_params + [limit + 1]
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = [rows[-1]['sort_key'], rows[-1]['project_dir'], rows[-1]['meta_file']]
+    return total, rows, next_after
+
+metrics.describe("cursor_sessions_http_requests_total", "counter", "HTTP requests by route and status")
+metrics.describe("cursor_sessions_http_request_duration_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("cursor_sessions_message_readers_total", "counter",
+                 "Conversation page reads from unindexed snapshots by reader cache result (hit, open)")
+metrics.describe("cursor_sessions_jobs_total", "counter", "Finished background jobs by kind and status")
+metrics.describe("cursor_sessions_job_wait_seconds", "histogram", "Time background jobs spend queued")
+metrics.describe("cursor_sessions_job_duration_seconds", "histogram", "Time background jobs spend running")
+metrics.describe("cursor_sessions_jobs", "gauge", "Background jobs currently queued or running")
+metrics.describe("cursor_sessions_sessions", "gauge", "Saved sessions per project")
+metrics.describe("cursor_sessions_store_bytes", "gauge", "Logical and stored snapshot size per project")
+metrics.describe("cursor_sessions_chunk_store_bytes", "gauge", "On-disk size of the deduplicated chunk store")
+
+class RequestMetricsMiddleware:
+    """记录每个请求的耗时（按路由模板聚合），按需附加 Server-Timing 响应头"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
         
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+        start = time.perf_counter()
+        timings = []
+        token = REQUEST_TIMINGS.set(timings)
+        wants_timing = SERVER_TIMING or (b'x-server-timing', b'1') in scope['headers']
+        status = 500
         
-        all_data = {}
-        for table_name in [t[0] for t in tables]:
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if wants_timing:
+                    message['headers'] = list(message.get('headers', [])) + [
+                        (b'server-timing', server_timing_header(timings, time.perf_counter() - start).encode())]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUEST_TIMINGS.reset(token)
+            # 按路由模板（如 /api/sessions/{session_id}/restore）聚合，静态文件等未匹配路由的请求归为一类
+            route = scope.get('route')
+            path = route.path if route is not None else ("static" if not scope['path'].startswith('/api') else "unmatched")
+            metrics.inc("cursor_sessions_http_requests_total", method=scope['method'], route=path, status=str(status))
+            metrics.observe("cursor_sessions_http_request_duration_seconds", time.perf_counter() - start,
+                            method=scope['method'], route=path)
+
+def server_timing_header(timings: list, total: float) -> str:
+    # 同名阶段（如批量操作中的多次删除）合并耗时
+    merged = OrderedDict()
+    for name, elapsed in timings:
+        merged[name] = merged.get(name, 0) + elapsed
+    merged['total'] = total
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in merged.items())
+
+app.add_middleware(RequestMetricsMiddleware)
+
+# 后台任务
+class Job:
+    """一次后台操作：记录状态、进度和结果，version 每次变化递增供 SSE 推送"""
+    
+    def __init__(self, kind: str, project: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.project = project
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = "排队中"
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+        self.future = Future()
+        # 提交时的上下文：在请求中提交的任务，其阶段耗时也计入该请求的 Server-Timing
+        self.context = contextvars.copy_context()
+        self.queued_at = time.perf_counter()
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+    
+    def update(self, progress: Optional[float] = None, message: Optional[str] = None):
+        if progress is not None:
+            self.progress = round(progress, 3)
+        if message is not None:
+            self.message = message
+        self.version += 1
+    
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "project": self.project,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "status_code": self.status_code,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class JobManager:
+    """有界线程池上的任务调度：同一项目（lane）同时只执行一个任务，其余按顺序排队"""
+    
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.jobs = OrderedDict()
+        self.lanes = {}  # 项目 -> 等待中的任务；键存在表示该项目有任务正在执行
+        self.barrier = None  # 等待中或执行中的独占任务
+        self.held = deque()  # 独占任务之后提交的任务，它完成后再按顺序安排
+        self.lock = threading.Lock()
+        self.closed = False
+    
+    def submit(self, kind: str, project: str, func, *args, exclusive: bool = False) -> Job:
+        """提交任务，func 以 func(*args, job=job) 调用，可通过 job.update() 报告进度
+
+        exclusive 为真时作为屏障：等所有项目正在执行和排队的任务完成后单独执行，之后提交的任务等它完成再开始
+        """
+        job = Job(kind, project)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+            start = self._schedule((job, func, args, exclusive))
+        for entry in start:
+            self.executor.submit(self._run, *entry)
+        return job
+    
+    def submit_after(self, jobs: List[Job], kind: str, project: str, func, *args) -> Job:
+        """jobs 全部结束（成功或失败）后再安排任务，立即返回任务；func 可从 jobs 的 result 读取它们的结果"""
+        job = Job(kind, project)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        pending = [len(jobs)]
+        
+        def release(_=None):
+            with self.lock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+                start = [] if self.closed else self._schedule((job, func, args, False))
+                closed = self.closed
+            if closed:
+                job.status, job.error, job.status_code = "failed", "服务已停止", 503
+                job.finished_at = datetime.now().isoformat()
+                job.update(message=job.error)
+                job.future.set_result(job)
+            for entry in start:
+                self.executor.submit(self._run, *entry)
+        
+        if not jobs:
+            pending[0] = 1
+            release()
+        for dependency in jobs:
+            dependency.future.add_done_callback(release)
+        return job
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def list(self) -> List[Job]:
+        with self.lock:
+            return list(reversed(self.jobs.values()))
+    
+    def shutdown(self):
+        """等待正在执行的任务完成，排队中的任务不再启动"""
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=True)
+    
+    def _prune(self):
+        # 只淘汰已结束的旧任务
+        excess = len(self.jobs) - JOB_HISTORY
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished][:max(excess, 0)]:
+            del self.jobs[job_id]
+    
+    def _schedule(self, entry) -> list:
+        """安排一个任务（调用方持有锁），返回可以立即启动的 (job, func, args)"""
+        job, func, args, exclusive = entry
+        if self.barrier is not None:
+            self.held.append(entry)
+            return []
+        if exclusive:
+            self.barrier = entry
+            return self._advance_barrier(None)
+        if job.project in self.lanes:
+            self.lanes[job.project].append((job, func, args))
+            return []
+        self.lanes[job.project] = deque()
+        return [(job, func, args)]
+    
+    def _advance_barrier(self, finished: Optional[Job]) -> list:
+        """所有项目的任务都已完成时启动独占任务；独占任务完成后放行之后提交的任务（调用方持有锁）"""
+        if self.barrier is None or self.lanes:
+            return []
+        job, func, args, _ = self.barrier
+        if finished is not job:
+            self.lanes[job.project] = deque()
+            return [(job, func, args)]
+        self.barrier = None
+        start = []
+        # 遇到下一个独占任务时停止，其余继续等待
+        while self.held and self.barrier is None:
+            start += self._schedule(self.held.popleft())
+        return start
+    
+    def _run(self, job: Job, func, args):
+        job.status = "running"
+        job.started_at = datetime.now().isoformat()
+        job.update(message="执行中")
+        started = time.perf_counter()
+        metrics.observe("cursor_sessions_job_wait_seconds", started - job.queued_at, kind=job.kind)
+        try:
+            job.result = job.context.run(func, *args, job=job)
+            job.status = "succeeded"
+            job.update(progress=1.0, message=(job.result or {}).get("message", "完成"))
+        except HTTPException as e:
+            job.status, job.error, job.status_code = "failed", e.detail, e.status_code
+        except Exception as e:
+            job.status, job.error, job.status_code = "failed", str(e), 500
+        job.finished_at = datetime.now().isoformat()
+        if job.status == "failed":
+            print(f"Job {job.id} ({job.kind}) failed: {job.error}")
+            job.update(message=job.error)
+        metrics.observe("cursor_sessions_job_duration_seconds", time.perf_counter() - started, kind=job.kind)
+        metrics.inc("cursor_sessions_jobs_total", kind=job.kind, status=job.status)
+        job.future.set_result(job)
+        
+        with self.lock:
+            queue = self.lanes[job.project]
+            if self.closed:
+                cancelled, next_job = list(queue), None
+                queue.clear()
+                cancelled += [entry[:3] for entry in self.held]
+                self.held.clear()
+                if self.barrier is not None and self.barrier[0] is not job and self.barrier[0].status == "queued":
+                    cancelled.append(self.barrier[:3])
+                    self.barrier = None
+            else:
+                cancelled, next_job = [], queue.popleft() if queue else None
+            if next_job is None:
+                del self.lanes[job.project]
+            start = [next_job] if next_job else []
+            if not self.closed:
+                start += self._advance_barrier(job)
+        for pending_job, _, _ in cancelled:
+            pending_job.status, pending_job.error, pending_job.status_code = "failed", "服务已停止", 503
+            pending_job.finished_at = datetime.now().isoformat()
+            pending_job.update(message=pending_job.error)
+            pending_job.future.set_result(pending_job)
+        for entry in start:
+            self.executor.submit(self._run, *entry)
+
+job_manager = JobManager(JOB_WORKERS)
+
+async def job_response(job: Job, wait: bool):
+    """wait 为真时等待任务完成并按原接口返回结果，否则立即返回 202 和任务 ID"""
+    if not wait:
+        return JSONResponse(status_code=202, content={
+            "status": "queued",
+            "job_id": job.id,
+            "job": job.to_dict()
+        })
+    await asyncio.wrap_future(job.future)
+    if job.status == "failed":
+        raise HTTPException(status_code=job.status_code, detail=job.error)
+    return job.result
+
+class EventHub:
+    """/api/events 的共享事件源：事件只产生和序列化一次，再分发给所有订阅者
+
+    后台线程通过 publish() 推送保存、删除、清理等事件；run() 在事件循环中统一检查任务进度和系统状态，
+    订阅者再多也只有这一个生产者。每个订阅者一个有界队列，消费过慢时断开，由 EventSource 自动重连
+    """
+    
+    def __init__(self):
+        self.subscribers = set()
+        self.loop = None
+        self.next_id = 0
+        self.job_versions = {}
+        self.last_status = None
+        self.task = None
+    
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+    
+    def format(self, event: str, data) -> str:
+        self.next_id += 1
+        return f"id: {self.next_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    def publish(self, event: str, data):
+        """推送事件（可在任意线程调用，没有订阅者时直接忽略）"""
+        loop = self.loop
+        if loop is None or not self.subscribers:
+            return
+        try:
+            loop.call_soon_threadsafe(self._dispatch, event, data)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+    
+    def _dispatch(self, event: str, data):
+        message = self.format(event, data)
+        for queue in list(self.subscribers):
             try:
-                cursor.execute(f"SELECT * FROM {table_name}")
-                rows = cursor.fetchall()
-                column_names = [description[0] for description in cursor.description]
-                all_data[table_name] = [dict(zip(column_names, row)) for row in rows]
-            except sqlite3.Error:
-                pass
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 丢弃积压的事件并通知连接关闭，重连后会重新收到状态快照
+                self.subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+    
+    async def run(self):
+        """唯一的轮询者：推送任务进度变化，并在有订阅者时定期检查系统状态"""
+        self.loop = asyncio.get_running_loop()
+        next_status_check = 0.0
+        while True:
+            await asyncio.sleep(EVENTS_JOB_INTERVAL)
+            jobs = job_manager.list()
+            for job in jobs:
+                if self.job_versions.get(job.id) != job.version:
+                    self.job_versions[job.id] = job.version
+                    if self.subscribers:
+                        self._dispatch("job", job.to_dict())
+            if len(self.job_versions) > len(jobs):
+                current = {job.id for job in jobs}
+                self.job_versions = {job_id: v for job_id, v in self.job_versions.items() if job_id in current}
+            
+            if not self.subscribers:
+                self.last_status = None
+                continue
+            if time.monotonic() < next_status_check:
+                continue
+            next_status_check = time.monotonic() + EVENTS_STATUS_INTERVAL
+            try:
+                status = await run_in_threadpool(collect_status)
+            except Exception as e:
+                print(f"Error collecting status: {e}")
+                continue
+            if status != self.last_status:
+                self.last_status = status
+                self._dispatch("status", status)
+
+event_hub = EventHub()
+
+class SnapshotReaders:
+    """已打开的只读快照（LRU）：尚未提取到消息存储的快照直接从快照读取对话，翻页时复用连接
+
+    完整 .db 快照以 immutable 只读 URI 原地打开，不复制。分块和增量快照没有可直接打开的文件：
+    Python 的 sqlite3 不能注册自定义 VFS，无法让 SQLite 直接按页读取块存储，
+    所以仍要先完整拼装为临时数据库（每个条目只拼装一次，淘汰时删除），这是打开这类快照的主要开销。
+    临时数据库总大小超过 max_mb 时，按 LRU 淘汰拼装过的条目（刚打开的条目保留）。
+    打开时只建立对话的消息 blob ID 顺序（不解码消息），每页只读取和解码当前页的 blob
+    """
+    
+    def __init__(self, capacity: int, max_mb: float):
+        self.capacity = max(capacity, 1)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.entries = OrderedDict()  # (项目目录, 元数据文件名) -> 条目
+        self.lock = threading.Lock()
+        self.temp_dir = None
+    
+    def page(self, meta: dict, offset: int, limit: int) -> dict:
+        """读取快照对话的一页（与 read_snapshot_messages 的格式相同）"""
+        key = (meta['project_dir'].name, meta['meta_file'].name)
+        signature = snapshot_signature(meta)
+        while True:
+            entry = self._get(meta, key, signature)
+            with entry['lock']:
+                # 取到条目后它可能已被淘汰并关闭，重新获取
+                if entry['closed']:
+                    continue
+                blob_ids = entry['order'][offset:offset + limit]
+                unique_ids = list(dict.fromkeys(blob_ids))
+                rows = dict(entry['conn'].execute(
+                    f"SELECT id, data FROM blobs WHERE id IN ({', '.join('?' * len(unique_ids))})", unique_ids
+                )) if unique_ids else {}
+                total = len(entry['order'])
+            break
         
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(all_data, f, indent=2, ensure_ascii=False, default=str)
+        messages = []
+        for seq, blob_id in enumerate(blob_ids, offset):
+            message = decode_message(rows.get(blob_id))
+            if message:
+                messages.append(dict(message, seq=seq))
+        return {
+            "session_id": meta['timestamp'],
+            "source": "snapshot",
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "messages": messages
+        }
+    
+    def close(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        for entry in entries:
+            self._close(entry)
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+    
+    def _get(self, meta: dict, key: tuple, signature: str) -> dict:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['signature'] == signature:
+                self.entries.move_to_end(key)
+                metrics.inc("cursor_sessions_message_readers_total", result="hit")
+                return entry
         
-        conn.close()
-        return True
-    except Exception as e:
-        print(f"Export error: {e}")
-        return False
+        # 打开和遍历对话树在锁外进行，不阻塞其他快照的翻页
+        metrics.inc("cursor_sessions_message_readers_total", result="open")
+        entry = self._open(meta, signature)
+        with self.lock:
+            evicted = [old for old in [self.entries.pop(key, None)] if old]
+            self.entries[key] = entry
+            while len(self.entries) > self.capacity:
+                evicted.append(self.entries.popitem(last=False)[1])
+            staged_size = sum(e['staged_size'] for e in self.entries.values())
+            for old_key in list(self.entries):
+                if staged_size <= self.max_bytes or old_key == key:
+                    break
+                if self.entries[old_key]['staged_size']:
+                    old = self.entries.pop(old_key)
+                    staged_size -= old['staged_size']
+                    evicted.append(old)
+        for old in evicted:
+            self._close(old)
+        return entry
+    
+    def _open(self, meta: dict, signature: str) -> dict:
+        db_path = meta['project_dir'] / meta['db_file']
+        staged_db = None
+        if meta.get('storage') == 'chunked':
+            with self.lock:
+                if self.temp_dir is None:
+                    self.temp_dir = Path(tempfile.mkdtemp(prefix="cursor-preview-"))
+            staged_db = db_path = self.temp_dir / f"{uuid.uuid4().hex}.db"
+        conn = None
+        try:
+            if staged_db:
+                materialize_snapshot(meta, staged_db)
+            # immutable：快照文件不会再变化，SQLite 不加锁也不检查修改
+            conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro&immutable=1", uri=True,
+                                   check_same_thread=False)
+            order = conversation_blob_ids(conn)
+        except BaseException:
+            if conn:
+                conn.close()
+            if staged_db:
+                discard_staged(staged_db)
+            raise
+        return {'signature': signature, 'conn': conn, 'order': order, 'staged_db': staged_db,
+                'staged_size': staged_db.stat().st_size if staged_db else 0,
+                'lock': threading.Lock(), 'closed': False}
+    
+    def _close(self, entry: dict):
+        with entry['lock']:
+            entry['closed'] = True
+            entry['conn'].close()
+        if entry['staged_db']:
+            discard_staged(entry['staged_db'])
+
+message_readers = SnapshotReaders(MESSAGE_READERS, MESSAGE_READERS_MAX_MB)
+
+search_index_job = None
+
+def schedule_search_index() -> Job:
+    """在后台同步搜索索引；已有排队中的同步任务时不重复提交"""
+    global search_index_job
+    job = search_index_job
+    if job is None or job.status != "queued":
+        job = job_manager.submit("search-index", ".search", sync_search_index)
+        search_index_job = job
+    return job
+
+def render_snippet(snippet: str) -> str:
+    """转义片段中的 HTML，再将高亮标记替换为 <mark>"""
+    return (html.escape(snippet)
+            .replace(SEARCH_MARK_START, '<mark>')
+            .replace(SEARCH_MARK_END, '</mark>'))
 
 # API 端点
 @app.get("/api")
@@ -134,379 +918,556 @@ async def root():
     }
 
 @app.get("/api/sessions", response_model=List[SessionInfo])
-async def list_sessions(project: Optional[str] = None):
-    """获取所有保存的会话"""
-    all_sessions = []
+async def list_sessions(request: Request, project: Optional[str] = None, auto_saved: Optional[bool] = None,
+                        since: Optional[str] = None, until: Optional[str] = None, q: Optional[str] = None,
+                        sort: str = 'datetime', order: str = 'desc', cursor: Optional[str] = None,
+                        limit: int = SESSIONS_PAGE_SIZE):
+    """分页获取保存的会话（支持按项目、自动保存、日期范围、名称/描述过滤和排序）
+
+    过滤后的总数和下一页游标分别在 X-Total-Count / X-Next-Cursor 响应头中；
+    列表未变化时对 If-None-Match 返回 304，不查询会话也不序列化
+    """
+    if sort not in SESSION_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"不支持的排序字段: {sort}")
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail=f"不支持的排序方向: {order}")
+    limit = min(max(limit, 1), SESSIONS_MAX_PAGE_SIZE)
+    filters = {
+        'project': project,
+        'auto_saved': auto_saved,
+        'since': parse_date_bound(since) if since else None,
+        'until': parse_date_bound(until, end=True) if until else None,
+        'until_exclusive': bool(until) and len(until) == 10,
+        'q': q.strip() if q and q.strip() else None
+    }
+    after = decode_cursor(cursor) if cursor else None
     
-    for project_dir in SESSIONS_DIR.iterdir():
-        if not project_dir.is_dir():
-            continue
-        
-        if project and project_dir.name != project:
-            continue
-        
-        for meta_file in project_dir.glob("*.meta.json"):
-            try:
-                with open(meta_file, 'r', encoding='utf-8') as f:
-                    meta = json.load(f)
-                    session = SessionInfo(
-                        id=meta['timestamp'],
-                        name=meta['name'],
-                        description=meta['description'],
-                        project=meta['project'],
-                        datetime=meta['datetime'],
-                        size_kb=meta['size_kb'],
-                        db_file=str(project_dir / meta['db_file'])
-                    )
-                    all_sessions.append(session)
-            except Exception as e:
-                print(f"Error reading {meta_file}: {e}")
+    # 同步索引需要访问磁盘，放到线程池中执行
+    with metrics.phase("list", "sync"):
+        generation = await run_in_threadpool(catalog_generation)
+    etag = catalog_etag(generation, "sessions", filters, sort, order, after, limit)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    with metrics.phase("list", "query"):
+        total, rows, next_after = await run_in_threadpool(
+            query_session_page, filters, sort, order == 'desc', after, limit
+        )
+    with metrics.phase("list", "serialize"):
+        response = sessions_page_response(rows, total, next_after, headers)
+    return response
+
+def sessions_page_response(rows: list, total: int, next_after: Optional[list], headers: dict) -> JSONResponse:
+    sessions = [{
+        "id": row['id'],
+        "name": row['name'],
+        "description": row['description'],
+        "project": row['project'],
+        "datetime": row['datetime'],
+        "size_kb": row['size_kb'],
+        "stored_kb": row['stored_kb'],
+        "codec": row['codec'],
+        "db_file": str(SESSIONS_DIR / row['project_dir'] / (row['db_file'] or '')),
+        "json_file": row['json_file']
+    } for row in rows]
     
-    # 按时间倒序排列
-    all_sessions.sort(key=lambda x: x.datetime, reverse=True)
-    return all_sessions
+    headers["X-Total-Count"] = str(total)
+    if next_after:
+        headers["X-Next-Cursor"] = encode_cursor(next_after)
+    return JSONResponse(sessions, headers=headers)
 
 @app.post("/api/sessions/auto-save")
-async def auto_save_session(max_keep: int = 3):
-    """自动保存当前会话"""
-    current_db, hash_folder = find_current_session_db()
+async def auto_save_session(wait: bool = False):
+    """自动保存当前会话（后台任务，wait=true 时等待完成；旧的自动保存由保留策略定期清理）"""
+    with metrics.phase("auto_save", "discover"):
+        current_db, hash_folder = find_current_session_db()
     
     if not current_db or not current_db.exists():
         raise HTTPException(status_code=404, detail="未找到当前会话数据库")
     
     project_name = get_current_project()
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # 智能检测会话是否有变化（避免重复保存）
-    project_sessions_dir = SESSIONS_DIR / project_name
-    project_sessions_dir.mkdir(exist_ok=True)
-    
-    recent_sessions = sorted(project_sessions_dir.glob("*.meta.json"), 
-                            key=lambda x: x.stat().st_mtime, reverse=True)
-    
-    if recent_sessions:
-        latest_meta = recent_sessions[0]
-        try:
-            with open(latest_meta, 'r', encoding='utf-8') as f:
-                latest_data = json.load(f)
-            
-            current_size = current_db.stat().st_size / 1024
-            size_diff = abs(current_size - latest_data.get('size_kb', 0))
-            
-            # 检查会话是否真正有变化
-            # 1. 大小差异小于 1KB 表示可能无变化
-            # 2. 读取数据库内容进行更精确的对比
-            if size_diff < 1:
-                # 读取数据库内容进行对比
-                latest_db_path = project_sessions_dir / latest_data['db_file']
-                if latest_db_path.exists():
-                    try:
-                        # 对比数据库文件的 MD5 或内容
-                        import hashlib
-                        
-                        def get_db_hash(db_path):
-                            with open(db_path, 'rb') as f:
-                                return hashlib.md5(f.read()).hexdigest()
-                        
-                        current_hash = get_db_hash(current_db)
-                        latest_hash = get_db_hash(latest_db_path)
-                        
-                        if current_hash == latest_hash:
-                            return {
-                                "status": "skipped",
-                                "message": "会话内容无变化，跳过保存",
-                                "session_id": latest_data['timestamp']
-                            }
-                    except:
-                        # 如果对比失败，继续保存
-                        pass
-        except:
-            pass
-    
-    # 生成自动保存的会话名称（包含项目名称）
-    # 将项目名中的连字符和下划线替换为空格，使其更易读
-    readable_project = project_name.replace('-', ' ').replace('_', ' ').replace('home neo upload', '').strip()
-    session_name = f"{readable_project} - {datetime.now().strftime('%m月%d日 %H:%M')}"
-    description = f"自动保存于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    
-    # 创建安全的文件名
-    base_name = f"{timestamp}_自动保存"
-    
-    # 创建项目目录
-    project_sessions_dir.mkdir(exist_ok=True)
-    
-    # 保存数据库
-    backup_file = project_sessions_dir / f"{base_name}.db"
-    shutil.copy2(current_db, backup_file)
-    
-    # 导出 JSON
-    json_file = project_sessions_dir / f"{base_name}.json"
-    export_db_to_json(current_db, json_file)
-    
-    # 保存元数据
-    metadata = {
-        'name': session_name,
-        'description': description,
-        'timestamp': timestamp,
-        'datetime': datetime.now().isoformat(),
-        'project': project_name,
-        'hash_folder': hash_folder,
-        'db_file': backup_file.name,
-        'json_file': json_file.name,
-        'size_kb': current_db.stat().st_size / 1024,
-        'original_path': str(current_db),
-        'auto_saved': True
-    }
+    job = job_manager.submit("auto-save", project_name, perform_auto_save,
+                             current_db, hash_folder, project_name,
+                             auto_save_watcher.config['delta'])
+    return await job_response(job, wait)
+
+def perform_auto_save(current_db: Path, hash_folder: str, project_name: str,
+                      delta: bool = False, job: Optional[Job] = None):
+    """自动保存指定的会话数据库（在项目任务队列中执行，供 API 与后台监听共用）"""
+    result = auto_save_snapshot(current_db, hash_folder, project_name, delta, job=job)
+    if result['status'] == "success":
+        event_hub.publish("session_saved", {"session_id": result['session_id'], "name": result['name'],
+                                            "project": project_name, "auto_saved": True})
+        schedule_search_index()
+    return result
+
+@app.post("/api/sessions/snapshot-all")
+async def snapshot_all_sessions(window_seconds: float = SNAPSHOT_ALL_WINDOW_SECONDS):
+    """保存最近 window_seconds 内有写入的所有会话数据库（内容无变化的跳过）
+
+    每个数据库一个任务，提交到所属项目的任务队列：不同项目在有界线程池（JOB_WORKERS）上并行，
+    同一项目依次执行；全部完成后按项目和聊天目录返回汇总结果
+    """
+    if window_seconds <= 0:
+        raise HTTPException(status_code=400, detail="window_seconds 必须大于 0")
+    with metrics.phase("snapshot_all", "discover"):
+        targets = await run_in_threadpool(discover_active_chat_dbs, window_seconds)
+    if not targets:
+        raise HTTPException(status_code=404, detail=f"最近 {window_seconds:g} 秒内没有活跃的会话数据库")
     
-    meta_file = project_sessions_dir / f"{base_name}.meta.json"
-    with open(meta_file, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    delta = auto_save_watcher.config['delta']
+    jobs = [job_manager.submit("snapshot", project, perform_auto_save,
+                               db_path, db_path.parent.parent.name, project, delta)
+            for db_path, project in targets]
+    await asyncio.gather(*(asyncio.wrap_future(job.future) for job in jobs))
     
-    # 清理旧的自动保存（只保留最近的 max_keep 个）
-    cleanup_old_auto_saves(project_sessions_dir, max_keep)
+    projects = {}
+    counts = Counter()
+    for (db_path, project), job in zip(targets, jobs):
+        if job.status == "failed":
+            entry = {"status": "failed", "error": job.error}
+        else:
+            entry = {"status": "saved" if job.result['status'] == "success" else "skipped",
+                     "session_id": job.result['session_id']}
+        counts[entry['status']] += 1
+        entry.update(db=str(db_path), job_id=job.id)
+        projects.setdefault(project, {}).setdefault(db_path.parent.parent.name, []).append(entry)
     
     return {
-        "status": "success",
-        "message": "自动保存成功",
-        "session_id": timestamp,
-        "name": session_name
+        "status": "success" if not counts['failed'] else "partial",
+        "message": f"已保存 {counts['saved']} 个会话，{counts['skipped']} 个无变化"
+                   + (f"，{counts['failed']} 个失败" if counts['failed'] else ""),
+        "discovered": len(targets),
+        "saved": counts['saved'],
+        "skipped": counts['skipped'],
+        "failed": counts['failed'],
+        "projects": projects
     }
 
-def cleanup_old_auto_saves(project_dir: Path, max_keep: int):
-    """清理旧的自动保存，只保留最近的 max_keep 个
-    
-    Args:
-        project_dir: 项目会话目录
-        max_keep: 保留的自动保存数量
-    """
-    try:
-        # 获取所有自动保存的会话
-        auto_save_sessions = []
-        for meta_file in project_dir.glob("*.meta.json"):
-            try:
-                with open(meta_file, 'r', encoding='utf-8') as f:
-                    metadata = json.load(f)
-                    # 只处理自动保存的会话
-                    if metadata.get('auto_saved', False):
-                        auto_save_sessions.append({
-                            'meta_file': meta_file,
-                            'metadata': metadata,
-                            'mtime': meta_file.stat().st_mtime
-                        })
-            except:
-                continue
-        
-        # 按时间倒序排列
-        auto_save_sessions.sort(key=lambda x: x['mtime'], reverse=True)
-        
-        # 删除超出数量的旧会话
-        if len(auto_save_sessions) > max_keep:
-            for session in auto_save_sessions[max_keep:]:
-                try:
-                    # 删除 meta.json
-                    session['meta_file'].unlink()
-                    
-                    # 删除 .db 文件
-                    db_file = project_dir / session['metadata']['db_file']
-                    if db_file.exists():
-                        db_file.unlink()
-                    
-                    # 删除 .json 文件
-                    json_file = project_dir / session['metadata']['json_file']
-                    if json_file.exists():
-                        json_file.unlink()
-                    
-                    print(f"已清理旧会话: {session['metadata']['name']}")
-                except Exception as e:
-                    print(f"清理会话失败: {e}")
-    except Exception as e:
-        print(f"清理旧会话时出错: {e}")
-
 @app.post("/api/sessions/save")
-async def save_session(session_save: SessionSave):
-    """手动保存当前会话"""
-    current_db, hash_folder = find_current_session_db()
+async def save_session(session_save: SessionSave, wait: bool = False):
+    """手动保存当前会话（后台任务，wait=true 时等待完成）"""
+    with metrics.phase("save", "discover"):
+        current_db, hash_folder = find_current_session_db()
     
     if not current_db or not current_db.exists():
         raise HTTPException(status_code=404, detail="未找到当前会话数据库")
     
     project_name = get_current_project()
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # 创建安全的文件名
-    safe_name = "".join(c for c in session_save.name if c.isalnum() or c in (' ', '-', '_', '中', '文')).strip()
-    safe_name = safe_name.replace(' ', '_')[:50]
-    base_name = f"{timestamp}_{safe_name}"
-    
-    # 创建项目目录
-    project_sessions_dir = SESSIONS_DIR / project_name
-    project_sessions_dir.mkdir(exist_ok=True)
-    
-    # 保存数据库
-    backup_file = project_sessions_dir / f"{base_name}.db"
-    shutil.copy2(current_db, backup_file)
-    
-    # 导出 JSON
-    json_file = project_sessions_dir / f"{base_name}.json"
-    export_db_to_json(current_db, json_file)
-    
-    # 保存元数据
-    metadata = {
-        'name': session_save.name,
-        'description': session_save.description,
-        'timestamp': timestamp,
-        'datetime': datetime.now().isoformat(),
-        'project': project_name,
-        'hash_folder': hash_folder,
-        'db_file': backup_file.name,
-        'json_file': json_file.name,
-        'size_kb': current_db.stat().st_size / 1024,
-        'original_path': str(current_db),
-        'auto_saved': False
-    }
-    
-    meta_file = project_sessions_dir / f"{base_name}.meta.json"
-    with open(meta_file, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
-    
-    return {
-        "status": "success",
-        "message": "会话保存成功",
-        "session_id": timestamp,
-        "name": session_save.name
-    }
+    job = job_manager.submit("save", project_name, perform_save, current_db, hash_folder,
+                             project_name, session_save.name, session_save.description)
+    return await job_response(job, wait)
+
+def perform_save(current_db: Path, hash_folder: str, project_name: str, name: str, description: str,
+                 job: Optional[Job] = None):
+    """保存指定的会话数据库（在项目任务队列中执行）"""
+    result = save_snapshot(current_db, hash_folder, project_name, name, description, job=job)
+    event_hub.publish("session_saved", {"session_id": result['session_id'], "name": name,
+                                        "project": project_name, "auto_saved": False})
+    schedule_search_index()
+    return result
 
 @app.post("/api/sessions/{session_id}/restore")
-async def restore_session(session_id: str):
-    """恢复指定的会话"""
-    # 查找会话
+async def restore_session(session_id: str, wait: bool = False):
+    """恢复指定的会话（后台任务，wait=true 时等待完成）"""
+    # 通过索引查找会话
     session_meta = None
     session_file = None
     
-    for project_dir in SESSIONS_DIR.iterdir():
-        if not project_dir.is_dir():
-            continue
-        
-        for meta_file in project_dir.glob(f"{session_id}_*.meta.json"):
-            try:
-                with open(meta_file, 'r', encoding='utf-8') as f:
-                    session_meta = json.load(f)
-                    session_file = project_dir / session_meta['db_file']
-                    break
-            except:
-                continue
-        
-        if session_meta:
-            break
+    matches = await run_in_threadpool(query_sessions, session_id=session_id, limit=1)
+    if matches:
+        session_meta = matches[0]
+        session_file = session_meta['project_dir'] / session_meta['db_file']
     
     if not session_meta or not session_file.exists():
         raise HTTPException(status_code=404, detail="会话不存在")
     
     # 查找当前数据库
-    current_db, _ = find_current_session_db()
+    with metrics.phase("restore", "discover"):
+        current_db, _ = find_current_session_db()
     if not current_db:
         raise HTTPException(status_code=404, detail="未找到当前会话数据库")
     
-    # 先备份当前会话
-    backup_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    auto_backup_name = f"自动备份_{backup_timestamp}"
+    # 替换的是当前项目的数据库，因此在当前项目的队列中执行，与该项目的保存互斥
+    project_name = get_current_project()
+    job = job_manager.submit("restore", project_name, restore_into, session_meta, current_db, project_name)
+    return await job_response(job, wait)
+
+@app.get("/api/sessions/undo-restore")
+async def get_restore_undo():
+    """列出可撤销的恢复（最近的在前）；state 为 undone 表示已撤销，再次撤销即重新应用恢复"""
+    return await run_in_threadpool(restore_undo_records)
+
+@app.post("/api/sessions/undo-restore")
+async def undo_restore(db: Optional[str] = None, wait: bool = False):
+    """撤销最近一次恢复（或指定数据库的恢复）：与保留的恢复前数据库交换，不复制数据；再次调用即重新应用恢复"""
+    records = await run_in_threadpool(restore_undo_records, db)
+    if not records:
+        raise HTTPException(status_code=404, detail="没有可撤销的恢复")
+    record = records[0]
+    job = job_manager.submit("undo-restore", record['project'], perform_undo_restore, record['db'])
+    return await job_response(job, wait)
+
+def perform_undo_restore(db: str, job: Optional[Job] = None):
+    """交换当前数据库与撤销点（在项目任务队列中执行）"""
+    try:
+        return revert_restore(db)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/api/sessions/{session_id}/export")
+async def export_session(session_id: str, wait: bool = False):
+    """导出会话为 JSON（缓存有效时直接返回文件，否则提交导出任务并返回 202，完成后再次请求即可下载）"""
+    matches = await run_in_threadpool(query_sessions, session_id=session_id, limit=1)
+    if not matches or not (matches[0]['project_dir'] / matches[0]['db_file']).exists():
+        raise HTTPException(status_code=404, detail="会话不存在")
+    meta = matches[0]
     
-    await save_session(SessionSave(
-        name=auto_backup_name,
-        description="恢复会话前的自动备份"
-    ))
+    with metrics.phase("export", "cache_check"):
+        fresh = await run_in_threadpool(json_export_is_fresh, meta)
+    if not fresh:
+        job = job_manager.submit("export", meta['project_dir'].name, perform_export, meta)
+        response = await job_response(job, wait)
+        if not wait:
+            return response
     
-    # 恢复会话
+    json_file = meta['project_dir'] / meta['json_file']
+    return FileResponse(json_file, media_type="application/json", filename=json_file.name)
+
+def perform_export(meta: dict, job: Optional[Job] = None):
+    """生成 JSON 导出（在项目任务队列中执行）"""
+    if job:
+        job.update(progress=0.1, message="导出 JSON")
     try:
-        shutil.copy2(session_file, current_db)
-        
-        # 清理 WAL 和 SHM 文件
-        for ext in ['-wal', '-shm']:
-            extra = Path(str(current_db) + ext)
-            if extra.exists():
-                extra.unlink()
-        
-        return {
-            "status": "success",
-            "message": "会话恢复成功，请重启 Cursor",
-            "session_name": session_meta['name']
-        }
+        with metrics.phase("export", "json"):
+            json_file = ensure_json_export(meta)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"恢复失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"导出失败: {str(e)}")
+    metrics.inc("cursor_sessions_bytes_copied_total", json_file.stat().st_size, operation="export")
+    
+    return {
+        "status": "success",
+        "message": "导出完成",
+        "session_id": meta['timestamp'],
+        "json_file": json_file.name
+    }
+
+@app.get("/api/sessions/{session_id}/messages")
+async def get_session_messages(session_id: str, offset: int = 0, limit: int = MESSAGES_PAGE_SIZE):
+    """分页读取快照的对话消息（角色、时间、正文、token 数、附件）
+
+    消息在建立搜索索引时提取并去重存储，浏览时只读取当前页；尚未提取的快照直接只读打开快照按页读取，
+    不复制也不等待索引（source 字段标明来源）
+    """
+    matches = await run_in_threadpool(query_sessions, session_id=session_id, limit=1)
+    if not matches:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    meta = matches[0]
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), MESSAGES_MAX_PAGE_SIZE)
+    
+    with metrics.phase("messages", "query"):
+        page = await run_in_threadpool(read_snapshot_messages, meta, offset, limit)
+    if page is None:
+        if not (meta['project_dir'] / meta['db_file']).exists():
+            raise HTTPException(status_code=404, detail="快照文件不存在")
+        with metrics.phase("messages", "read"):
+            try:
+                page = await run_in_threadpool(message_readers.page, meta, offset, limit)
+            except sqlite3.DatabaseError as e:
+                raise HTTPException(status_code=500, detail=f"读取对话失败: {e}")
+        # 后台补建索引，之后的翻页直接走消息存储
+        schedule_search_index()
+    return page
+
+@app.get("/api/sessions/{session_id}/diff/{other_id}")
+async def diff_sessions(session_id: str, other_id: str, limit: int = DIFF_ROW_LIMIT, wait: bool = False):
+    """逐表比较两个快照（session_id 为旧版本，other_id 为新版本），返回新增、删除和修改的行（后台任务）"""
+    metas = []
+    for identifier in (session_id, other_id):
+        matches = await run_in_threadpool(query_sessions, session_id=identifier, limit=1)
+        if not matches or not (matches[0]['project_dir'] / matches[0]['db_file']).exists():
+            raise HTTPException(status_code=404, detail=f"会话不存在: {identifier}")
+        metas.append(matches[0])
+    
+    job = job_manager.submit("diff", metas[0]['project_dir'].name, diff_snapshots,
+                             metas[0], metas[1], min(max(limit, 0), 1000))
+    return await job_response(job, wait)
 
 @app.put("/api/sessions/{session_id}/rename")
 async def rename_session(session_id: str, rename_data: SessionRename):
     """重命名会话"""
-    # 查找会话元数据文件
-    meta_file_path = None
-    
-    for project_dir in SESSIONS_DIR.iterdir():
-        if not project_dir.is_dir():
-            continue
-        
-        for meta_file in project_dir.glob(f"{session_id}_*.meta.json"):
-            meta_file_path = meta_file
-            break
-        
-        if meta_file_path:
-            break
+    # 通过索引查找会话元数据文件
+    matches = await run_in_threadpool(query_sessions, session_id=session_id, limit=1)
+    meta_file_path = matches[0]['meta_file'] if matches else None
     
     if not meta_file_path:
         raise HTTPException(status_code=404, detail="会话不存在")
     
+    # 与同一项目的清理、保存任务串行，避免改写已被删除的会话
+    job = job_manager.submit("rename", matches[0]['project_dir'].name, perform_rename,
+                             meta_file_path, rename_data.new_name, rename_data.new_description)
+    return await job_response(job, wait=True)
+
+def perform_rename(meta_file_path: Path, new_name: str, new_description: Optional[str],
+                   job: Optional[Job] = None):
+    """改写会话名称和描述（在项目任务队列中执行）"""
     # 读取并更新元数据
     try:
         with open(meta_file_path, 'r', encoding='utf-8') as f:
             metadata = json.load(f)
         
-        metadata['name'] = rename_data.new_name
-        if rename_data.new_description:
-            metadata['description'] = rename_data.new_description
+        metadata['name'] = new_name
+        if new_description:
+            metadata['description'] = new_description
         
-        with open(meta_file_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        # 原地改写不会改变目录 mtime，因此需要显式更新索引
+        write_metadata(meta_file_path, metadata)
         
         return {
             "status": "success",
             "message": "会话已重命名",
-            "new_name": rename_data.new_name
+            "new_name": new_name
         }
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="会话不存在")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"重命名失败: {str(e)}")
 
 @app.delete("/api/sessions/{session_id}")
 async def delete_session(session_id: str):
     """删除会话"""
-    deleted = False
+    matches = await run_in_threadpool(query_sessions, session_id=session_id)
+    if not matches:
+        raise HTTPException(status_code=404, detail="会话不存在")
     
-    for project_dir in SESSIONS_DIR.iterdir():
-        if not project_dir.is_dir():
-            continue
-        
-        for file_pattern in [f"{session_id}_*.db", f"{session_id}_*.json", f"{session_id}_*.meta.json"]:
-            for file_path in project_dir.glob(file_pattern):
-                try:
-                    file_path.unlink()
-                    deleted = True
-                except Exception as e:
-                    print(f"Error deleting {file_path}: {e}")
+    # 与同一项目的自动保存清理串行，避免重复释放分块引用
+    jobs = [job_manager.submit("delete", meta['project_dir'].name, perform_delete, meta) for meta in matches]
+    results = [await job_response(job, wait=True) for job in jobs]
     
-    if not deleted:
+    if not any(result['deleted'] for result in results):
         raise HTTPException(status_code=404, detail="会话不存在")
     
     return {"status": "success", "message": "会话已删除"}
 
-@app.get("/api/status")
-async def get_status():
-    """获取系统状态"""
+def perform_delete(meta: dict, job: Optional[Job] = None):
+    """删除会话文件（在项目任务队列中执行）"""
+    # 排队期间可能已被自动保存清理
+    if not meta['meta_file'].exists():
+        return {"status": "skipped", "message": "会话已不存在", "deleted": False}
+    
+    # 通过元数据删除，分块快照需要释放引用而不是直接删除清单
+    try:
+        with metrics.phase("delete", "remove"):
+            remove_session_files(meta)
+    except Exception as e:
+        print(f"Error deleting {meta['meta_file']}: {e}")
+        return {"status": "error", "message": f"删除失败: {str(e)}", "deleted": False}
+    
+    event_hub.publish("session_deleted", {"session_id": meta['timestamp'], "project": meta['project_dir'].name})
+    return {"status": "success", "message": "会话已删除", "deleted": True}
+
+def resolve_selection(selection: BulkSelection):
+    """一次索引查询解析批量操作选中的会话，返回 (会话列表, 未找到的 ID)"""
+    metas = query_sessions(
+        project_dir=selection.project,
+        session_ids=selection.ids,
+        before=parse_date_bound(selection.before) if selection.before else None,
+        auto_saved=selection.auto_saved
+    )
+    found = {meta['timestamp'] for meta in metas}
+    missing = sorted(set(selection.ids or []) - found)
+    return metas, missing
+
+@app.post("/api/sessions/bulk-delete")
+async def bulk_delete_sessions(selection: BulkSelection):
+    """批量删除会话：各项目在自己的任务队列中并行删除，返回汇总结果"""
+    if not (selection.ids or selection.project or selection.before or selection.auto_saved is not None):
+        raise HTTPException(status_code=400, detail="请至少指定一个选择条件")
+    if selection.before:
+        parse_date_bound(selection.before)
+    metas, missing = await run_in_threadpool(resolve_selection, selection)
+    
+    by_project = {}
+    for meta in metas:
+        by_project.setdefault(meta['project_dir'].name, []).append(meta)
+    jobs = [job_manager.submit("bulk-delete", project, perform_bulk_delete, project_metas)
+            for project, project_metas in by_project.items()]
+    results = await asyncio.gather(*(job_response(job, wait=True) for job in jobs))
+    
+    deleted = [session_id for result in results for session_id in result['deleted']]
+    failed = [item for result in results for item in result['failed']]
+    return {
+        "status": "success" if not failed else "partial",
+        "message": f"已删除 {len(deleted)} 个会话",
+        "matched": len(metas),
+        "deleted": deleted,
+        "failed": failed,
+        "missing": missing,
+        "freed_kb": round(sum(result['freed_kb'] for result in results), 1),
+        "projects": {project: len(result['deleted']) for project, result in zip(by_project, results)}
+    }
+
+def perform_bulk_delete(metas: List[dict], event: str = "sessions_deleted", job: Optional[Job] = None):
+    """删除同一项目的多个会话（在项目任务队列中执行，保留策略的清理也使用它）
+
+    按时间从新到旧删除：整条增量快照链一起删除时，后继快照已先删除，不会为即将删除的快照重建关键帧
+    """
+    deleted, failed = [], []
+    freed_kb = 0.0
+    for index, meta in enumerate(metas):
+        if job:
+            job.update(progress=index / len(metas), message=f"删除会话 {index + 1}/{len(metas)}")
+        if not meta['meta_file'].exists():
+            continue
+        try:
+            with metrics.phase("cleanup" if event == "cleanup" else "bulk_delete", "remove"):
+                freed = remove_session_files(meta)
+        except Exception as e:
+            print(f"Error deleting {meta['meta_file']}: {e}")
+            failed.append({"session_id": meta['timestamp'], "error": str(e)})
+            continue
+        deleted.append(meta['timestamp'])
+        # 只计引用计数降为 0 的分块，仍被其他快照共用的分块不算释放
+        freed_kb += freed / 1024
+    
+    if deleted:
+        event_hub.publish(event, {"session_ids": deleted, "project": metas[0]['project_dir'].name,
+                                  "freed_kb": round(freed_kb, 1)})
+    return {
+        "status": "success",
+        "message": f"已删除 {len(deleted)} 个会话",
+        "deleted": deleted,
+        "failed": failed,
+        "freed_kb": freed_kb
+    }
+
+@app.post("/api/sessions/bulk-export")
+async def bulk_export_sessions(selection: BulkSelection, wait: bool = False):
+    """将选中的会话导出为一个 ZIP 压缩包（后台任务，完成后从结果中的 download_url 下载）
+
+    各项目在自己的任务队列中读取快照并写入压缩包，不会与同一项目的恢复或删除同时进行；
+    全部完成后由汇总任务生成下载文件，返回的是汇总任务
+    """
+    if selection.before:
+        parse_date_bound(selection.before)
+    metas, missing = await run_in_threadpool(resolve_selection, selection)
+    if not metas:
+        raise HTTPException(status_code=404, detail="没有符合条件的会话")
+    
+    archive_name = f"sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.zip"
+    by_project = {}
+    for meta in metas:
+        by_project.setdefault(meta['project_dir'].name, []).append(meta)
+    parts = [(job_manager.submit("bulk-export", project, perform_export_part, archive_name, project_metas),
+              [meta['timestamp'] for meta in project_metas])
+             for project, project_metas in by_project.items()]
+    job = job_manager.submit_after([part for part, _ in parts], "bulk-export", ".export",
+                                   perform_bulk_export, archive_name, parts, missing)
+    return await job_response(job, wait)
+
+# 各项目的导出任务并行执行，写入同一个压缩包时逐个进行
+export_lock = threading.Lock()
+
+def perform_export_part(archive_name: str, metas: List[dict], job: Optional[Job] = None):
+    """把同一项目的会话写入压缩包（在项目任务队列中执行）：JSON 导出缓存有效时直接复用，否则临时生成，不改动会话文件"""
+    EXPORTS_DIR.mkdir(exist_ok=True)
+    tmp_archive = EXPORTS_DIR / f".{archive_name}.tmp"
+    exported, failed = [], []
+    for index, meta in enumerate(metas):
+        if job:
+            job.update(progress=index / len(metas), message=f"导出会话 {index + 1}/{len(metas)}")
+        base_name = meta['meta_file'].name[:-len('.meta.json')]
+        arc_dir = meta['project_dir'].name
+        staged_db = EXPORTS_DIR / f".{base_name}.staging.db"
+        staged_json = EXPORTS_DIR / f".{base_name}.json.tmp"
+        try:
+            if json_export_is_fresh(meta):
+                json_file = meta['project_dir'] / meta['json_file']
+            else:
+                materialize_snapshot(meta, staged_db)
+                if not export_db_to_json(staged_db, staged_json):
+                    raise IOError("JSON 导出失败")
+                json_file = staged_json
+            public_meta = {k: v for k, v in meta.items() if k not in ('project_dir', 'meta_file')}
+            with export_lock, zipfile.ZipFile(tmp_archive, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.write(json_file, f"{arc_dir}/{base_name}.json")
+                zf.writestr(f"{arc_dir}/{base_name}.meta.json",
+                            json.dumps(public_meta, indent=2, ensure_ascii=False))
+            exported.append(meta['timestamp'])
+        except Exception as e:
+            print(f"Error exporting {meta['meta_file']}: {e}")
+            failed.append({"session_id": meta['timestamp'], "error": str(e)})
+        finally:
+            discard_staged(staged_db)
+            if staged_json.exists():
+                staged_json.unlink()
+    return {"status": "success", "message": f"已导出 {len(exported)} 个会话", "exported": exported, "failed": failed}
+
+def perform_bulk_export(archive_name: str, parts: list, missing: List[str], job: Optional[Job] = None):
+    """各项目的导出任务结束后生成下载文件，汇总导出结果（parts 为 [(项目导出任务, 会话 ID)]）"""
+    EXPORTS_DIR.mkdir(exist_ok=True)
+    for old_archive in EXPORTS_DIR.glob("*.zip"):
+        if time.time() - old_archive.stat().st_mtime > EXPORT_ARCHIVE_TTL:
+            old_archive.unlink()
+    
+    exported, failed = [], []
+    for part, session_ids in parts:
+        if part.status == "succeeded":
+            exported += part.result['exported']
+            failed += part.result['failed']
+        else:
+            failed += [{"session_id": session_id, "error": part.error} for session_id in session_ids]
+    
+    archive = EXPORTS_DIR / archive_name
+    tmp_archive = EXPORTS_DIR / f".{archive_name}.tmp"
+    try:
+        if not tmp_archive.exists():
+            zipfile.ZipFile(tmp_archive, 'w').close()
+        os.replace(tmp_archive, archive)
+    finally:
+        if tmp_archive.exists():
+            tmp_archive.unlink()
+    
+    return {
+        "status": "success" if not failed else "partial",
+        "message": f"已导出 {len(exported)} 个会话",
+        "archive": archive_name,
+        "download_url": f"/api/exports/{archive_name}",
+        "size_kb": round(archive.stat().st_size / 1024, 1),
+        "exported": exported,
+        "failed": failed,
+        "missing": missing
+    }
+
+@app.get("/api/exports/{archive_name}")
+async def download_export(archive_name: str):
+    """下载批量导出的压缩包"""
+    archive = EXPORTS_DIR / archive_name
+    if Path(archive_name).name != archive_name or not archive_name.endswith('.zip') or not archive.exists():
+        raise HTTPException(status_code=404, detail="导出文件不存在")
+    return FileResponse(archive, media_type="application/zip", filename=archive_name)
+
+def collect_status() -> dict:
+    """系统状态（/api/status 与事件推送共用；catalog_generation 变化表示会话列表有变化）"""
     current_db, _ = find_current_session_db()
     project = get_current_project()
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        sessions_count = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        row = conn.execute("SELECT value FROM catalog_state WHERE name = 'generation'").fetchone()
+    finally:
+        conn.close()
     
     status = {
         "cursor_running": current_db is not None,
         "current_project": project,
-        "sessions_count": len(list(SESSIONS_DIR.rglob("*.meta.json"))),
-        "sessions_dir": str(SESSIONS_DIR)
+        "sessions_count": sessions_count,
+        "catalog_generation": row[0] if row else 0,
+        "sessions_dir": str(SESSIONS_DIR),
+        "jobs_active": sum(1 for job in job_manager.list() if not job.finished)
     }
     
     if current_db:
@@ -517,23 +1478,503 @@ async def get_status():
     
     return status
 
+@app.get("/api/status")
+async def get_status():
+    """获取系统状态"""
+    return await run_in_threadpool(collect_status)
+
+def collect_gauge_metrics():
+    """抓取时更新仪表：各项目的会话数和快照大小、分块存储的实际大小、排队与执行中的任务数"""
+    project_names, counts, usage = query_project_counts()
+    conn = open_store()
+    try:
+        chunk_bytes = conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM chunks").fetchone()[0]
+    finally:
+        conn.close()
+    
+    metrics.reset("cursor_sessions_sessions")
+    metrics.reset("cursor_sessions_store_bytes")
+    for project in project_names:
+        sessions_count, logical_kb = counts.get(project, (0, 0))
+        stored_bytes, _ = usage.get(project, (0, 0))
+        metrics.set("cursor_sessions_sessions", sessions_count, project=project)
+        metrics.set("cursor_sessions_store_bytes", round((logical_kb or 0) * 1024), project=project, kind="logical")
+        metrics.set("cursor_sessions_store_bytes", stored_bytes, project=project, kind="stored")
+    metrics.set("cursor_sessions_chunk_store_bytes", chunk_bytes)
+    
+    active = Counter(job.status for job in job_manager.list() if not job.finished)
+    for status in ("queued", "running"):
+        metrics.set("cursor_sessions_jobs", active[status], status=status)
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Prometheus 文本格式的指标：请求与各阶段耗时、自动保存结果、复制字节数、各项目存储大小和任务队列"""
+    await run_in_threadpool(collect_gauge_metrics)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/events")
+async def stream_events():
+    """以 SSE 推送状态变化、保存/删除/清理结果和任务进度（所有连接共享同一个事件源）"""
+    queue = event_hub.subscribe()
+    
+    async def events():
+        try:
+            # 连接（包括自动重连）时先发送当前状态快照
+            yield event_hub.format("status", await run_in_threadpool(collect_status))
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            event_hub.unsubscribe(queue)
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def query_project_counts():
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        counts = {row[0]: row[1:] for row in conn.execute(
+            "SELECT project_dir, COUNT(*), SUM(size_kb) FROM sessions GROUP BY project_dir"
+        )}
+        project_names = [row[0] for row in conn.execute("SELECT name FROM project_dirs ORDER BY name")]
+    finally:
+        conn.close()
+    # 逐快照的 stored_kb 之和会重复计算快照间共用的分块，改为按存储中实际持有的分块计算
+    return project_names, counts, project_usage()
+
 @app.get("/api/projects")
-async def list_projects():
-    """获取所有项目列表"""
+async def list_projects(request: Request):
+    """获取所有项目列表（项目和会话都未变化时对 If-None-Match 返回 304）"""
+    generation = await run_in_threadpool(catalog_generation)
+    etag = catalog_etag(generation, "projects")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    project_names, counts, usage = await run_in_threadpool(query_project_counts)
+    
     projects = []
+    for name in project_names:
+        sessions_count, logical_kb = counts.get(name, (0, 0))
+        stored_bytes, pack_bytes = usage.get(name, (0, 0))
+        stored_kb = stored_bytes / 1024
+        projects.append({
+            "name": name,
+            "sessions_count": sessions_count,
+            "logical_kb": round(logical_kb or 0, 1),
+            "stored_kb": round(stored_kb, 1),
+            "pack_kb": round(pack_bytes / 1024, 1),
+            "savings_percent": round(100 * (1 - stored_kb / logical_kb), 1) if logical_kb else 0
+        })
+    
+    return JSONResponse(projects, headers=headers)
+
+@app.post("/api/store/pack")
+async def pack_store(project: Optional[str] = None, older_than_days: float = PACK_COLD_DAYS, wait: bool = False):
+    """把冷快照（早于 older_than_days 天）的分块打包进各项目的包文件（每个项目一个后台任务）"""
+    projects = await run_in_threadpool(pack_targets, project)
+    jobs = [job_manager.submit("pack", name, pack_project, name, older_than_days) for name in projects]
+    if not wait:
+        return JSONResponse(status_code=202, content={
+            "status": "queued",
+            "job_ids": [job.id for job in jobs],
+            "jobs": [job.to_dict() for job in jobs]
+        })
+    results = await asyncio.gather(*(job_response(job, wait=True) for job in jobs))
+    return {
+        "status": "success",
+        "message": f"已打包 {len(projects)} 个项目",
+        "chunks_packed": sum(result['chunks_packed'] for result in results),
+        "files_removed": sum(result['files_removed'] for result in results),
+        "projects": {name: result for name, result in zip(projects, results)}
+    }
+
+@app.post("/api/catalog/reindex")
+async def reindex_catalog(wait: bool = False):
+    """从 .meta.json 文件完整重建会话索引（后台任务，wait=true 时等待完成）
+
+    独占执行：等所有项目的保存、删除等任务完成后才开始，期间提交的任务等重建完成再执行
+    """
+    job = job_manager.submit("reindex", ".catalog", perform_reindex, exclusive=True)
+    return await job_response(job, wait)
+
+def perform_reindex(job: Optional[Job] = None):
+    """重建会话索引和分块引用计数"""
+    count = rebuild_catalog()
+    if job:
+        job.update(progress=0.5, message="重建分块引用")
+    chunks, freed = rebuild_store_refs()
+    
+    return {
+        "status": "success",
+        "message": "索引已重建",
+        "sessions_count": count,
+        "chunks_count": chunks,
+        "chunks_freed": freed
+    }
+
+@app.post("/api/store/recompress")
+async def recompress_store(codec: Optional[str] = None, wait: bool = False):
+    """将存储中的快照统一压缩为指定格式（默认 SNAPSHOT_CODEC，后台任务）
+
+    分块在存储任务中重新压缩，之后每个项目一个任务转换旧快照并更新元数据（结果中的 job_ids）
+    """
+    codec = codec or SNAPSHOT_CODEC
+    if codec != 'none' and codec not in CHUNK_CODECS:
+        raise HTTPException(status_code=400, detail=f"不支持的压缩格式: {codec}")
+    job = job_manager.submit("recompress", ".store", perform_recompress, codec)
+    if not wait:
+        return await job_response(job, wait)
+    result = await job_response(job, wait=True)
+    projects = await asyncio.gather(*(job_response(job_manager.get(job_id), wait=True)
+                                      for job_id in result['job_ids']))
+    return dict(result, message="重新压缩完成",
+                snapshots_converted=sum(item['snapshots_converted'] for item in projects),
+                projects={item['project']: item for item in projects})
+
+def perform_recompress(codec: str, job: Optional[Job] = None):
+    """重新压缩分块，完成后在各项目的任务队列中转换旧快照、更新快照元数据"""
+    result = recompress_chunks(codec, job)
+    jobs = [job_manager.submit("recompress", project, recompress_project, project, codec)
+            for project in recompress_targets()]
+    return dict(result, job_ids=[job.id for job in jobs])
+
+@app.get("/api/search")
+async def search(q: str, page: int = 1, page_size: int = SEARCH_PAGE_SIZE):
+    """全文搜索所有快照的对话内容（按相关度排序，片段中的匹配以 <mark> 高亮）"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="搜索内容不能为空")
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 100)
+    
+    # 顺便在后台索引新快照（包括 CLI 保存的），本次查询不等待
+    index_job = schedule_search_index()
+    try:
+        total, results = await run_in_threadpool(search_sessions, q, page, page_size)
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"搜索失败: {str(e)}")
+    
+    metas = {}
+    if results:
+        for meta in await run_in_threadpool(query_sessions):
+            metas[(meta['project_dir'].name, meta['meta_file'].name)] = meta
+    found = []
+    for result in results:
+        meta = metas.get((result.pop('project_dir'), result.pop('meta_file')))
+        if meta is None:
+            # 已删除但索引尚未同步的快照
+            continue
+        found.append(result)
+        result.update({
+            "name": meta.get('name'),
+            "description": meta.get('description'),
+            "project": meta.get('project'),
+            "datetime": meta.get('datetime'),
+            "snippet": render_snippet(result['snippet'])
+        })
+    
+    return {
+        "query": q,
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "results": found,
+        "indexing": {"job_id": index_job.id, "status": index_job.status}
+    }
+
+@app.get("/api/jobs")
+async def list_jobs():
+    """最近的后台任务（新的在前）"""
+    return [job.to_dict() for job in job_manager.list()]
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询后台任务状态与结果"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job(job_id: str):
+    """以 SSE 推送任务进度，任务结束后关闭连接"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    async def events():
+        version = -1
+        while True:
+            if job.version != version:
+                version = job.version
+                yield f"event: job\ndata: {json.dumps(job.to_dict(), ensure_ascii=False)}\n\n"
+            if job.finished and job.version == version:
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# 后台自动保存
+class AutoSaveWatcher:
+    """监听 ~/.cursor/chats/*/*/store.db 及其 WAL 的写入，去抖后在后台保存快照"""
+    
+    def __init__(self):
+        self.config = load_auto_save_config()
+        self.mode = None
+        self.pending = {}  # 数据库路径 -> [首次变化时间, 最近变化时间]
+        self.last_result = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+    
+    def start(self):
+        self.stop_event.clear()
+        self.threads = [
+            threading.Thread(target=self._watch, name="auto-save-watch", daemon=True),
+            threading.Thread(target=self._schedule, name="auto-save-schedule", daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        session_discovery.set_watched(False)
+        # 等待监听线程退出，避免解释器关闭时 watchfiles 仍在运行
+        for thread in self.threads:
+            thread.join(timeout=5)
+    
+    def notify(self, db_path: Path):
+        """记录一次数据库写入"""
+        now = time.monotonic()
+        with self.lock:
+            self.pending.setdefault(db_path, [now, now])[1] = now
+    
+    def status(self) -> dict:
+        with self.lock:
+            pending = len(self.pending)
+        return {"mode": self.mode, "pending": pending, "last_result": self.last_result}
+    
+    def _watch(self):
+        chats_dir = CURSOR_DIR / "chats"
+        projects_dir = CURSOR_DIR / "projects"
+        if watchfiles is not None:
+            try:
+                # 目录尚不存在时先轮询等待
+                while not chats_dir.exists():
+                    if self.stop_event.wait(AUTO_SAVE_POLL_SECONDS):
+                        return
+                watch_dirs = [d for d in (chats_dir, projects_dir) if d.exists()]
+                self.mode = "inotify"
+                session_discovery.set_watched(True)
+                for changes in watchfiles.watch(*watch_dirs, stop_event=self.stop_event, debounce=500):
+                    for _, path in changes:
+                        if path.endswith("/worker.log"):
+                            session_discovery.touch(Path(path))
+                            continue
+                        if path.endswith("-wal"):
+                            path = path[:-len("-wal")]
+                        if path.endswith("/store.db"):
+                            session_discovery.touch(Path(path))
+                            self.notify(Path(path))
+                return
+            except Exception as e:
+                session_discovery.set_watched(False)
+                print(f"File watcher unavailable ({e}), falling back to polling")
+        
+        # 轮询模式下由本循环定期刷新会话发现缓存
+        self.mode = "polling"
+        session_discovery.set_watched(True)
+        seen = {}
+        while True:
+            session_discovery.refresh()
+            for db_file in session_discovery.chat_db_files():
+                state = []
+                for f in (db_file, Path(str(db_file) + "-wal")):
+                    try:
+                        stat = f.stat()
+                        state.append((stat.st_size, stat.st_mtime_ns))
+                    except FileNotFoundError:
+                        state.append(None)
+                # 第一次看到的数据库只记录基线，不视为变化
+                if db_file in seen and seen[db_file] != state:
+                    self.notify(db_file)
+                seen[db_file] = state
+            if self.stop_event.wait(AUTO_SAVE_POLL_SECONDS):
+                session_discovery.set_watched(False)
+                return
+    
+    def _schedule(self):
+        while not self.stop_event.wait(1):
+            config = self.config
+            now = time.monotonic()
+            with self.lock:
+                if not config['enabled']:
+                    self.pending.clear()
+                    continue
+                due = [db for db, (first, last) in self.pending.items()
+                       if now - last >= config['quiet_seconds'] or now - first >= config['max_latency_seconds']]
+                for db in due:
+                    del self.pending[db]
+            
+            for db in due:
+                self._snapshot(db, config)
     
-    for project_dir in SESSIONS_DIR.iterdir():
-        if project_dir.is_dir():
-            session_count = len(list(project_dir.glob("*.meta.json")))
-            projects.append({
-                "name": project_dir.name,
-                "sessions_count": session_count
-            })
+    def _snapshot(self, db_path: Path, config: dict):
+        try:
+            mtime = db_path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        try:
+            mtime = max(mtime, Path(str(db_path) + '-wal').stat().st_mtime)
+        except FileNotFoundError:
+            pass
+        # 与 discover_active_chat_dbs 相同：按聊天目录确定项目，而不是取最近活跃的项目（多个窗口同时写入时会错配）
+        [(_, project_name)] = assign_chat_projects({db_path: mtime}, session_discovery.project_activity())
+        job = job_manager.submit("auto-save", project_name, perform_auto_save,
+                                 db_path, db_path.parent.parent.name, project_name, config['delta'])
+        job.future.add_done_callback(lambda _: self._record(job, db_path))
+    
+    def _record(self, job: Job, db_path: Path):
+        if job.status == "failed":
+            result = {"status": "error", "message": job.error}
+            print(f"Auto-save failed for {db_path}: {job.error}")
+        else:
+            result = job.result
+        self.last_result = dict(result, db=str(db_path), job_id=job.id, at=datetime.now().isoformat())
+
+auto_save_watcher = AutoSaveWatcher()
+
+class RetentionScheduler:
+    """每 interval_seconds 执行一次保留策略：一次评估，再把各项目的删除提交到各自的任务队列"""
     
-    return projects
+    def __init__(self):
+        self.policy = load_retention_policy()
+        self.last_run = None
+        self.next_run = None
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+    
+    def run(self, dry_run: bool = False):
+        """评估保留策略；非 dry_run 时提交删除任务，返回 (汇总, 任务列表)"""
+        with metrics.phase("cleanup", "plan"):
+            summary, deletions = plan_retention(self.policy)
+        summary['dry_run'] = dry_run
+        jobs = []
+        if not dry_run:
+            jobs = [job_manager.submit("retention", project, perform_bulk_delete, metas, "cleanup")
+                    for project, metas in deletions.items()]
+            self.last_run = {k: v for k, v in summary.items() if k != 'projects'}
+            self.last_run.update(at=datetime.now().isoformat(), job_ids=[job.id for job in jobs])
+        return summary, jobs
+    
+    def _loop(self):
+        delay = RETENTION_STARTUP_DELAY
+        while True:
+            self.next_run = (datetime.now() + timedelta(seconds=delay)).isoformat()
+            if self.stop_event.wait(delay):
+                return
+            if self.policy['enabled']:
+                try:
+                    self.run()
+                except Exception as e:
+                    print(f"Retention run failed: {e}")
+            delay = self.policy['interval_seconds']
+
+retention_scheduler = RetentionScheduler()
+
+@app.on_event("startup")
+async def start_auto_save_watcher():
+    auto_save_watcher.start()
+    retention_scheduler.start()
+    event_hub.task = asyncio.create_task(event_hub.run())
+    # 补建 CLI 或旧版本保存的快照的搜索索引
+    schedule_search_index()
+
+@app.on_event("shutdown")
+async def stop_auto_save_watcher():
+    auto_save_watcher.stop()
+    retention_scheduler.stop()
+    # 等待正在执行的任务写完快照
+    job_manager.shutdown()
+    message_readers.close()
+
+@app.get("/api/auto-save/config")
+async def get_auto_save_config():
+    """获取后台自动保存配置与监听状态"""
+    return dict(auto_save_watcher.config, watcher=auto_save_watcher.status())
+
+@app.put("/api/auto-save/config")
+async def update_auto_save_config(update: AutoSaveConfig):
+    """更新后台自动保存配置"""
+    config = load_auto_save_config()
+    config.update({k: v for k, v in update.dict().items() if v is not None})
+    with open(AUTO_SAVE_CONFIG_FILE, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+    auto_save_watcher.config = config
+    # 让其他打开的页面同步开关和间隔
+    event_hub.publish("auto_save_config", config)
+    return dict(config, watcher=auto_save_watcher.status())
+
+@app.get("/api/retention")
+async def get_retention_policy():
+    """获取保留策略及最近一次执行结果"""
+    return dict(retention_scheduler.policy, last_run=retention_scheduler.last_run,
+                next_run=retention_scheduler.next_run if retention_scheduler.policy['enabled'] else None)
+
+@app.put("/api/retention")
+async def update_retention_policy(update: RetentionPolicy):
+    """更新保留策略（projects 中可按项目覆盖分层与数量、大小限制）
+
+    省略的字段保持不变；max_keep、project_max_mb、total_max_mb 显式设为 null 表示取消上限，
+    项目规则中的 null 表示该项目不受全局上限限制；projects 为 null 时清除所有项目规则
+    """
+    changes = update.dict(exclude_unset=True)
+    for key, value in changes.items():
+        if value is None and key not in RETENTION_NULLABLE and key != 'projects':
+            raise HTTPException(status_code=400, detail=f"{key} 不能为空")
+    if 'projects' in changes:
+        changes['projects'] = changes['projects'] or {}
+    for project, rules in changes.get('projects', {}).items():
+        if not isinstance(rules, dict) or set(rules) - set(RETENTION_PROJECT_RULES) \
+                or any(value is None and key not in RETENTION_NULLABLE for key, value in rules.items()):
+            raise HTTPException(status_code=400, detail=f"项目 {project} 的保留规则无效")
+    policy = load_retention_policy()
+    policy.update(changes)
+    with open(RETENTION_FILE, 'w', encoding='utf-8') as f:
+        json.dump(policy, f, indent=2, ensure_ascii=False)
+    retention_scheduler.policy = policy
+    return policy
+
+@app.post("/api/retention/run")
+async def run_retention(dry_run: bool = False):
+    """立即执行保留策略；dry_run=true 时只返回将要删除的会话和可回收的空间"""
+    summary, jobs = await run_in_threadpool(retention_scheduler.run, dry_run)
+    if jobs:
+        results = await asyncio.gather(*(job_response(job, wait=True) for job in jobs))
+        summary['deleted'] = sum(len(result['deleted']) for result in results)
+        summary['failed'] = [item for result in results for item in result['failed']]
+    return summary
 
 # 挂载静态文件（前端）
-app.mount("/", StaticFiles(directory="/app/frontend", html=True), name="frontend")
+app.mount("/", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="frontend")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,2999 @@
+#!/usr/bin/env python3
+"""
+Cursor Session Manager - 会话存储核心
+
+Web 后端（app.py）与命令行工具（cursor_sessions.py）共用的实现：会话索引、分块去重存储与包文件、
+在线快照与原子恢复、JSON 导出与快照比较、全文搜索与消息存储、保留策略，以及保存、恢复等操作本身
+"""
+
+import sqlite3
+import json
+import struct
+import os
+import uuid
+import hashlib
+import re
+import errno
+import gzip
+import lzma
+import tempfile
+import threading
+import time
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl  # reflink（FICLONE）只在 Linux 上可用
+except ImportError:
+    fcntl = None
+
+# 配置路径
+
+CURSOR_DIR = Path.home() / ".cursor"
+SESSIONS_DIR = Path.home() / "cursor-session-manager" / "saved_sessions"
+SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
+CATALOG_FILE = SESSIONS_DIR / ".catalog.db"
+STORE_DIR = SESSIONS_DIR / ".store"
+SEARCH_DB_FILE = SESSIONS_DIR / ".search.db"
+
+# 会话索引 saved_sessions/.catalog.db
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    project_dir TEXT NOT NULL,
+    meta_file TEXT NOT NULL,
+    id TEXT NOT NULL,
+    project TEXT,
+    name TEXT,
+    datetime TEXT NOT NULL DEFAULT '',
+    auto_saved INTEGER NOT NULL DEFAULT 0,
+    size_kb REAL NOT NULL DEFAULT 0,
+    mtime_ns INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    PRIMARY KEY (project_dir, meta_file)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_id ON sessions(id);
+CREATE INDEX IF NOT EXISTS idx_sessions_datetime ON sessions(datetime);
+CREATE INDEX IF NOT EXISTS idx_sessions_project ON sessions(project_dir, datetime);
+CREATE INDEX IF NOT EXISTS idx_sessions_auto ON sessions(project_dir, auto_saved, datetime);
+CREATE TABLE IF NOT EXISTS project_dirs (
+    name TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+-- 索引代数：会话或项目目录的任何变化都会递增（首次写入时取随机值，重建索引文件后不会与旧值重复）
+CREATE TABLE IF NOT EXISTS catalog_state (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS sessions_insert_generation AFTER INSERT ON sessions BEGIN
+    INSERT INTO catalog_state (name, value) VALUES ('generation', abs(random() >> 16)) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_update_generation AFTER UPDATE ON sessions BEGIN
+    INSERT INTO catalog_state (name, value) VALUES ('generation', abs(random() >> 16)) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_delete_generation AFTER DELETE ON sessions BEGIN
+    INSERT INTO catalog_state (name, value) VALUES ('generation', abs(random() >> 16)) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS project_dirs_insert_generation AFTER INSERT ON project_dirs BEGIN
+    INSERT INTO catalog_state (name, value) VALUES ('generation', abs(random() >> 16)) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS project_dirs_delete_generation AFTER DELETE ON project_dirs BEGIN
+    INSERT INTO catalog_state (name, value) VALUES ('generation', abs(random() >> 16)) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+END;
+"""
+
+# 内容寻址快照存储 saved_sessions/.store
+# 64 KiB 是 SQLite 所有页大小的整数倍，单个页的修改只会影响它所在的分块
+CHUNK_SIZE = 64 * 1024
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0,
+    codec TEXT NOT NULL DEFAULT 'none',
+    stored_size INTEGER,
+    pack TEXT,
+    pack_offset INTEGER,
+    tried_codec TEXT
+);
+"""
+
+# 冷快照的分块打包进每个项目一个的只追加包文件（.store/packs/<项目>.<代数>.pack），索引记录包名和偏移，
+# 可随机读取单个分块。每条记录带 (hash, 格式, 长度) 头，索引丢失时可重新扫描；死记录过多时改写为新一代包文件
+PACKS_DIR = STORE_DIR / "packs"
+PACK_RECORD = struct.Struct('>32sBI')
+PACK_COLD_DAYS = float(os.environ.get('PACK_COLD_DAYS', 7))
+PACK_COMPACT_RATIO = 0.5
+PACK_BATCH = 256
+# 按哈希批量查询分块索引时每批的哈希数
+CHUNK_QUERY_BATCH = 500
+
+# 分块压缩：优先 zstd（需安装 zstandard），否则使用标准库 gzip；lzma 压缩率更高但更慢
+# 分块文件名后缀标明压缩格式，索引中的 codec 列记录每个分块实际使用的格式
+CODEC_SUFFIXES = {'none': '', 'zstd': '.zst', 'gzip': '.gz', 'lzma': '.xz'}
+PACK_CODECS = list(CODEC_SUFFIXES)
+CHUNK_CODECS = {
+    'gzip': (lambda data: gzip.compress(data, compresslevel=6, mtime=0), gzip.decompress),
+    'lzma': (lzma.compress, lzma.decompress)
+}
+if zstandard is not None:
+    # 压缩器对象不是线程安全的，每次调用单独创建
+    CHUNK_CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                            lambda data: zstandard.ZstdDecompressor().decompress(data))
+SNAPSHOT_CODEC = os.environ.get('SNAPSHOT_CODEC') or ('zstd' if zstandard is not None else 'gzip')
+if SNAPSHOT_CODEC != 'none' and SNAPSHOT_CODEC not in CHUNK_CODECS:
+    print(f"Snapshot codec {SNAPSHOT_CODEC} unavailable, using gzip")
+    SNAPSHOT_CODEC = 'gzip'
+
+# 增量快照：自动保存只存储相对同一数据库上一快照变化的页，链长达到 DELTA_KEYFRAME_INTERVAL 时存完整关键帧
+DELTA_KEYFRAME_INTERVAL = int(os.environ.get('DELTA_KEYFRAME_INTERVAL', 10))
+# 变化的页超过数据库大小的该比例时，增量没有意义，直接存关键帧
+DELTA_MAX_RATIO = 0.5
+
+# 在线快照参数：每步复制的页数、步间让出时间（让 Cursor 的写入不被阻塞）及总超时
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+BACKUP_TIMEOUT = 300
+
+# 流式导出时每批从游标读取的行数
+EXPORT_BATCH_ROWS = 500
+
+# 文件复制策略（按顺序尝试）：reflink 在 btrfs/XFS 等文件系统上共享数据块，不复制数据；
+# copy_file_range/sendfile 在内核中复制，不经过用户态缓冲；buffered 是普通的读写复制
+COPY_STRATEGIES = [name.strip() for name in
+                   os.environ.get('COPY_STRATEGIES', 'reflink,copy_file_range,sendfile,buffered').split(',')
+                   if name.strip()] or ['buffered']
+# FICLONE ioctl（linux/fs.h）
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 1024 * 1024
+# 这些错误表示策略本身不被支持（而不是磁盘满等真正的错误），换下一个策略
+COPY_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL,
+                           errno.ENOSYS, errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+# 恢复：替换前的数据库以硬链接保留在同一目录（.store.db.pre-restore），撤销时与当前数据库交换
+# 撤销点记录在 saved_sessions/.restore_undo.json，每个数据库只保留最近一次
+RESTORE_UNDO_FILE = SESSIONS_DIR / ".restore_undo.json"
+RESTORE_UNDO_SUFFIX = ".pre-restore"
+
+# 快照比较：每张表的新增/删除/修改各最多列出的行数（计数不受限制），以及列出的单个值的最大长度
+DIFF_ROW_LIMIT = 50
+DIFF_MAX_VALUE = 2000
+
+# 变化检测：每个活跃数据库最近一次确认过内容的廉价指纹（含内容哈希），避免重复哈希
+FINGERPRINT_CACHE = {}
+CHEAP_FINGERPRINT_KEYS = ('db_size', 'db_mtime_ns', 'change_counter', 'wal_size', 'wal_mtime_ns', 'wal_salt')
+
+# 自动保存配置：Web 后端监听数据库写入，安静期后保存，持续写入时最长延迟 max_latency 秒；
+# delta 同样用于 CLI 的 save --all-active
+AUTO_SAVE_CONFIG_FILE = SESSIONS_DIR / ".auto_save.json"
+AUTO_SAVE_DEFAULTS = {
+    'enabled': os.environ.get('AUTO_SAVE_ENABLED', '0') == '1',
+    'quiet_seconds': float(os.environ.get('AUTO_SAVE_QUIET_SECONDS', 10)),
+    'max_latency_seconds': float(os.environ.get('AUTO_SAVE_MAX_LATENCY_SECONDS', 60)),
+    # 增量快照：只存储相对同一数据库上一快照变化的页
+    'delta': os.environ.get('AUTO_SAVE_DELTA', '1') == '1'
+}
+
+
+# 自动保存的保留策略（GFS 分层）：最近 keep_all_hours 小时全部保留，之后每小时/每天/每周各保留最新的一个，
+# 超出 weekly_weeks 周的删除；max_keep 与大小上限为可选的附加限制。projects 中可按项目覆盖（total_max_mb 除外）
+RETENTION_FILE = SESSIONS_DIR / ".retention.json"
+RETENTION_DEFAULTS = {
+    'enabled': os.environ.get('RETENTION_ENABLED', '1') == '1',
+    'interval_seconds': float(os.environ.get('RETENTION_INTERVAL_SECONDS', 600)),
+    'keep_all_hours': float(os.environ.get('RETENTION_KEEP_ALL_HOURS', 1)),
+    'hourly_hours': float(os.environ.get('RETENTION_HOURLY_HOURS', 24)),
+    'daily_days': float(os.environ.get('RETENTION_DAILY_DAYS', 7)),
+    'weekly_weeks': float(os.environ.get('RETENTION_WEEKLY_WEEKS', 4)),
+    'max_keep': int(os.environ['AUTO_SAVE_MAX_KEEP']) if os.environ.get('AUTO_SAVE_MAX_KEEP') else None,
+    'project_max_mb': float(os.environ['RETENTION_PROJECT_MAX_MB']) if os.environ.get('RETENTION_PROJECT_MAX_MB') else None,
+    'total_max_mb': float(os.environ['RETENTION_TOTAL_MAX_MB']) if os.environ.get('RETENTION_TOTAL_MAX_MB') else None,
+    'projects': {}
+}
+RETENTION_PROJECT_RULES = ('keep_all_hours', 'hourly_hours', 'daily_days', 'weekly_weeks', 'max_keep', 'project_max_mb')
+# 可设为 null（不限制）的上限
+RETENTION_NULLABLE = ('max_keep', 'project_max_mb', 'total_max_mb')
+
+# 全文搜索：相同文本只索引一次，snapshot_blobs 记录每个快照包含哪些文本
+# trigram 分词支持中文和代码的子串匹配（SQLite 3.34+），否则退回 unicode61
+SEARCH_TOKENIZER = 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61'
+SEARCH_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    project_dir TEXT NOT NULL,
+    meta_file TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    datetime TEXT NOT NULL DEFAULT '',
+    signature TEXT NOT NULL,
+    UNIQUE (project_dir, meta_file)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    role TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshot_blobs (
+    snapshot_id INTEGER NOT NULL,
+    blob_id INTEGER NOT NULL,
+    PRIMARY KEY (snapshot_id, blob_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_snapshot_blobs_blob ON snapshot_blobs(blob_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS blob_text USING fts5(content, tokenize='{SEARCH_TOKENIZER}');
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    role TEXT NOT NULL,
+    created_at TEXT,
+    text TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    tokens_estimated INTEGER NOT NULL,
+    attachments TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS snapshot_messages (
+    snapshot_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (snapshot_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_snapshot_messages_message ON snapshot_messages(message_id);
+"""
+# 索引格式版本：低于该版本的索引打开时让所有快照重新提取（版本 2 加入对话消息）
+SEARCH_INDEX_VERSION = 2
+SEARCH_MAX_TEXT = 200_000
+SEARCH_PAGE_SIZE = 20
+# 高亮标记（Web 端输出前替换为 <mark>，避免与正文中的 HTML 混淆；CLI 替换为【】）
+SEARCH_MARK_START, SEARCH_MARK_END = '\x02', '\x03'
+
+# 对话消息：建立搜索索引时把快照中的消息解码为规范化记录，存在同一个 .search.db 中，
+# 相同的消息在所有快照间只存一次，snapshot_messages 记录每个快照的消息顺序
+MESSAGE_ROLES = ('system', 'user', 'assistant', 'tool')
+# 消息用量字段（不同版本的命名），没有时按约每 4 字节一个 token 估算
+MESSAGE_TOKEN_KEYS = ('inputTokens', 'outputTokens', 'promptTokens', 'completionTokens',
+                      'input_tokens', 'output_tokens', 'prompt_tokens', 'completion_tokens')
+MESSAGE_TIME_KEYS = ('createdAt', 'created_at', 'timestamp', 'time')
+# 附件保留的描述字段
+MESSAGE_ATTACHMENT_KEYS = ('toolName', 'toolCallId', 'name', 'filename', 'path', 'mediaType', 'mimeType')
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+# 提取消息时每批读取的 blob 数
+MESSAGE_BATCH = 500
+
+# /api/sessions/snapshot-all 与 CLI save --all-active：默认保存最近多长时间内有写入的所有会话数据库
+SNAPSHOT_ALL_WINDOW_SECONDS = float(os.environ.get('SNAPSHOT_ALL_WINDOW_SECONDS', 3600))
+
+# 指标：耗时直方图的桶（秒）
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def open_catalog():
+    """打开会话索引数据库"""
+    conn = sqlite3.connect(str(CATALOG_FILE), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(CATALOG_SCHEMA)
+    return conn
+
+def index_meta_file(conn, meta_file: Path):
+    """将单个 .meta.json 写入索引"""
+    try:
+        mtime_ns = meta_file.stat().st_mtime_ns
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except Exception as e:
+        print(f"Error reading {meta_file}: {e}")
+        return
+    
+    conn.execute(
+        "INSERT OR REPLACE INTO sessions "
+        "(project_dir, meta_file, id, project, name, datetime, auto_saved, size_kb, mtime_ns, meta) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (meta_file.parent.name, meta_file.name, meta.get('timestamp', ''), meta.get('project'),
+         meta.get('name'), meta.get('datetime', ''), 1 if meta.get('auto_saved') else 0,
+         meta.get('size_kb', 0), mtime_ns, json.dumps(meta, ensure_ascii=False))
+    )
+
+def sync_catalog(conn):
+    """按目录 mtime 增量同步索引，只重新扫描有变化的项目目录"""
+    known = dict(conn.execute("SELECT name, mtime_ns FROM project_dirs"))
+    seen = set()
+    
+    for project_dir in SESSIONS_DIR.iterdir():
+        if not project_dir.is_dir() or project_dir.name.startswith('.'):
+            continue
+        
+        seen.add(project_dir.name)
+        # 先记录 mtime 再扫描，扫描期间的新变化会在下次同步时被发现
+        dir_mtime = project_dir.stat().st_mtime_ns
+        if known.get(project_dir.name) == dir_mtime:
+            continue
+        
+        indexed = dict(conn.execute(
+            "SELECT meta_file, mtime_ns FROM sessions WHERE project_dir = ?", (project_dir.name,)
+        ))
+        present = set()
+        for meta_file in project_dir.glob("*.meta.json"):
+            present.add(meta_file.name)
+            if indexed.get(meta_file.name) != meta_file.stat().st_mtime_ns:
+                index_meta_file(conn, meta_file)
+        
+        for gone in set(indexed) - present:
+            conn.execute("DELETE FROM sessions WHERE project_dir = ? AND meta_file = ?",
+                         (project_dir.name, gone))
+        # 只更新 mtime 不算列表变化（不触发索引代数递增）
+        conn.execute("INSERT INTO project_dirs (name, mtime_ns) VALUES (?, ?) "
+                     "ON CONFLICT(name) DO UPDATE SET mtime_ns = excluded.mtime_ns",
+                     (project_dir.name, dir_mtime))
+    
+    for gone in set(known) - seen:
+        conn.execute("DELETE FROM sessions WHERE project_dir = ?", (gone,))
+        conn.execute("DELETE FROM project_dirs WHERE name = ?", (gone,))
+    
+    conn.commit()
+
+def query_sessions(project_dir: Optional[str] = None, session_id: Optional[str] = None,
+                   auto_saved: Optional[bool] = None, limit: Optional[int] = None,
+                   session_ids: Optional[List[str]] = None, before: Optional[str] = None,
+                   original_path: Optional[str] = None):
+    """从索引查询会话元数据（按时间倒序），附带 project_dir / meta_file 路径"""
+    sql = "SELECT project_dir, meta_file, meta FROM sessions"
+    clauses, params = [], []
+    if project_dir:
+        clauses.append("project_dir = ?")
+        params.append(project_dir)
+    if session_id:
+        clauses.append("id = ?")
+        params.append(session_id)
+    if session_ids is not None:
+        # 以 JSON 数组作为单个参数传入，不受 SQLite 参数个数限制
+        clauses.append("id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(session_ids))
+    if before:
+        clauses.append("datetime < ?")
+        params.append(before)
+    if auto_saved is not None:
+        clauses.append("auto_saved = ?")
+        params.append(1 if auto_saved else 0)
+    if original_path:
+        clauses.append("json_extract(meta, '$.original_path') = ?")
+        params.append(original_path)
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY datetime DESC"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        sessions = []
+        for row in conn.execute(sql, params):
+            meta = json.loads(row['meta'])
+            meta['project_dir'] = SESSIONS_DIR / row['project_dir']
+            meta['meta_file'] = meta['project_dir'] / row['meta_file']
+            sessions.append(meta)
+        return sessions
+    finally:
+        conn.close()
+
+def write_metadata(meta_file: Path, metadata: dict):
+    """写入 .meta.json 并同步更新索引（忽略查询时附加的路径字段）"""
+    metadata = {k: v for k, v in metadata.items() if k not in ('project_dir', 'meta_file')}
+    with open(meta_file, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    
+    conn = open_catalog()
+    try:
+        index_meta_file(conn, meta_file)
+        conn.commit()
+    finally:
+        conn.close()
+
+def clone_db(src_path: Path, dest_path: Path) -> dict:
+    """在源数据库的读事务中以 reflink 克隆数据库和 WAL，再重放 WAL 得到一致性快照（不复制数据页）
+
+    读事务期间 checkpoint 不会写入之后提交的页，WAL 也不会被重置，因此先克隆的数据库文件
+    与随后克隆的 WAL 一起重放即为某次提交后的完整状态（WAL 末尾未写完的帧会被校验和排除）。
+    文件系统不支持 reflink 时抛出 OSError。
+    """
+    devices = (os.stat(src_path).st_dev, os.stat(Path(dest_path).parent).st_dev)
+    if (devices, 'reflink') in unsupported_copy_strategies:
+        raise OSError(errno.EOPNOTSUPP, "reflink 不可用")
+    
+    started = time.monotonic()
+    wal_file = Path(str(src_path) + '-wal')
+    src = sqlite3.connect(f"{Path(src_path).resolve().as_uri()}?mode=ro", uri=True, timeout=30,
+                          isolation_level=None)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        copy_info = copy_file(src_path, dest_path, strategies=['reflink'])
+        wal_size = 0
+        if wal_file.exists():
+            wal_size = copy_file(wal_file, Path(str(dest_path) + '-wal'), strategies=['reflink'])['bytes']
+    finally:
+        src.close()
+    
+    dst = sqlite3.connect(str(dest_path))
+    try:
+        # 重放 WAL 并合并为单个文件，与在线备份的结果一样可以直接存储
+        dst.execute("PRAGMA journal_mode=DELETE").fetchone()
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            raise sqlite3.DatabaseError(f"快照完整性检查失败: {check}")
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+    
+    return {
+        'method': 'reflink_clone',
+        'pages': page_count,
+        'wal_kb': wal_size / 1024,
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+        'quick_check': check,
+        'copy': copy_info
+    }
+
+def backup_db(src_path: Path, dest_path: Path, on_progress=None) -> dict:
+    """生成一致性快照（包含 WAL 中已提交的内容）：支持 reflink 时克隆，否则使用 SQLite 在线备份 API
+    
+    on_progress: 可选回调，每步复制后以已完成比例（0~1）调用
+    """
+    if 'reflink' in COPY_STRATEGIES:
+        try:
+            return clone_db(src_path, dest_path)
+        except (OSError, sqlite3.Error):
+            discard_staged(dest_path)
+    
+    started = time.monotonic()
+    wal_file = Path(str(src_path) + '-wal')
+    wal_size = wal_file.stat().st_size if wal_file.exists() else 0
+    
+    copy_info = None
+    fallback_dir = None
+    try:
+        # 只读打开，关闭时不会触发对 Cursor 数据库的 checkpoint
+        src = sqlite3.connect(f"{Path(src_path).resolve().as_uri()}?mode=ro", uri=True, timeout=30)
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    except sqlite3.OperationalError:
+        # 只读挂载（如 Docker 的 :ro 卷）下无法创建 -shm：复制数据库和 WAL 后由 SQLite 重放
+        fallback_dir = Path(tempfile.mkdtemp(prefix="cursor-snapshot-"))
+        copy_info = copy_file(src_path, fallback_dir / "store.db")
+        if wal_size:
+            copy_file(wal_file, fallback_dir / "store.db-wal")
+        src = sqlite3.connect(str(fallback_dir / "store.db"), timeout=30)
+    
+    deadline = started + BACKUP_TIMEOUT
+    
+    def progress(status, remaining, total):
+        if time.monotonic() > deadline:
+            raise TimeoutError("在线备份超时，数据库持续被写入")
+        if on_progress and total:
+            on_progress((total - remaining) / total)
+        # 步间让出，避免长时间占用读锁
+        time.sleep(BACKUP_STEP_SLEEP)
+    
+    dst = sqlite3.connect(str(dest_path))
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            raise sqlite3.DatabaseError(f"快照完整性检查失败: {check}")
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+        if fallback_dir:
+            shutil.rmtree(fallback_dir, ignore_errors=True)
+    
+    info = {
+        'method': 'sqlite_backup',
+        'pages': page_count,
+        'wal_kb': wal_size / 1024,
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+        'quick_check': check
+    }
+    if copy_info:
+        info['copy'] = copy_info
+    return info
+
+def discard_staged(staged_db: Path):
+    """删除临时快照文件及其日志文件"""
+    for ext in ['', '-journal', '-wal', '-shm']:
+        extra = Path(str(staged_db) + ext)
+        if extra.exists():
+            extra.unlink()
+
+# 某对设备（源, 目标）上已确认不支持的复制策略，之后不再尝试
+unsupported_copy_strategies = set()
+
+def copy_reflink(src_fd: int, dst_fd: int, size: int):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink 不可用")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def copy_kernel_range(src_fd: int, dst_fd: int, size: int):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range 不可用")
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if n == 0:
+            # 部分文件系统不报错但什么也不复制
+            raise OSError(errno.EOPNOTSUPP, "copy_file_range 未复制数据")
+        copied += n
+
+def copy_sendfile(src_fd: int, dst_fd: int, size: int):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, "sendfile 不可用")
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if n == 0:
+            raise OSError(errno.EOPNOTSUPP, "sendfile 未复制数据")
+        copied += n
+
+def copy_buffered(src_fd: int, dst_fd: int, size: int):
+    while True:
+        data = os.read(src_fd, COPY_BUFFER_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+COPY_FUNCTIONS = {
+    'reflink': copy_reflink,
+    'copy_file_range': copy_kernel_range,
+    'sendfile': copy_sendfile,
+    'buffered': copy_buffered,
+}
+
+def copy_file(src: Path, dest: Path, strategies: Optional[List[str]] = None) -> dict:
+    """按策略顺序复制文件（含权限和修改时间，同 shutil.copy2），返回使用的策略与吞吐量
+
+    某个策略失败时截断目标文件后尝试下一个，并记住该设备组合不支持它；strategies 全部失败时抛出最后的错误。
+    """
+    started = time.monotonic()
+    strategies = COPY_STRATEGIES if strategies is None else strategies
+    error = None
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        src_stat = os.fstat(fsrc.fileno())
+        devices = (src_stat.st_dev, os.fstat(fdst.fileno()).st_dev)
+        for strategy in strategies:
+            if (devices, strategy) in unsupported_copy_strategies or strategy not in COPY_FUNCTIONS:
+                continue
+            try:
+                COPY_FUNCTIONS[strategy](fsrc.fileno(), fdst.fileno(), src_stat.st_size)
+                break
+            except OSError as e:
+                if e.errno not in COPY_UNSUPPORTED_ERRNOS:
+                    raise
+                unsupported_copy_strategies.add((devices, strategy))
+                error = e
+                os.ftruncate(fdst.fileno(), 0)
+                os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+                os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+        else:
+            raise error or OSError(errno.EOPNOTSUPP, "没有可用的复制策略")
+    shutil.copystat(src, dest)
+    
+    elapsed = time.monotonic() - started
+    metrics.inc("cursor_sessions_copy_bytes_total", src_stat.st_size, strategy=strategy)
+    return {
+        'strategy': strategy,
+        'bytes': src_stat.st_size,
+        'elapsed_ms': round(elapsed * 1000, 2),
+        'mb_per_s': round(src_stat.st_size / 1048576 / elapsed, 1) if elapsed > 0 else None
+    }
+
+def link_or_copy(src: Path, dest: Path) -> str:
+    """为 src 的当前内容建立另一个路径：优先硬链接（常数时间，不复制数据），文件系统不支持时复制，返回方式"""
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError:
+        return copy_file(src, dest)['strategy']
+
+def fsync_path(path: Path):
+    """将文件（或目录项的变化）刷到磁盘"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def swap_in_db(new_db: Path, target_db: Path, keep_as: Path) -> str:
+    """用同一目录下的 new_db 原子替换 target_db，替换前的数据库及其 WAL 保留为 keep_as，返回保留方式
+
+    任一时刻崩溃，target_db 要么是完整的旧数据库，要么是完整的新数据库。旧 WAL 在替换前移走
+    （新数据库不能与旧 WAL 一起被打开），此时崩溃只会暂时缺少 WAL 中的提交，它们仍在 keep_as 旁。
+    """
+    discard_staged(keep_as)
+    method = link_or_copy(target_db, keep_as)
+    wal_file = Path(str(target_db) + '-wal')
+    if wal_file.exists():
+        os.replace(wal_file, Path(str(keep_as) + '-wal'))
+    shm_file = Path(str(target_db) + '-shm')
+    if shm_file.exists():
+        shm_file.unlink()
+    
+    os.replace(new_db, target_db)
+    new_wal = Path(str(new_db) + '-wal')
+    if new_wal.exists():
+        os.replace(new_wal, wal_file)
+    discard_staged(new_db)
+    fsync_path(target_db.parent)
+    return method
+
+# 撤销点记录的读改写在进程内串行（文件本身通过原子替换写入）
+restore_undo_lock = threading.Lock()
+
+def load_restore_undo() -> dict:
+    """撤销点：数据库路径 -> 记录（撤销文件、恢复的会话、状态）"""
+    try:
+        with open(RESTORE_UNDO_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_restore_undo(records: dict):
+    tmp_file = RESTORE_UNDO_FILE.with_name(RESTORE_UNDO_FILE.name + ".tmp")
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(records, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, RESTORE_UNDO_FILE)
+
+def open_store():
+    """打开分块存储索引（自动提交模式，写操作显式加锁）"""
+    (STORE_DIR / "chunks").mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(STORE_DIR / "index.db"), timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(STORE_SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}
+    if 'codec' not in columns:
+        # 旧索引：已有分块均为未压缩存储
+        conn.execute("BEGIN IMMEDIATE")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}
+        if 'codec' not in columns:
+            conn.execute("ALTER TABLE chunks ADD COLUMN codec TEXT NOT NULL DEFAULT 'none'")
+            conn.execute("ALTER TABLE chunks ADD COLUMN stored_size INTEGER")
+            conn.execute("UPDATE chunks SET stored_size = size")
+        conn.execute("COMMIT")
+    if 'pack' not in columns:
+        conn.execute("BEGIN IMMEDIATE")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}
+        if 'pack' not in columns:
+            conn.execute("ALTER TABLE chunks ADD COLUMN pack TEXT")
+            conn.execute("ALTER TABLE chunks ADD COLUMN pack_offset INTEGER")
+        conn.execute("COMMIT")
+    if 'tried_codec' not in columns:
+        # 存入时请求的压缩格式：压缩后没有变小而原样存储的分块据此不再重复尝试同一格式
+        conn.execute("BEGIN IMMEDIATE")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}
+        if 'tried_codec' not in columns:
+            conn.execute("ALTER TABLE chunks ADD COLUMN tried_codec TEXT")
+        conn.execute("COMMIT")
+    return conn
+
+def chunk_path(chunk_hash: str, codec: str = 'none') -> Path:
+    return STORE_DIR / "chunks" / chunk_hash[:2] / (chunk_hash + CODEC_SUFFIXES[codec])
+
+def parse_chunk_name(name: str):
+    """由分块文件名解析出 (hash, codec)，无法识别的文件（如残留的 .tmp）返回 codec=None"""
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if suffix and name.endswith(suffix):
+            return name[:-len(suffix)], codec
+    if len(name) == 64 and '.' not in name:
+        return name, 'none'
+    return name, None
+
+def encode_chunk(data: bytes, codec: str):
+    """压缩分块，返回 (数据, 实际格式)；压缩后没有变小时原样存储"""
+    if codec != 'none':
+        encoded = CHUNK_CODECS[codec][0](data)
+        if len(encoded) < len(data):
+            return encoded, codec
+    return data, 'none'
+
+def decode_chunk(encoded: bytes, codec: str) -> bytes:
+    if codec == 'none':
+        return encoded
+    if codec not in CHUNK_CODECS:
+        raise IOError(f"不支持的分块压缩格式: {codec}（zstd 需要安装 zstandard）")
+    return CHUNK_CODECS[codec][1](encoded)
+
+def write_chunk(chunk_hash: str, data: bytes, codec: str):
+    """压缩并原子写入分块文件，返回 (实际格式, 磁盘大小)"""
+    encoded, codec = encode_chunk(data, codec)
+    write_encoded_chunk(chunk_hash, encoded, codec)
+    return codec, len(encoded)
+
+def write_encoded_chunk(chunk_hash: str, encoded: bytes, codec: str):
+    """原子写入已压缩的分块文件"""
+    chunk_file = chunk_path(chunk_hash, codec)
+    chunk_file.parent.mkdir(exist_ok=True)
+    tmp_file = chunk_file.parent / f"{chunk_hash}.tmp"
+    with open(tmp_file, 'wb') as out:
+        out.write(encoded)
+    os.replace(tmp_file, chunk_file)
+
+def read_chunk(conn, chunk_hash: str) -> bytes:
+    """读取并解压分块（散放文件或包文件中的记录），校验内容哈希"""
+    for attempt in range(2):
+        row = conn.execute("SELECT codec, pack, pack_offset, stored_size FROM chunks WHERE hash = ?",
+                           (chunk_hash,)).fetchone()
+        codec = row[0] if row else 'none'
+        try:
+            if row and row[1]:
+                with open(PACKS_DIR / row[1], 'rb') as f:
+                    f.seek(row[2])
+                    encoded = f.read(row[3])
+            else:
+                with open(chunk_path(chunk_hash, codec), 'rb') as f:
+                    encoded = f.read()
+            break
+        except FileNotFoundError:
+            # 读取期间分块可能刚被打包、或包文件刚被改写为新一代，重新查询位置后再读一次
+            if attempt:
+                raise
+    data = decode_chunk(encoded, codec)
+    if hashlib.sha256(data).hexdigest() != chunk_hash:
+        raise IOError(f"分块校验失败: {chunk_hash}")
+    return data
+
+def iter_db_chunks(db_path):
+    """按 CHUNK_SIZE 流式读取文件，逐块返回 (hash, data)"""
+    with open(db_path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield hashlib.sha256(data).hexdigest(), data
+
+def put_chunk(conn, chunk_hash: str, data: bytes, codec: str) -> int:
+    """在写事务中存入分块（已存在的分块只增加引用），返回其磁盘大小"""
+    row = conn.execute("SELECT codec, stored_size, pack FROM chunks WHERE hash = ?", (chunk_hash,)).fetchone()
+    if row and (row[2] or chunk_path(chunk_hash, row[0]).exists()):
+        conn.execute("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", (chunk_hash,))
+        return row[1]
+    chunk_codec, stored_size = write_chunk(chunk_hash, data, codec)
+    conn.execute(
+        "INSERT INTO chunks (hash, size, refs, codec, stored_size, tried_codec) VALUES (?, ?, 1, ?, ?, ?) "
+        "ON CONFLICT(hash) DO UPDATE SET refs = refs + 1, codec = excluded.codec, "
+        "stored_size = excluded.stored_size, tried_codec = excluded.tried_codec",
+        (chunk_hash, len(data), chunk_codec, stored_size, codec)
+    )
+    return stored_size
+
+def parse_pack_name(name: str):
+    """由包文件名解析出 (项目, 代数)，不是包文件时返回 (None, None)"""
+    parts = name.rsplit('.', 2)
+    if len(parts) == 3 and parts[2] == 'pack' and parts[1].isdigit():
+        return parts[0], int(parts[1])
+    return None, None
+
+def project_packs(project: str) -> list:
+    """项目的所有包文件名，按代数从旧到新"""
+    packs = []
+    for pack_file in PACKS_DIR.glob("*.pack"):
+        owner, generation = parse_pack_name(pack_file.name)
+        if owner == project:
+            packs.append((generation, pack_file.name))
+    return [name for _, name in sorted(packs)]
+
+def iter_pack_records(pack_file: Path):
+    """顺序扫描包文件，逐条返回 (hash, 格式, 数据偏移, 长度)；忽略写入中断留下的不完整尾部"""
+    with open(pack_file, 'rb') as f:
+        while True:
+            header = f.read(PACK_RECORD.size)
+            if len(header) < PACK_RECORD.size:
+                return
+            digest, codec_index, length = PACK_RECORD.unpack(header)
+            offset = f.tell()
+            f.seek(length, os.SEEK_CUR)
+            if f.tell() > os.fstat(f.fileno()).st_size or codec_index >= len(PACK_CODECS):
+                return
+            yield digest.hex(), PACK_CODECS[codec_index], offset, length
+
+def append_pack_records(conn, pack_name: str, records) -> int:
+    """在写事务中把 (hash, 格式, 编码数据) 追加到包文件并更新索引位置，返回追加的字节数"""
+    entries = []
+    with open(PACKS_DIR / pack_name, 'ab') as pack:
+        pack.seek(0, os.SEEK_END)
+        start = offset = pack.tell()
+        for chunk_hash, codec, encoded in records:
+            pack.write(PACK_RECORD.pack(bytes.fromhex(chunk_hash), PACK_CODECS.index(codec), len(encoded)))
+            pack.write(encoded)
+            entries.append((pack_name, offset + PACK_RECORD.size, len(encoded), chunk_hash))
+            offset += PACK_RECORD.size + len(encoded)
+        pack.flush()
+        os.fsync(pack.fileno())
+    conn.executemany("UPDATE chunks SET pack = ?, pack_offset = ?, stored_size = ? WHERE hash = ?", entries)
+    return offset - start
+
+def load_manifest(manifest_file: Path) -> dict:
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_manifest(manifest_file: Path, manifest: dict):
+    """原子改写快照清单"""
+    tmp_file = manifest_file.parent / f".{manifest_file.name}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+
+def manifest_chunks(manifest: dict) -> list:
+    """清单引用的所有分块：完整快照为顺序分块，增量快照为变化的页"""
+    if manifest.get('type') == 'delta':
+        return list(manifest['pages'].values())
+    return manifest['chunks']
+
+def manifest_blocks(manifest: dict) -> list:
+    """快照完整内容按 CHUNK_SIZE 划分的各块哈希（增量快照单独记录，便于不还原就比较内容）"""
+    return manifest['blocks'] if manifest.get('type') == 'delta' else manifest['chunks']
+
+def load_chain(manifest_file: Path) -> list:
+    """读取快照链 [快照, 基准, ..., 关键帧]，基准与快照位于同一目录"""
+    chain = []
+    seen = set()
+    while True:
+        if manifest_file.name in seen:
+            raise IOError(f"快照链存在循环: {manifest_file.name}")
+        seen.add(manifest_file.name)
+        try:
+            manifest = load_manifest(manifest_file)
+        except FileNotFoundError:
+            raise IOError(f"快照链缺少基准快照: {manifest_file.name}")
+        chain.append(manifest)
+        if manifest.get('type') != 'delta':
+            return chain
+        manifest_file = manifest_file.parent / manifest['base']
+
+def sqlite_page_size(header: bytes) -> int:
+    """由 SQLite 文件头偏移 16 处读取页大小（1 表示 65536），不是合法的数据库时返回 0"""
+    if len(header) < 18 or not header.startswith(b"SQLite format 3\x00"):
+        return 0
+    page_size = int.from_bytes(header[16:18], 'big')
+    return 65536 if page_size == 1 else page_size
+
+def read_snapshot_block(conn, chain: list, index: int) -> bytes:
+    """只还原快照的第 index 个 CHUNK_SIZE 块：从关键帧对应的分块开始叠加各层变化的页"""
+    keyframe = chain[-1]
+    start = index * CHUNK_SIZE
+    block = bytearray(read_chunk(conn, keyframe['chunks'][index])) if index < len(keyframe['chunks']) else bytearray()
+    for manifest in reversed(chain[:-1]):
+        page_size = manifest['page_size']
+        first = start // page_size
+        for page_no in range(first, first + CHUNK_SIZE // page_size):
+            page_hash = manifest['pages'].get(str(page_no))
+            if page_hash:
+                offset = page_no * page_size - start
+                if len(block) < offset:
+                    block.extend(bytes(offset - len(block)))
+                block[offset:offset + page_size] = read_chunk(conn, page_hash)
+        del block[max(manifest['size'] - start, 0):]
+    return bytes(block)
+
+def store_snapshot(src_path, manifest_file: Path, codec: Optional[str] = None, release: Optional[list] = None):
+    """将数据库按块压缩写入分块存储，并生成快照清单（已存在的分块只增加引用）
+
+    清单在同一个写事务中写入（release 为被替换的旧清单引用的分块，一并释放），
+    持有写锁的一方看到的清单与引用计数总是一致的
+    """
+    codec = codec or SNAPSHOT_CODEC
+    written = False
+    conn = open_store()
+    try:
+        # 持有写锁直到引用计数更新完成，避免与并发的释放操作竞争
+        conn.execute("BEGIN IMMEDIATE")
+        hashes = []
+        total = 0
+        stored = 0
+        for chunk_hash, data in iter_db_chunks(src_path):
+            stored += put_chunk(conn, chunk_hash, data, codec)
+            hashes.append(chunk_hash)
+            total += len(data)
+        if release:
+            release_refs(conn, release)
+        manifest = {
+            'version': 1,
+            'size': total,
+            'chunk_size': CHUNK_SIZE,
+            'codec': codec,
+            'stored_size': stored,
+            'chunks': hashes
+        }
+        write_manifest(manifest_file, manifest)
+        written = True
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+            if written and not release:
+                manifest_file.unlink(missing_ok=True)
+        raise
+    finally:
+        conn.close()
+    return manifest
+
+def store_delta_snapshot(src_path: Path, base_file: Path, manifest_file: Path, codec: Optional[str] = None):
+    """相对基准快照只存储变化的数据库页，生成增量清单；需要完整关键帧时返回 None"""
+    codec = codec or SNAPSHOT_CODEC
+    try:
+        chain = load_chain(base_file)
+    except (IOError, ValueError, KeyError):
+        return None
+    if len(chain) >= DELTA_KEYFRAME_INTERVAL:
+        return None
+    with open(src_path, 'rb') as f:
+        page_size = sqlite_page_size(f.read(100))
+    if not page_size:
+        return None
+    size = src_path.stat().st_size
+    base_blocks = manifest_blocks(chain[0])
+    
+    written = False
+    conn = open_store()
+    try:
+        # 第一遍：先比较块哈希，只有内容不同的块才还原基准的对应部分逐页比较
+        blocks = []
+        changed = []
+        for index, (block_hash, data) in enumerate(iter_db_chunks(src_path)):
+            blocks.append(block_hash)
+            if index < len(base_blocks) and base_blocks[index] == block_hash:
+                continue
+            try:
+                base_data = read_snapshot_block(conn, chain, index) if index < len(base_blocks) else b''
+            except IOError:
+                # 基准的分块已随基准一起释放（并发删除），改存关键帧
+                return None
+            if index == 0 and sqlite_page_size(base_data[:100]) != page_size:
+                return None
+            for offset in range(0, len(data), page_size):
+                if data[offset:offset + page_size] != base_data[offset:offset + page_size]:
+                    changed.append((index * CHUNK_SIZE + offset) // page_size)
+            if len(changed) * page_size > size * DELTA_MAX_RATIO:
+                return None
+        
+        # 第二遍：只重新读取变化的页写入分块存储，清单在同一个写事务中写入
+        conn.execute("BEGIN IMMEDIATE")
+        # 第一遍没有持有写锁，期间基准可能被删除或改接（rebase_dependents）；基准链变化时改存关键帧
+        try:
+            current = load_chain(base_file)
+        except (IOError, ValueError, KeyError):
+            current = None
+        if current != chain:
+            conn.execute("ROLLBACK")
+            return None
+        pages = {}
+        stored = 0
+        with open(src_path, 'rb') as f:
+            for page_no in changed:
+                f.seek(page_no * page_size)
+                data = f.read(page_size)
+                page_hash = hashlib.sha256(data).hexdigest()
+                stored += put_chunk(conn, page_hash, data, codec)
+                pages[str(page_no)] = page_hash
+        manifest = {
+            'version': 1,
+            'type': 'delta',
+            'base': base_file.name,
+            'size': size,
+            'chunk_size': CHUNK_SIZE,
+            'page_size': page_size,
+            'codec': codec,
+            'stored_size': stored,
+            'pages': pages,
+            'blocks': blocks
+        }
+        write_manifest(manifest_file, manifest)
+        written = True
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+            if written:
+                manifest_file.unlink(missing_ok=True)
+        raise
+    finally:
+        conn.close()
+    return manifest
+
+def release_refs(conn, hashes) -> int:
+    """在写事务中释放对分块的引用，删除不再被引用的分块（包文件中的记录成为死记录，打包时清理）
+
+    返回引用计数降为 0 的分块的磁盘大小（字节）；仍被其他快照引用的分块不计入
+    """
+    for chunk_hash, count in Counter(hashes).items():
+        conn.execute("UPDATE chunks SET refs = refs - ? WHERE hash = ?", (count, chunk_hash))
+    unreferenced = conn.execute("SELECT hash, codec, stored_size FROM chunks WHERE refs <= 0").fetchall()
+    for chunk_hash, codec, _ in unreferenced:
+        chunk_path(chunk_hash, codec).unlink(missing_ok=True)
+    conn.execute("DELETE FROM chunks WHERE refs <= 0")
+    return sum(stored_size or 0 for _, _, stored_size in unreferenced)
+
+def release_snapshot(manifest_file: Path) -> int:
+    """释放快照对分块的引用，删除不再被引用的分块和清单（清单在同一个写事务中删除），返回释放的字节数"""
+    conn = open_store()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            manifest = load_manifest(manifest_file)
+        except FileNotFoundError:
+            conn.execute("ROLLBACK")
+            return 0
+        freed = release_refs(conn, manifest_chunks(manifest))
+        manifest_file.unlink()
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return freed
+
+def restore_snapshot(manifest_file: Path, target):
+    """按清单逐块解压拼装，还原出完整的数据库文件（增量快照从关键帧开始逐层叠加变化的页）"""
+    chain = load_chain(manifest_file)
+    
+    conn = open_store()
+    try:
+        with open(target, 'wb') as out:
+            for chunk_hash in chain[-1]['chunks']:
+                out.write(read_chunk(conn, chunk_hash))
+            for manifest in reversed(chain[:-1]):
+                page_size = manifest['page_size']
+                for page_no, page_hash in manifest['pages'].items():
+                    out.seek(int(page_no) * page_size)
+                    out.write(read_chunk(conn, page_hash))
+                out.truncate(manifest['size'])
+    finally:
+        conn.close()
+
+def rebase_dependents(manifest_file: Path):
+    """删除快照前压缩快照链：以它为基准的增量快照并入它的页、改接到它的基准上；
+    删除的是关键帧时，后续增量快照还原后重新存为关键帧"""
+    try:
+        manifest = load_manifest(manifest_file)
+    except FileNotFoundError:
+        return
+    
+    for child_file in manifest_file.parent.glob("*.manifest.json"):
+        if child_file == manifest_file:
+            continue
+        try:
+            child = load_manifest(child_file)
+        except (OSError, ValueError):
+            continue
+        if child.get('type') != 'delta' or child.get('base') != manifest_file.name:
+            continue
+        
+        if manifest.get('type') == 'delta':
+            # 子快照自己的页优先；超出子快照大小的页已被截断，不再继承
+            page_size = child['page_size']
+            inherited = {page_no: page_hash for page_no, page_hash in manifest['pages'].items()
+                         if page_no not in child['pages'] and int(page_no) * page_size < child['size']}
+            pages = {**inherited, **child['pages']}
+            conn = open_store()
+            try:
+                # 改写后的清单与增加的引用在同一个写事务中生效
+                conn.execute("BEGIN IMMEDIATE")
+                for page_hash in inherited.values():
+                    conn.execute("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", (page_hash,))
+                stored_sizes = {}
+                for page_hash in set(pages.values()):
+                    row = conn.execute("SELECT stored_size FROM chunks WHERE hash = ?", (page_hash,)).fetchone()
+                    stored_sizes[page_hash] = row[0] if row else 0
+                child.update({
+                    'base': manifest['base'],
+                    'pages': dict(sorted(pages.items(), key=lambda item: int(item[0]))),
+                    'stored_size': sum(stored_sizes[page_hash] for page_hash in pages.values())
+                })
+                write_manifest(child_file, child)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+        else:
+            staged_db = child_file.parent / f".{child_file.name}.staging.db"
+            try:
+                restore_snapshot(child_file, staged_db)
+                # 新关键帧的写入与旧增量页的释放在同一个写事务中完成
+                child = store_snapshot(staged_db, child_file, child['codec'], release=manifest_chunks(child))
+            finally:
+                discard_staged(staged_db)
+        
+        for meta in query_sessions(project_dir=child_file.parent.name):
+            if meta.get('db_file') == child_file.name:
+                meta['stored_kb'] = child['stored_size'] / 1024
+                write_metadata(meta['meta_file'], meta)
+
+def materialize_snapshot(meta: dict, target) -> Optional[dict]:
+    """将保存的会话还原为数据库文件（兼容旧的完整 .db 快照），整文件复制时返回复制策略与吞吐量"""
+    snapshot_file = meta['project_dir'] / meta['db_file']
+    if meta.get('storage') == 'chunked':
+        restore_snapshot(snapshot_file, target)
+        return None
+    return copy_file(snapshot_file, target)
+
+def remove_session_files(meta: dict) -> int:
+    """删除会话的所有文件，分块快照只释放引用
+
+    返回快照实际释放的字节数：分块快照只计引用计数降为 0 的分块，旧的完整 .db 快照计整个文件
+    """
+    project_dir = meta['project_dir']
+    freed = 0
+    if meta.get('storage') == 'chunked':
+        # 先让依赖它的增量快照脱离，再释放引用
+        rebase_dependents(project_dir / meta['db_file'])
+        freed = release_snapshot(project_dir / meta['db_file'])
+    elif meta.get('db_file') and (project_dir / meta['db_file']).exists():
+        freed = (project_dir / meta['db_file']).stat().st_size
+    for name in [meta.get('db_file'), meta.get('json_file')]:
+        if name and (project_dir / name).exists():
+            (project_dir / name).unlink()
+    if meta['meta_file'].exists():
+        meta['meta_file'].unlink()
+    return freed
+
+def rebuild_store_refs():
+    """根据所有快照清单重新计算分块引用计数，并清理无引用的分块
+
+    先取得存储写锁再扫描清单：快照的写入和释放都在写锁内同时更新清单与引用计数，持锁期间看到的清单是完整的。
+    仍有引用（refs > 0）但没有清单引用的分块保留原记录；扫描开始后才写入的文件不会被删除
+    """
+    started = time.time()
+    freed = 0
+    conn = open_store()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        refs = Counter()
+        for manifest_file in SESSIONS_DIR.glob("*/*.manifest.json"):
+            if manifest_file.parent.name.startswith('.'):
+                continue
+            try:
+                refs.update(manifest_chunks(load_manifest(manifest_file)))
+            except Exception as e:
+                print(f"Error reading {manifest_file}: {e}")
+        
+        rows = {row[0]: row[1:] for row in
+                conn.execute("SELECT hash, size, refs, codec, stored_size, pack, pack_offset, tried_codec FROM chunks")}
+        live = set(refs) | {chunk_hash for chunk_hash, row in rows.items() if row[1] > 0}
+        
+        # 现有记录的位置仍然有效时沿用，否则从散放文件和包文件中重新查找
+        located = {}
+        for chunk_hash in live & set(rows):
+            size, _, codec, stored_size, pack, pack_offset, _ = rows[chunk_hash]
+            if (PACKS_DIR / pack).exists() if pack else chunk_path(chunk_hash, codec).exists():
+                located[chunk_hash] = (size, codec, stored_size, pack, pack_offset)
+        
+        def removable(path: Path) -> bool:
+            try:
+                return path.stat().st_mtime < started
+            except FileNotFoundError:
+                return False
+        
+        for chunk_file in (STORE_DIR / "chunks").glob("*/*"):
+            chunk_hash, codec = parse_chunk_name(chunk_file.name)
+            if codec is not None and chunk_hash in live:
+                if chunk_hash not in located:
+                    size = rows[chunk_hash][0] if chunk_hash in rows else None
+                    if size is None:
+                        size = chunk_file.stat().st_size if codec == 'none' \
+                            else len(decode_chunk(chunk_file.read_bytes(), codec))
+                    located[chunk_hash] = (size, codec, chunk_file.stat().st_size, None, None)
+                    continue
+                if located[chunk_hash][3] is None and located[chunk_hash][1] == codec:
+                    continue
+            # 无引用、残留的临时文件，或重新压缩/打包中断留下的另一份副本
+            if removable(chunk_file):
+                chunk_file.unlink()
+                freed += 1
+        
+        # 包文件从新到旧扫描，同一分块只登记一次；没有任何有效记录的包文件直接删除
+        pack_files = sorted(PACKS_DIR.glob("*.pack"), key=lambda f: parse_pack_name(f.name)[1] or 0, reverse=True)
+        for pack_file in pack_files:
+            for chunk_hash, codec, offset, length in iter_pack_records(pack_file):
+                if chunk_hash not in live or chunk_hash in located:
+                    continue
+                size = rows[chunk_hash][0] if chunk_hash in rows else None
+                if size is None:
+                    with open(pack_file, 'rb') as f:
+                        f.seek(offset)
+                        size = len(decode_chunk(f.read(length), codec))
+                located[chunk_hash] = (size, codec, length, pack_file.name, offset)
+        used_packs = {location[3] for location in located.values()}
+        for pack_file in pack_files:
+            if pack_file.name not in used_packs and removable(pack_file):
+                pack_file.unlink()
+                freed += 1
+        
+        conn.execute("DELETE FROM chunks")
+        conn.executemany(
+            "INSERT INTO chunks (hash, size, refs, codec, stored_size, pack, pack_offset, tried_codec) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(chunk_hash, size, refs[chunk_hash] if chunk_hash in refs else rows[chunk_hash][1],
+              codec, stored_size, pack, pack_offset, rows[chunk_hash][6] if chunk_hash in rows else None)
+             for chunk_hash, (size, codec, stored_size, pack, pack_offset) in located.items()]
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return len(refs), freed
+
+def db_fingerprint(db_path: Path) -> dict:
+    """读取数据库的廉价指纹：文件大小/mtime、头部修改计数器、WAL 大小/mtime/salt"""
+    stat = db_path.stat()
+    with open(db_path, 'rb') as f:
+        header = f.read(100)
+    fingerprint = {
+        'db_size': stat.st_size,
+        'db_mtime_ns': stat.st_mtime_ns,
+        # 文件头偏移 24 处的 4 字节 file change counter（WAL 模式下仅在 checkpoint 时变化）
+        'change_counter': int.from_bytes(header[24:28], 'big') if len(header) >= 28 else 0,
+        'wal_size': 0,
+        'wal_mtime_ns': 0,
+        'wal_salt': None
+    }
+    
+    wal_file = Path(str(db_path) + '-wal')
+    if wal_file.exists():
+        wal_stat = wal_file.stat()
+        with open(wal_file, 'rb') as f:
+            wal_header = f.read(32)
+        fingerprint['wal_size'] = wal_stat.st_size
+        fingerprint['wal_mtime_ns'] = wal_stat.st_mtime_ns
+        # WAL 头偏移 16 处的两个 salt 在每次 WAL 重置时改变
+        fingerprint['wal_salt'] = wal_header[16:24].hex() if len(wal_header) >= 24 else None
+    
+    return fingerprint
+
+def same_fingerprint(a: dict, b: dict) -> bool:
+    return bool(a) and bool(b) and all(a.get(k) == b.get(k) for k in CHEAP_FINGERPRINT_KEYS)
+
+def file_content_hash(path: Path) -> str:
+    """流式计算文件内容的 BLAKE2b 哈希"""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE * 16)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def db_matches_snapshot(db_path: Path, meta: dict) -> bool:
+    """判断数据库内容是否与已保存的快照一致"""
+    snapshot_file = meta['project_dir'] / meta['db_file']
+    if not snapshot_file.exists():
+        return False
+    
+    if meta.get('storage') == 'chunked':
+        # 分块快照的清单本身就是内容哈希，无需再读取旧快照
+        manifest = load_manifest(snapshot_file)
+        if manifest['size'] != db_path.stat().st_size:
+            return False
+        return [h for h, _ in iter_db_chunks(db_path)] == manifest_blocks(manifest)
+    
+    def get_db_hash(path):
+        md5 = hashlib.md5()
+        for _, data in iter_db_chunks(path):
+            md5.update(data)
+        return md5.hexdigest()
+    
+    return get_db_hash(db_path) == get_db_hash(snapshot_file)
+
+def iter_export_tables(conn):
+    """逐表返回 (表名, 行迭代器)，行通过游标按批读取，不会一次性载入整张表"""
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    for table_name in tables:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT * FROM "{}"'.format(table_name.replace('"', '""')))
+        except sqlite3.Error:
+            continue
+        column_names = [description[0] for description in cursor.description]
+        
+        def rows(cursor=cursor, column_names=column_names):
+            while True:
+                batch = cursor.fetchmany(EXPORT_BATCH_ROWS)
+                if not batch:
+                    break
+                for row in batch:
+                    yield dict(zip(column_names, row))
+        
+        yield table_name, rows()
+
+def export_db_to_json(db_path, json_file):
+    """流式导出数据库到 JSON（输出格式与 json.dump(indent=2) 一致）"""
+    try:
+        conn = sqlite3.connect(str(db_path))
+        try:
+            with open(json_file, 'w', encoding='utf-8') as f:
+                f.write('{')
+                first_table = True
+                for table_name, rows in iter_export_tables(conn):
+                    f.write(('\n' if first_table else ',\n') + '  ' +
+                            json.dumps(table_name, ensure_ascii=False) + ': [')
+                    first_table = False
+                    first_row = True
+                    for row in rows:
+                        dumped = json.dumps(row, indent=2, ensure_ascii=False, default=str)
+                        f.write(('\n' if first_row else ',\n') +
+                                '\n'.join('    ' + line for line in dumped.split('\n')))
+                        first_row = False
+                    f.write(']' if first_row else '\n  ]')
+                f.write('}' if first_table else '\n}')
+        finally:
+            conn.close()
+        return True
+    except Exception as e:
+        print(f"Export error: {e}")
+        return False
+
+def export_db_to_ndjson(db_path, out_dir):
+    """按表流式导出为 NDJSON（每张表一个文件，每行一条记录）"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(db_path))
+    try:
+        for table_name, rows in iter_export_tables(conn):
+            safe_table = "".join(c if c.isalnum() or c in '-_.' else '_' for c in table_name)
+            with open(out_dir / f"{safe_table}.ndjson", 'w', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+    finally:
+        conn.close()
+
+def snapshot_signature(meta: dict) -> str:
+    """快照内容签名：用于判断缓存的导出是否仍然对应当前快照"""
+    snapshot_file = meta['project_dir'] / meta['db_file']
+    if meta.get('storage') == 'chunked':
+        with open(snapshot_file, 'rb') as f:
+            data = f.read()
+        manifest = json.loads(data)
+        if manifest.get('type') == 'delta':
+            # 压缩快照链会改写增量清单（基准和页），但快照内容即各块哈希不变
+            return hashlib.sha256(json.dumps(manifest['blocks']).encode()).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+    stat = snapshot_file.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def ensure_json_export(meta: dict) -> Path:
+    """按需生成 JSON 导出并缓存在快照旁，快照未变化时直接复用"""
+    project_dir = meta['project_dir']
+    signature = snapshot_signature(meta)
+    if meta.get('json_file') and meta.get('json_source') == signature:
+        json_file = project_dir / meta['json_file']
+        if json_file.exists():
+            return json_file
+    
+    base_name = meta['meta_file'].name[:-len('.meta.json')]
+    json_file = project_dir / f"{base_name}.json"
+    staged_db = project_dir / f".export_{meta['timestamp']}.staging.db"
+    staged_json = project_dir / f".{base_name}.json.tmp"
+    try:
+        materialize_snapshot(meta, staged_db)
+        if not export_db_to_json(staged_db, staged_json):
+            raise IOError("JSON 导出失败")
+        os.replace(staged_json, json_file)
+    finally:
+        discard_staged(staged_db)
+        if staged_json.exists():
+            staged_json.unlink()
+    
+    meta['json_file'] = json_file.name
+    meta['json_source'] = signature
+    write_metadata(meta['meta_file'], meta)
+    return json_file
+
+def json_export_is_fresh(meta: dict) -> bool:
+    """缓存的 JSON 导出是否存在且对应当前快照"""
+    if not meta.get('json_file') or meta.get('json_source') != snapshot_signature(meta):
+        return False
+    return (meta['project_dir'] / meta['json_file']).exists()
+
+def quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+def table_diff_key(conn, table_name: str) -> List[str]:
+    """表的比较键：声明的主键列（按主键顺序），没有主键时使用 rowid"""
+    columns = sorted((row[5], row[1]) for row in conn.execute(f"PRAGMA table_info({quote_identifier(table_name)})")
+                     if row[5])
+    return [name for _, name in columns] or ['rowid']
+
+def table_has_rowid(conn, table_name: str) -> bool:
+    """表是否有 rowid：WITHOUT ROWID 表在建表语句末尾的表选项中声明"""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone()
+    return not (row and row[0] and re.search(r'\)[^)]*\bWITHOUT\s+ROWID\b[^)]*$', row[0], re.IGNORECASE))
+
+def iter_keyed_rows(conn, table_name: str, key: List[str]):
+    """按比较键升序流式读取，返回 (列名, (键, 行) 迭代器)；顺序由索引（或 SQLite 的外部排序）保证，不在内存中排序"""
+    key_columns = ['rowid' if column == 'rowid' else quote_identifier(column) for column in key]
+    cursor = conn.execute(f"SELECT {', '.join(key_columns)}, * FROM {quote_identifier(table_name)} "
+                          f"ORDER BY {', '.join(column + ' COLLATE BINARY' for column in key_columns)}")
+    columns = [description[0] for description in cursor.description][len(key):]
+    
+    def rows():
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_ROWS)
+            if not batch:
+                break
+            for row in batch:
+                yield row[:len(key)], row[len(key):]
+    
+    return columns, rows()
+
+def sqlite_order(key: tuple) -> tuple:
+    # 与 SQLite 的排序一致：NULL < 数值 < 文本 < BLOB，文本按 UTF-8 字节（即码点）比较
+    return tuple((0, 0) if v is None else (1, v) if isinstance(v, (int, float)) else (2, v) if isinstance(v, str)
+                 else (3, bytes(v)) for v in key)
+
+def diff_value(value):
+    """转换为可 JSON 序列化的值：BLOB 按 UTF-8 解码（Cursor 的消息为 JSON 文本），过长的值截断"""
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return f"<{len(value)} bytes>"
+    if isinstance(value, str) and len(value) > DIFF_MAX_VALUE:
+        return value[:DIFF_MAX_VALUE] + f"…（共 {len(value)} 字符）"
+    return value
+
+def diff_table(conn_a, conn_b, table_name: str, limit: int) -> dict:
+    """以比较键对两个版本的表做归并连接，统计并列出新增、删除和修改的行"""
+    key = table_diff_key(conn_b if conn_b else conn_a, table_name)
+    if conn_a and conn_b and table_diff_key(conn_a, table_name) != key:
+        key = ['rowid']  # 主键定义变化时按 rowid 对齐
+        if not (table_has_rowid(conn_a, table_name) and table_has_rowid(conn_b, table_name)):
+            # WITHOUT ROWID 表没有 rowid，主键又不同，无法对齐行
+            return {"key": [], "added": 0, "removed": 0, "changed": 0, "unchanged": 0,
+                    "rows": {"added": [], "removed": [], "changed": []},
+                    "skipped": "WITHOUT ROWID 表的主键定义已变化，无法逐行比较"}
+    columns_a, rows_a = iter_keyed_rows(conn_a, table_name, key) if conn_a else ([], iter(()))
+    columns_b, rows_b = iter_keyed_rows(conn_b, table_name, key) if conn_b else ([], iter(()))
+    result = {"key": key, "added": 0, "removed": 0, "changed": 0, "unchanged": 0,
+              "rows": {"added": [], "removed": [], "changed": []}}
+    
+    def record(kind, row_key, entry):
+        result[kind] += 1
+        if len(result["rows"][kind]) < limit:
+            result["rows"][kind].append(dict(key=dict(zip(key, map(diff_value, row_key))), **entry))
+    
+    a, b = next(rows_a, None), next(rows_b, None)
+    while a is not None or b is not None:
+        order = 0
+        if a is not None and b is not None:
+            key_a, key_b = sqlite_order(a[0]), sqlite_order(b[0])
+            order = (key_a > key_b) - (key_a < key_b)
+        if b is None or (a is not None and order < 0):
+            record("removed", a[0], {"row": {c: diff_value(v) for c, v in zip(columns_a, a[1])}})
+            a = next(rows_a, None)
+        elif a is None or order > 0:
+            record("added", b[0], {"row": {c: diff_value(v) for c, v in zip(columns_b, b[1])}})
+            b = next(rows_b, None)
+        else:
+            if columns_a == columns_b and a[1] == b[1]:
+                result["unchanged"] += 1
+            else:
+                before, after = dict(zip(columns_a, a[1])), dict(zip(columns_b, b[1]))
+                changed = [c for c in dict.fromkeys(columns_a + columns_b) if before.get(c) != after.get(c)]
+                if changed:
+                    record("changed", a[0], {
+                        "columns": changed,
+                        "before": {c: diff_value(before.get(c)) for c in changed},
+                        "after": {c: diff_value(after.get(c)) for c in changed}
+                    })
+                else:
+                    result["unchanged"] += 1
+            a, b = next(rows_a, None), next(rows_b, None)
+    return result
+
+def diff_databases(db_a, db_b, limit: int = DIFF_ROW_LIMIT) -> dict:
+    """逐表比较两个数据库（db_a 为旧版本），返回各表的差异和汇总计数"""
+    conn_a = sqlite3.connect(f"{Path(db_a).resolve().as_uri()}?mode=ro", uri=True)
+    conn_b = sqlite3.connect(f"{Path(db_b).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        sql = "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        tables_a = [row[0] for row in conn_a.execute(sql)]
+        tables_b = [row[0] for row in conn_b.execute(sql)]
+        tables = {}
+        for table_name in sorted(set(tables_a) | set(tables_b)):
+            tables[table_name] = diff_table(conn_a if table_name in tables_a else None,
+                                            conn_b if table_name in tables_b else None, table_name, limit)
+    finally:
+        conn_a.close()
+        conn_b.close()
+    
+    summary = {kind: sum(table[kind] for table in tables.values())
+               for kind in ("added", "removed", "changed", "unchanged")}
+    summary["tables_added"] = [name for name in tables if name not in tables_a]
+    summary["tables_removed"] = [name for name in tables if name not in tables_b]
+    summary["tables_skipped"] = [name for name, table in tables.items() if table.get("skipped")]
+    return {"summary": summary, "tables": tables}
+
+def next_timestamp(project_sessions_dir: Path) -> str:
+    """生成会话 ID；同一秒内已有会话时顺延到下一秒，避免 ID 冲突（调用方需持有项目串行权）"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    while list(project_sessions_dir.glob(f"{timestamp}_*.meta.json")):
+        time.sleep(0.2)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return timestamp
+
+# 指标（Web 后端通过 /api/metrics 输出；CLI 进程中同样记录，只是不输出）
+REQUEST_TIMINGS = contextvars.ContextVar('request_timings', default=None)
+
+class Metrics:
+    """进程内的计数器、仪表和直方图，按 Prometheus 文本格式输出（不依赖 prometheus_client）"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}  # 名称 -> (类型, 说明)
+        self.values = {}    # 名称 -> {标签元组: 值}；直方图的值为 [各桶累计次数..., 总和, 次数]
+    
+    def describe(self, name: str, kind: str, text: str):
+        self.families[name] = (kind, text)
+        self.values.setdefault(name, {})
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+    
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+    
+    def reset(self, name: str):
+        """清空某个仪表的所有序列（如已删除的项目）"""
+        with self.lock:
+            self.values[name] = {}
+    
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = [0] * (len(METRICS_BUCKETS) + 2)
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    @contextmanager
+    def phase(self, operation: str, phase: str):
+        """记录一个阶段的耗时；在请求（或其提交的任务）中执行时同时计入该请求的 Server-Timing"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("cursor_sessions_phase_duration_seconds", elapsed, operation=operation, phase=phase)
+            timings = REQUEST_TIMINGS.get()
+            if timings is not None:
+                timings.append((f"{operation}.{phase}", elapsed))
+    
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, (kind, text) in self.families.items():
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f"{name}{format_labels(key)} {format_metric_value(value)}")
+                        continue
+                    for bound, count in zip(METRICS_BUCKETS, value):
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', repr(float(bound))),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {value[-1]}")
+                    lines.append(f"{name}_sum{format_labels(key)} {format_metric_value(value[-2])}")
+                    lines.append(f"{name}_count{format_labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in key) + "}"
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metric_value(value: float) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+metrics = Metrics()
+metrics.describe("cursor_sessions_phase_duration_seconds", "histogram",
+                 "Duration of each phase of save, auto-save, restore, list, export and cleanup")
+metrics.describe("cursor_sessions_auto_saves_total", "counter",
+                 "Auto-save attempts by result (saved, skipped_fingerprint, skipped_content)")
+metrics.describe("cursor_sessions_bytes_copied_total", "counter", "Bytes copied by snapshot, restore and export")
+metrics.describe("cursor_sessions_copy_bytes_total", "counter",
+                 "Bytes of whole-file copies by strategy (reflink, copy_file_range, sendfile, buffered)")
+
+def job_stage(job, start: float, end: float):
+    """将某个阶段内 0~1 的进度映射到任务总进度 [start, end]"""
+    if job is None:
+        return None
+    return lambda fraction: job.update(progress=start + (end - start) * fraction)
+
+# 全文搜索
+def open_search_index():
+    """打开全文搜索索引"""
+    conn = sqlite3.connect(str(SEARCH_DB_FILE), timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SEARCH_SCHEMA)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SEARCH_INDEX_VERSION:
+        # 旧版本的索引缺少新提取的内容：清空签名，下次同步时重新索引所有快照
+        conn.execute("UPDATE snapshots SET signature = ''")
+        conn.execute(f"PRAGMA user_version = {SEARCH_INDEX_VERSION}")
+    return conn
+
+def collect_json_text(value, out: list):
+    """收集 JSON 消息中 text / content 及标题字段下的字符串"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ('text', 'content', 'title', 'name') and isinstance(item, str):
+                out.append(item)
+            elif isinstance(item, (dict, list)):
+                collect_json_text(item, out)
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, str):
+                out.append(item)
+            else:
+                collect_json_text(item, out)
+
+def extract_search_text(value):
+    """从数据库中的单个值提取可搜索文本，返回 (role, text)；无法解码时返回 None"""
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            # 二进制（如 protobuf）：只保留其中较长的可读片段
+            runs = re.findall(r'[^\x00-\x08\x0b-\x1f\x7f\ufffd]{16,}', value.decode('utf-8', 'replace'))
+            return (None, '\n'.join(runs)[:SEARCH_MAX_TEXT]) if runs else None
+    if not isinstance(value, str):
+        return None
+    
+    text = value.strip()
+    # Cursor 的 meta 表以十六进制存储 JSON
+    if len(text) >= 4 and len(text) % 2 == 0 and re.fullmatch(r'[0-9a-fA-F]+', text):
+        try:
+            return extract_search_text(bytes.fromhex(text))
+        except ValueError:
+            pass
+    if text[:1] in ('{', '['):
+        try:
+            message = json.loads(text)
+        except ValueError:
+            message = None
+        if message is not None:
+            parts = []
+            collect_json_text(message, parts)
+            text = '\n'.join(part for part in parts if part.strip())
+            role = message.get('role') if isinstance(message, dict) else None
+            return (role, text[:SEARCH_MAX_TEXT]) if text else None
+    return (None, text[:SEARCH_MAX_TEXT]) if len(text) >= 2 else None
+
+def decode_json_value(value):
+    """把数据库中的值解码为 JSON（支持 meta 表的十六进制编码），不是 JSON 时返回 None"""
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    if len(text) >= 4 and len(text) % 2 == 0 and re.fullmatch(r'[0-9a-fA-F]+', text):
+        try:
+            text = bytes.fromhex(text).decode('utf-8').strip()
+        except (ValueError, UnicodeDecodeError):
+            return None
+    if text[:1] not in ('{', '['):
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+def message_timestamp(sources: List[dict]) -> Optional[str]:
+    """消息时间（ISO 格式）：Unix 秒或毫秒时间戳转换为本地时间，字符串原样保留"""
+    for source in sources:
+        for key in MESSAGE_TIME_KEYS:
+            value = source.get(key)
+            if isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                try:
+                    return datetime.fromtimestamp(value / 1000 if value > 1e11 else value).isoformat()
+                except (OverflowError, OSError, ValueError):
+                    return None
+            if isinstance(value, str) and value:
+                return value
+    return None
+
+def decode_message(value) -> Optional[dict]:
+    """把单个 blob 解码为规范化消息（角色、时间、正文、token 数、附件），不是对话消息时返回 None"""
+    message = decode_json_value(value)
+    if not isinstance(message, dict) or message.get('role') not in MESSAGE_ROLES:
+        return None
+    
+    content = message.get('content')
+    parts = content if isinstance(content, list) else [content]
+    texts, attachments = [], []
+    for part in parts:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict):
+            kind = part.get('type') or 'text'
+            if kind == 'text' and isinstance(part.get('text'), str):
+                texts.append(part['text'])
+                continue
+            # 工具调用、工具结果、推理过程、图片和文件：只保留类型、名称和大小，正文在原快照中
+            attachment = {'type': kind}
+            attachment.update({key: part[key] for key in MESSAGE_ATTACHMENT_KEYS if isinstance(part.get(key), str)})
+            attachment['size'] = len(json.dumps(part, ensure_ascii=False))
+            attachments.append(attachment)
+    for item in message.get('attachments') or []:
+        if isinstance(item, dict):
+            attachment = {'type': item.get('type') or 'file'}
+            attachment.update({key: item[key] for key in MESSAGE_ATTACHMENT_KEYS if isinstance(item.get(key), str)})
+            attachments.append(attachment)
+    
+    sources = [message] + [message[key] for key in ('metadata', 'providerOptions') if isinstance(message.get(key), dict)]
+    text = '\n'.join(part for part in texts if part.strip())[:SEARCH_MAX_TEXT]
+    tokens = None
+    for source in sources:
+        usage = source.get('usage')
+        if isinstance(usage, dict):
+            counted = [usage[key] for key in MESSAGE_TOKEN_KEYS
+                       if isinstance(usage.get(key), int) and not isinstance(usage.get(key), bool)]
+            if counted:
+                tokens = sum(counted)
+                break
+    return {
+        'role': message['role'],
+        'created_at': message_timestamp(sources),
+        'text': text,
+        'tokens': tokens if tokens is not None else (len(text.encode('utf-8')) + 3) // 4,
+        'tokens_estimated': tokens is None,
+        'attachments': attachments
+    }
+
+def blob_references(data: bytes, keys: dict) -> List[str]:
+    """按出现顺序列出节点（protobuf）中引用的 blob ID：以长度前缀存储的原始哈希或十六进制字符串"""
+    refs = []
+    pos = 0
+    while pos < len(data) - 1:
+        length = data[pos]
+        ref = keys.get(data[pos + 1:pos + 1 + length]) if length in (32, 64) else None
+        if ref:
+            refs.append(ref)
+            pos += 1 + length
+        else:
+            pos += 1
+    return refs
+
+def conversation_blob_ids(db) -> list:
+    """当前对话按顺序引用的消息 blob ID（同一条消息可以出现多次）
+
+    Cursor 的 blobs 表按内容哈希存储消息 JSON 和对话树节点（protobuf）。meta 中的 latestRootBlobId
+    指向当前对话的根节点，从它开始按引用顺序深度优先遍历，得到当前分支的消息；
+    没有根节点或无法解析时，按写入顺序返回所有消息。消息由 SQLite 按 JSON 的 role 字段识别，
+    不读入也不解码；节点在遍历到时才读取。
+    """
+    tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'blobs' not in tables:
+        return []
+    
+    root_id = None
+    if 'meta' in tables:
+        for (value,) in db.execute("SELECT value FROM meta"):
+            decoded = decode_json_value(value)
+            if isinstance(decoded, dict) and isinstance(decoded.get('latestRootBlobId'), str):
+                root_id = decoded['latestRootBlobId']
+                break
+    
+    # 1：消息；0：其他（二进制值可能是节点）；NULL：十六进制编码的文本，交给 decode_message 判断
+    roles = ', '.join('?' * len(MESSAGE_ROLES))
+    rows = db.execute(
+        "SELECT id, CASE WHEN json_valid(CAST(data AS TEXT)) "
+        f"THEN COALESCE(json_extract(CAST(data AS TEXT), '$.role') IN ({roles}), 0) "
+        "WHEN length(data) >= 4 AND CAST(data AS TEXT) NOT GLOB '*[^0-9a-fA-F]*' THEN NULL ELSE 0 END, "
+        "typeof(data) = 'blob' FROM blobs ORDER BY rowid", MESSAGE_ROLES
+    ).fetchall()
+    message_ids, nodes = [], set()
+    for blob_id, is_message, is_bytes in rows:
+        if is_message is None:
+            (data,) = db.execute("SELECT data FROM blobs WHERE id = ?", (blob_id,)).fetchone()
+            is_message = decode_message(data) is not None
+        if is_message:
+            message_ids.append(blob_id)
+        elif is_bytes:
+            nodes.add(blob_id)
+    if root_id not in nodes:
+        return message_ids
+    
+    messages = set(message_ids)
+    keys = {}
+    for blob_id in message_ids + list(nodes):
+        if not isinstance(blob_id, str):
+            continue
+        keys[blob_id.encode('utf-8')] = blob_id
+        if len(blob_id) == 64:
+            try:
+                keys[bytes.fromhex(blob_id)] = blob_id
+            except ValueError:
+                pass
+    
+    ordered, seen, stack = [], {root_id}, [root_id]
+    while stack:
+        blob_id = stack.pop()
+        if blob_id in messages:
+            ordered.append(blob_id)
+            continue
+        (data,) = db.execute("SELECT data FROM blobs WHERE id = ?", (blob_id,)).fetchone()
+        # 相同内容的消息共用一个 blob，可以出现多次；节点只展开一次，避免环
+        refs = [ref for ref in blob_references(data, keys) if ref in messages or ref not in seen]
+        seen.update(refs)
+        stack.extend(reversed(refs))
+    return ordered or message_ids
+
+def extract_messages(db) -> List[dict]:
+    """从会话数据库提取对话消息，按对话顺序返回（按批读取和解码消息 blob）"""
+    order = conversation_blob_ids(db)
+    unique_ids = list(dict.fromkeys(order))
+    messages = {}
+    for start in range(0, len(unique_ids), MESSAGE_BATCH):
+        batch = unique_ids[start:start + MESSAGE_BATCH]
+        for blob_id, data in db.execute(
+                f"SELECT id, data FROM blobs WHERE id IN ({', '.join('?' * len(batch))})", batch):
+            messages[blob_id] = decode_message(data)
+    return [messages[blob_id] for blob_id in order if messages.get(blob_id)]
+
+def store_message(conn, message: dict) -> int:
+    """写入规范化消息（相同消息只存一次），返回消息 ID"""
+    attachments = json.dumps(message['attachments'], ensure_ascii=False, sort_keys=True)
+    message_hash = hashlib.sha1(json.dumps(
+        [message['role'], message['created_at'], message['text'], attachments], ensure_ascii=False
+    ).encode('utf-8')).hexdigest()
+    found = conn.execute("SELECT id FROM messages WHERE hash = ?", (message_hash,)).fetchone()
+    if found:
+        return found[0]
+    return conn.execute(
+        "INSERT INTO messages (hash, role, created_at, text, tokens, tokens_estimated, attachments) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (message_hash, message['role'], message['created_at'], message['text'],
+         message['tokens'], int(message['tokens_estimated']), attachments)
+    ).lastrowid
+
+def index_snapshot(conn, meta: dict, signature: str):
+    """将单个快照中的文本写入搜索索引（已索引过的相同文本只记录引用）"""
+    staged_db = meta['project_dir'] / f".search_{meta['timestamp']}.staging.db"
+    try:
+        materialize_snapshot(meta, staged_db)
+        db = sqlite3.connect(f"{staged_db.resolve().as_uri()}?mode=ro", uri=True)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            key = (meta['project_dir'].name, meta['meta_file'].name)
+            remove_indexed_snapshot(conn, key)
+            snapshot_id = conn.execute(
+                "INSERT INTO snapshots (project_dir, meta_file, session_id, datetime, signature) "
+                "VALUES (?, ?, ?, ?, ?)",
+                key + (meta['timestamp'], meta.get('datetime', ''), signature)
+            ).lastrowid
+            for _, rows in iter_export_tables(db):
+                for row in rows:
+                    for value in row.values():
+                        extracted = extract_search_text(value)
+                        if not extracted:
+                            continue
+                        role, text = extracted
+                        text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                        found = conn.execute("SELECT id FROM blobs WHERE hash = ?", (text_hash,)).fetchone()
+                        if found:
+                            blob_id = found[0]
+                        else:
+                            blob_id = conn.execute("INSERT INTO blobs (hash, role) VALUES (?, ?)",
+                                                   (text_hash, role)).lastrowid
+                            conn.execute("INSERT INTO blob_text (rowid, content) VALUES (?, ?)", (blob_id, text))
+                        conn.execute("INSERT OR IGNORE INTO snapshot_blobs (snapshot_id, blob_id) VALUES (?, ?)",
+                                     (snapshot_id, blob_id))
+            conn.executemany("INSERT INTO snapshot_messages (snapshot_id, seq, message_id) VALUES (?, ?, ?)",
+                             [(snapshot_id, seq, store_message(conn, message))
+                              for seq, message in enumerate(extract_messages(db))])
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+    finally:
+        discard_staged(staged_db)
+
+def remove_indexed_snapshot(conn, key: tuple):
+    """删除快照的索引记录及其文本和消息引用（key 为 (项目目录, 元数据文件名)）"""
+    for table in ('snapshot_blobs', 'snapshot_messages'):
+        conn.execute(f"DELETE FROM {table} WHERE snapshot_id IN "
+                     "(SELECT id FROM snapshots WHERE project_dir = ? AND meta_file = ?)", key)
+    conn.execute("DELETE FROM snapshots WHERE project_dir = ? AND meta_file = ?", key)
+
+def sync_search_index(job=None) -> dict:
+    """增量同步搜索索引：索引新的或内容变化的快照，移除已删除快照的引用"""
+    conn = open_search_index()
+    try:
+        indexed = {(row[0], row[1]): row[2] for row in
+                   conn.execute("SELECT project_dir, meta_file, signature FROM snapshots")}
+        sessions = query_sessions()
+        current = {(meta['project_dir'].name, meta['meta_file'].name) for meta in sessions}
+        
+        gone = set(indexed) - current
+        if gone:
+            conn.execute("BEGIN IMMEDIATE")
+            for key in gone:
+                remove_indexed_snapshot(conn, key)
+            conn.execute("COMMIT")
+        
+        added = 0
+        # 按时间倒序，最新的快照最先可搜索
+        for i, meta in enumerate(sessions):
+            if job:
+                job.update(progress=i / len(sessions), message="建立搜索索引")
+            try:
+                signature = snapshot_signature(meta)
+                if indexed.get((meta['project_dir'].name, meta['meta_file'].name)) == signature:
+                    continue
+                index_snapshot(conn, meta, signature)
+                added += 1
+            except Exception as e:
+                print(f"Error indexing {meta['meta_file']}: {e}")
+        
+        # 不再被任何快照引用的文本和消息（重新索引内容变化的快照也会留下旧的文本和消息）
+        if added or gone:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM blob_text WHERE rowid IN (SELECT id FROM blobs WHERE id NOT IN "
+                         "(SELECT blob_id FROM snapshot_blobs))")
+            conn.execute("DELETE FROM blobs WHERE id NOT IN (SELECT blob_id FROM snapshot_blobs)")
+            conn.execute("DELETE FROM messages WHERE id NOT IN (SELECT message_id FROM snapshot_messages)")
+            conn.execute("COMMIT")
+    finally:
+        conn.close()
+    
+    return {"status": "success", "message": "搜索索引已更新", "indexed": added, "removed": len(gone)}
+
+def read_snapshot_messages(meta: dict, offset: int, limit: int) -> Optional[dict]:
+    """从消息存储分页读取快照的对话；快照尚未提取或内容已变化时返回 None"""
+    if not SEARCH_DB_FILE.exists():
+        return None
+    signature = snapshot_signature(meta)
+    conn = open_search_index()
+    try:
+        found = conn.execute("SELECT id, signature FROM snapshots WHERE project_dir = ? AND meta_file = ?",
+                             (meta['project_dir'].name, meta['meta_file'].name)).fetchone()
+        if not found or found[1] != signature:
+            return None
+        total = conn.execute("SELECT COUNT(*) FROM snapshot_messages WHERE snapshot_id = ?", (found[0],)).fetchone()[0]
+        rows = conn.execute(
+            "SELECT sm.seq, m.role, m.created_at, m.text, m.tokens, m.tokens_estimated, m.attachments "
+            "FROM snapshot_messages sm JOIN messages m ON m.id = sm.message_id "
+            "WHERE sm.snapshot_id = ? AND sm.seq >= ? ORDER BY sm.seq LIMIT ?",
+            (found[0], offset, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    return {
+        "session_id": meta['timestamp'],
+        "source": "index",
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "messages": [{
+            "seq": seq,
+            "role": role,
+            "created_at": created_at,
+            "text": text,
+            "tokens": tokens,
+            "tokens_estimated": bool(tokens_estimated),
+            "attachments": json.loads(attachments)
+        } for seq, role, created_at, text, tokens, tokens_estimated, attachments in rows]
+    }
+
+def search_query(q: str) -> str:
+    """将用户输入转为 FTS5 查询：每个词按短语匹配，多个词需同时出现"""
+    terms = q.split()
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def search_sessions(q: str, page: int = 1, page_size: int = SEARCH_PAGE_SIZE):
+    """全文搜索，按快照聚合并按相关度排序，返回 (总数, 当前页结果)"""
+    terms = q.split()
+    if not SEARCH_DB_FILE.exists() or not terms:
+        return 0, []
+    
+    # trigram 无法匹配少于 3 个字符的词，此时退回逐条子串扫描（无相关度排序）
+    substring_scan = SEARCH_TOKENIZER == 'trigram' and min(len(term) for term in terms) < 3
+    if substring_scan:
+        condition = ' AND '.join(['instr(content, ?) > 0'] * len(terms))
+        hits_sql = (f"SELECT rowid AS blob_id, 0 AS score, content AS snippet FROM blob_text "
+                    f"WHERE {condition}")
+        params = terms
+    else:
+        # LIMIT -1 阻止子查询被展开到聚合查询中（bm25/snippet 只能直接用于 MATCH 查询）
+        hits_sql = ("SELECT rowid AS blob_id, bm25(blob_text) AS score, "
+                    "snippet(blob_text, 0, ?, ?, '…', 24) AS snippet "
+                    "FROM blob_text WHERE blob_text MATCH ? LIMIT -1")
+        params = [SEARCH_MARK_START, SEARCH_MARK_END, search_query(q)]
+    
+    conn = open_search_index()
+    try:
+        rows = conn.execute(
+            f"WITH hits AS ({hits_sql}) "
+            "SELECT s.project_dir, s.meta_file, s.session_id, MIN(h.score) AS score, h.snippet, "
+            "COUNT(*) AS hits, COUNT(*) OVER () AS total "
+            "FROM hits h JOIN snapshot_blobs sb ON sb.blob_id = h.blob_id "
+            "JOIN snapshots s ON s.id = sb.snapshot_id "
+            "GROUP BY s.id ORDER BY score, s.datetime DESC LIMIT ? OFFSET ?",
+            params + [page_size, (page - 1) * page_size]
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    total = rows[0][6] if rows else 0
+    results = []
+    for project_dir, meta_file, session_id, score, snippet, hits, _ in rows:
+        if substring_scan:
+            snippet = plain_snippet(snippet, terms)
+        results.append({
+            "project_dir": project_dir,
+            "meta_file": meta_file,
+            "session_id": session_id,
+            "score": round(-score, 3),
+            "hits": hits,
+            "snippet": snippet
+        })
+    return total, results
+
+def plain_snippet(text: str, terms: List[str], width: int = 40) -> str:
+    """子串扫描结果的片段：截取第一个匹配附近的文本并加上高亮标记"""
+    pos = max(text.find(terms[0]), 0)
+    start, end = max(pos - width, 0), pos + len(terms[0]) + width
+    snippet = text[start:end]
+    for term in terms:
+        snippet = snippet.replace(term, SEARCH_MARK_START + term + SEARCH_MARK_END)
+    return ('…' if start > 0 else '') + snippet + ('…' if end < len(text) else '')
+
+def load_retention_policy() -> dict:
+    """读取保留策略（文件中的设置覆盖环境变量默认值）"""
+    policy = dict(RETENTION_DEFAULTS)
+    try:
+        with open(RETENTION_FILE, 'r', encoding='utf-8') as f:
+            policy.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading {RETENTION_FILE}: {e}")
+    return policy
+
+def snapshot_usage(meta: dict, dropped=()) -> tuple:
+    """快照占用的存储：返回 (自身清单的分块引用, 还原它需要的所有存储单元, {新分块: 相近的已有分块})
+
+    存储单元是分块哈希，旧的完整 .db 快照为文件路径。增量快照还需要快照链上基准的分块。
+    dropped 为同一项目中将被删除的快照清单文件名，按删除后改接的快照链计算（见 rebase_dependents）：
+    关键帧被删除时，链上最旧的保留快照会重新存为关键帧，需要它完整内容的各块（它原来的页随之释放）；
+    其中不在存储中的块是新写入的分块，大小按原关键帧同一位置（超出时为最后一个）的分块估算
+    """
+    snapshot_file = meta['project_dir'] / meta['db_file']
+    if meta.get('storage') != 'chunked':
+        return [snapshot_file], {snapshot_file}, {}
+    try:
+        chain = load_chain(snapshot_file)
+    except (IOError, ValueError, KeyError):
+        return [], set(), {}
+    names = [meta['db_file']] + [manifest['base'] for manifest in chain[:-1]]
+    keyframe = chain[-1]
+    similar = {}
+    if names[-1] in dropped and names[0] not in dropped:
+        rebased = max(index for index, name in enumerate(names) if name not in dropped)
+        units = set(manifest_blocks(chain[rebased]))
+        similar = {block: keyframe['chunks'][min(index, len(keyframe['chunks']) - 1)]
+                   for index, block in enumerate(manifest_blocks(chain[rebased])) if keyframe['chunks']}
+        layers = chain[:rebased]
+    else:
+        units = set(keyframe['chunks'])
+        layers = chain[:-1]
+    pages = set()
+    for manifest in layers:
+        # 后面的快照覆盖的页和超出快照大小的页不再需要
+        for page_no, page_hash in manifest['pages'].items():
+            if page_no not in pages and int(page_no) * manifest['page_size'] < chain[0]['size']:
+                pages.add(page_no)
+                units.add(page_hash)
+    return manifest_chunks(chain[0]), units, similar
+
+def storage_sizes(units) -> tuple:
+    """存储单元的磁盘大小（字节）和分块的引用计数，返回 (大小, 引用计数)"""
+    sizes, refs = {}, {}
+    hashes = []
+    for unit in units:
+        if isinstance(unit, Path):
+            sizes[unit] = unit.stat().st_size if unit.exists() else 0
+        else:
+            hashes.append(unit)
+    if hashes:
+        conn = open_store()
+        try:
+            for start in range(0, len(hashes), CHUNK_QUERY_BATCH):
+                batch = hashes[start:start + CHUNK_QUERY_BATCH]
+                for chunk_hash, chunk_refs, stored_size in conn.execute(
+                        f"SELECT hash, refs, stored_size FROM chunks WHERE hash IN ({', '.join('?' * len(batch))})",
+                        batch):
+                    sizes[chunk_hash] = stored_size or 0
+                    refs[chunk_hash] = chunk_refs
+        finally:
+            conn.close()
+    return sizes, refs
+
+def load_usage(metas: List[dict], dropped: Optional[dict] = None) -> tuple:
+    """为每个会话记录 _own 和 _units（见 snapshot_usage，dropped 为 {项目目录: 将删除的清单文件名}），
+    返回所有存储单元的 (大小, 引用计数)；尚不在存储中的分块只有估算的大小，没有引用计数"""
+    units, similar = set(), {}
+    for meta in metas:
+        meta['_own'], meta['_units'], guesses = snapshot_usage(
+            meta, (dropped or {}).get(meta['project_dir'].name, ())
+        ) if meta.get('db_file') else ([], set(), {})
+        units |= meta['_units'] | set(guesses.values())
+        similar.update(guesses)
+    sizes, refs = storage_sizes(units)
+    for unit, like in similar.items():
+        if unit not in refs:
+            sizes[unit] = sizes.get(like, 0)
+    return sizes, refs
+
+def project_usage() -> dict:
+    """各项目的快照在存储中实际占用的空间，返回 {项目目录: (字节数, 包文件字节数)}
+
+    字节数按分块去重计算（项目内多个快照共用的分块只算一次，分块在散放文件或包文件中均计入；
+    不同项目共用的分块各自计入），包文件字节数为项目包文件的磁盘大小（含等待改写清理的死记录）
+    """
+    metas = query_sessions()
+    sizes, _ = load_usage(metas)
+    units = {}
+    for meta in metas:
+        units.setdefault(meta['project_dir'].name, set()).update(meta['_units'])
+    return {project: (sum(sizes.get(unit, 0) for unit in project_units),
+                      sum((PACKS_DIR / name).stat().st_size for name in project_packs(project)
+                          if (PACKS_DIR / name).exists()))
+            for project, project_units in units.items()}
+
+def trim_to_size(kept: List[dict], candidates: List[dict], limit_mb: float, sizes: dict) -> List[dict]:
+    """按候选顺序删除 kept 中的会话，直到它们实际占用的空间不超过 limit_mb，返回要删除的会话
+
+    占用按去重后的存储单元计算，多个快照共用的分块只算一次；删除后不能减少占用的会话
+    （数据仍被保留的快照使用）跳过
+    """
+    held = Counter(unit for session in kept for unit in session['_units'])
+    total = sum(sizes.get(unit, 0) for unit in held)
+    removed = []
+    for session in candidates:
+        if total <= limit_mb * 1024 * 1024:
+            break
+        freed = sum(sizes.get(unit, 0) for unit in session['_units'] if held[unit] == 1)
+        if not freed:
+            continue
+        held.subtract(session['_units'])
+        total -= freed
+        removed.append(session)
+    return removed
+
+def reclaimable_bytes(pruned: List[dict], remaining: List[dict], sizes: dict, refs: dict) -> int:
+    """删除 pruned 实际能回收的字节数：引用计数会降为 0、且不再被 remaining 使用的分块和旧的完整 .db 快照文件，
+    减去改接快照链时新写入的分块（remaining 的 _units 应按删除后的快照链计算）"""
+    released = Counter(unit for session in pruned for unit in session['_own'])
+    # 重新存为关键帧的保留快照释放它原来的页
+    released.update(unit for session in remaining for unit in session['_own'] if unit not in session['_units'])
+    still_used = set().union(*(session['_units'] for session in remaining))
+    freed = sum(sizes.get(unit, 0) for unit, count in released.items()
+                if unit not in still_used and (isinstance(unit, Path) or refs.get(unit, 0) <= count))
+    added = sum(sizes.get(unit, 0) for unit in still_used if not isinstance(unit, Path) and unit not in refs)
+    return max(freed - added, 0)
+
+def reclaimable_kb(metas: List[dict]) -> float:
+    """删除这些会话预计能回收的空间（KB），与保留策略的计算方式相同（同一项目的其余会话视为保留）"""
+    dropped = {}
+    for meta in metas:
+        dropped.setdefault(meta['project_dir'].name, set()).add(meta.get('db_file'))
+    selected = {meta['meta_file'] for meta in metas}
+    remaining = [meta for project in dropped for meta in query_sessions(project_dir=project)
+                 if meta['meta_file'] not in selected]
+    sizes, refs = load_usage(metas + remaining, dropped)
+    return reclaimable_bytes(metas, remaining, sizes, refs) / 1024
+
+def select_retained(sessions: List[dict], rules: dict, now: datetime, sizes: dict):
+    """按 GFS 分层规则选择一个项目中要保留的自动保存（sessions 按时间倒序）
+
+    每一层在其时间窗口内每个时间段（小时/天/ISO 周）保留最新的一个，各层结果取并集；
+    最新的一个始终保留（它是下一个增量快照的基准）。项目大小按去重后实际占用的空间计算
+    （sizes 为各存储单元的大小）。返回 (保留列表, [(会话, 原因)])
+    """
+    tiers = [(rules['hourly_hours'] * 3600, '%Y-%m-%d %H'),
+             (rules['daily_days'] * 86400, '%Y-%m-%d'),
+             (rules['weekly_weeks'] * 7 * 86400, '%G-W%V')]
+    kept, pruned = [], []
+    buckets = set()
+    for index, session in enumerate(sessions):
+        age = (now - session['_datetime']).total_seconds()
+        keep = index == 0 or age < rules['keep_all_hours'] * 3600
+        for window, fmt in tiers:
+            if age < window:
+                bucket = (fmt, session['_datetime'].strftime(fmt))
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    keep = True
+        if keep:
+            kept.append(session)
+        else:
+            pruned.append((session, 'tier'))
+    
+    if rules.get('max_keep') is not None:
+        limit = max(int(rules['max_keep']), 1)
+        pruned += [(session, 'count') for session in kept[limit:]]
+        kept = kept[:limit]
+    
+    if rules.get('project_max_mb') is not None:
+        # 从最旧的开始删除，最新的一个不删除
+        for session in trim_to_size(kept, kept[:0:-1], rules['project_max_mb'], sizes):
+            kept.remove(session)
+            pruned.append((session, 'project_size'))
+    return kept, pruned
+
+def plan_retention(policy: dict, now: Optional[datetime] = None):
+    """一次索引查询评估所有项目的保留策略
+
+    返回 (汇总, {项目: 待删除会话列表（按时间倒序）})；只清理自动保存，手动保存不受影响。
+    大小上限和可回收空间按分块去重后的实际占用计算：多个快照共用的分块只算一次，
+    仍被其他快照（包括手动保存）引用的分块删除后不会回收
+    """
+    now = now or datetime.now()
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        rows = conn.execute(
+            "SELECT project_dir, meta_file, meta, auto_saved FROM sessions ORDER BY project_dir, datetime DESC"
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    by_project, manual = {}, {}
+    evaluated = 0
+    for row in rows:
+        meta = json.loads(row['meta'])
+        meta['project_dir'] = SESSIONS_DIR / row['project_dir']
+        meta['meta_file'] = meta['project_dir'] / row['meta_file']
+        if row['auto_saved']:
+            evaluated += 1
+            try:
+                meta['_datetime'] = datetime.fromisoformat(meta['datetime'])
+            except (KeyError, TypeError, ValueError):
+                manual.setdefault(row['project_dir'], []).append(meta)
+                continue
+            by_project.setdefault(row['project_dir'], []).append(meta)
+        else:
+            manual.setdefault(row['project_dir'], []).append(meta)
+    
+    sizes, refs = load_usage([meta for metas in (*by_project.values(), *manual.values()) for meta in metas])
+    
+    kept, pruned = {}, {}
+    for project, sessions in by_project.items():
+        rules = {key: policy.get(key) for key in RETENTION_PROJECT_RULES}
+        rules.update(policy.get('projects', {}).get(project, {}))
+        kept[project], pruned[project] = select_retained(sessions, rules, now, sizes)
+    
+    # 全局大小上限：从所有项目中最旧的开始删除，每个项目的最新快照不删除
+    if policy.get('total_max_mb') is not None:
+        candidates = sorted((session for sessions in kept.values() for session in sessions[1:]),
+                            key=lambda session: session['_datetime'])
+        for session in trim_to_size([session for sessions in kept.values() for session in sessions],
+                                    candidates, policy['total_max_mb'], sizes):
+            project = session['project_dir'].name
+            kept[project].remove(session)
+            pruned[project].append((session, 'total_size'))
+    
+    # 可回收空间按删除后改接的快照链重新计算
+    dropped = {project: {session.get('db_file') for session, _ in items} for project, items in pruned.items()}
+    sizes, refs = load_usage([meta for metas in (*by_project.values(), *manual.values()) for meta in metas], dropped)
+    
+    summary = {"evaluated": evaluated, "kept": 0, "pruned": 0, "reclaimed_kb": 0.0, "projects": {}}
+    deletions = {}
+    for project in by_project:
+        items = sorted(pruned[project], key=lambda item: item[0]['_datetime'], reverse=True)
+        reclaimed_kb = reclaimable_bytes([session for session, _ in items],
+                                         kept[project] + manual.get(project, []), sizes, refs) / 1024
+        summary['kept'] += len(kept[project])
+        summary['pruned'] += len(items)
+        summary['projects'][project] = {
+            "kept": len(kept[project]),
+            "reclaimed_kb": round(reclaimed_kb, 1),
+            "pruned": [{"id": session['timestamp'], "name": session.get('name'),
+                        "datetime": session['datetime'], "reason": reason,
+                        "stored_kb": round(session.get('stored_kb', session.get('size_kb', 0)), 1)}
+                       for session, reason in items]
+        }
+        if items:
+            deletions[project] = [session for session, _ in items]
+    # 不同项目的快照也可能共用分块：全部删除后才回收的分块只计入总数
+    summary['reclaimed_kb'] = round(reclaimable_bytes(
+        [session for items in pruned.values() for session, _ in items],
+        [session for sessions in (*kept.values(), *manual.values()) for session in sessions], sizes, refs
+    ) / 1024, 1)
+    return summary, deletions
+
+def load_auto_save_config() -> dict:
+    """读取自动保存配置（文件中的设置覆盖环境变量默认值）"""
+    config = dict(AUTO_SAVE_DEFAULTS)
+    try:
+        with open(AUTO_SAVE_CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading {AUTO_SAVE_CONFIG_FILE}: {e}")
+    return config
+
+def assign_chat_projects(active: dict, activity: dict) -> List[tuple]:
+    """为会话数据库确定所属项目，返回 [(数据库, 项目)]（按写入时间从新到旧）
+
+    active 为 {数据库: 最近写入时间}，activity 为 {项目: worker.log 修改时间}。项目优先沿用同一聊天目录
+    （hash_folder）最近一次保存时的项目；从未保存过的，取 worker.log 修改时间与数据库最接近的项目
+    （每个 Cursor 窗口写自己项目的 worker.log）
+    """
+    if not active:
+        return []
+    hash_folders = sorted({db_path.parent.parent.name for db_path in active})
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        # 按时间升序构造字典，同一聊天目录以最近一次保存为准
+        known = dict(conn.execute(
+            "SELECT json_extract(meta, '$.hash_folder'), project_dir FROM sessions "
+            "WHERE json_extract(meta, '$.hash_folder') IN (SELECT value FROM json_each(?)) ORDER BY datetime",
+            (json.dumps(hash_folders),)
+        ).fetchall())
+    finally:
+        conn.close()
+    
+    targets = []
+    for db_path, mtime in sorted(active.items(), key=lambda item: item[1], reverse=True):
+        project = known.get(db_path.parent.parent.name)
+        if project is None:
+            project = min(activity, key=lambda name: abs(activity[name] - mtime)) if activity else "unknown"
+        targets.append((db_path, project))
+    return targets
+
+# 会话操作：Web 后端在所属项目的任务队列中调用（job 用于报告进度），CLI 直接调用；
+# 同一项目的保存、恢复、删除需依次执行。失败时抛出的异常信息可直接展示给用户
+def auto_save_snapshot(current_db: Path, hash_folder: str, project_name: str, delta: bool = False, job=None) -> dict:
+    """自动保存指定的会话数据库：与同一数据库的上一次快照相同时跳过"""
+    # 智能检测会话是否有变化（避免重复保存）
+    project_sessions_dir = SESSIONS_DIR / project_name
+    project_sessions_dir.mkdir(exist_ok=True)
+    
+    # 同一项目可能有多个会话数据库（多个聊天），与同一数据库的上一次快照比较
+    recent_sessions = query_sessions(project_dir=project_name, original_path=str(current_db), limit=1)
+    latest_data = recent_sessions[0] if recent_sessions else None
+    
+    # 1. 廉价指纹：数据库与 WAL 均未被写入过则直接跳过，不读取任何数据页
+    if job:
+        job.update(progress=0.05, message="检查会话变化")
+    with metrics.phase("auto_save", "fingerprint"):
+        fingerprint = db_fingerprint(current_db)
+    saved_fingerprint = {}
+    if latest_data and latest_data.get('original_path') == str(current_db):
+        saved_fingerprint = latest_data.get('fingerprint') or {}
+        cached = FINGERPRINT_CACHE.get(str(current_db))
+        if cached and cached.get('content_hash') == saved_fingerprint.get('content_hash'):
+            known_fingerprints = [saved_fingerprint, cached]
+        else:
+            known_fingerprints = [saved_fingerprint]
+        
+        if any(same_fingerprint(fingerprint, known) for known in known_fingerprints):
+            metrics.inc("cursor_sessions_auto_saves_total", result="skipped_fingerprint")
+            return {
+                "status": "skipped",
+                "message": "会话内容无变化，跳过保存",
+                "session_id": latest_data['timestamp']
+            }
+    
+    # 2. 指纹有变化（可能只是 checkpoint），通过在线备份得到一致性快照后再比较内容
+    # 会话 ID 在确定需要保存后才生成（可能需要等待到下一秒），暂存文件名与它无关
+    staged_db = project_sessions_dir / f".auto_save_{uuid.uuid4().hex[:8]}.staging.db"
+    if job:
+        job.update(progress=0.1, message="生成快照")
+    try:
+        with metrics.phase("auto_save", "backup"):
+            snapshot_info = backup_db(current_db, staged_db, on_progress=job_stage(job, 0.1, 0.6))
+        metrics.inc("cursor_sessions_bytes_copied_total", staged_db.stat().st_size, operation="auto_save")
+        with metrics.phase("auto_save", "hash"):
+            fingerprint['content_hash'] = file_content_hash(staged_db)
+    except Exception as e:
+        discard_staged(staged_db)
+        raise RuntimeError(f"快照失败: {str(e)}") from e
+    
+    if latest_data:
+        try:
+            current_size = staged_db.stat().st_size / 1024
+            size_diff = abs(current_size - latest_data.get('size_kb', 0))
+            
+            # 检查会话是否真正有变化
+            # 1. 大小差异超过 1KB 表示一定有变化
+            # 2. 否则比较内容哈希（旧快照没有记录哈希时才读取快照本身）
+            if size_diff < 1:
+                try:
+                    with metrics.phase("auto_save", "compare"):
+                        if saved_fingerprint.get('content_hash'):
+                            unchanged = fingerprint['content_hash'] == saved_fingerprint['content_hash']
+                        else:
+                            unchanged = db_matches_snapshot(staged_db, latest_data)
+                    
+                    if unchanged:
+                        discard_staged(staged_db)
+                        # 记住当前指纹，下次同样的状态无需再备份和哈希
+                        FINGERPRINT_CACHE[str(current_db)] = fingerprint
+                        metrics.inc("cursor_sessions_auto_saves_total", result="skipped_content")
+                        return {
+                            "status": "skipped",
+                            "message": "会话内容无变化，跳过保存",
+                            "session_id": latest_data['timestamp']
+                        }
+                except:
+                    # 如果对比失败，继续保存
+                    pass
+        except:
+            pass
+    
+    # 同一秒内的多次保存（例如多个数据库同时变化）会生成相同的会话 ID，顺延到下一秒
+    timestamp = next_timestamp(project_sessions_dir)
+    base_name = f"{timestamp}_自动保存"
+    
+    # 生成自动保存的会话名称（包含项目名称）
+    # 将项目名中的连字符和下划线替换为空格，使其更易读
+    readable_project = project_name.replace('-', ' ').replace('_', ' ').replace('home neo upload', '').strip()
+    session_name = f"{readable_project} - {datetime.now().strftime('%m月%d日 %H:%M')}"
+    description = f"自动保存于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    
+    # 保存数据库（分块去重存储），JSON 导出改为按需生成
+    # 增量模式下相对同一数据库的上一快照只存变化的页，链过长或变化过多时存完整关键帧
+    backup_file = project_sessions_dir / f"{base_name}.manifest.json"
+    if job:
+        job.update(progress=0.7, message="写入分块存储")
+    try:
+        snapshot_size = staged_db.stat().st_size
+        manifest = None
+        with metrics.phase("auto_save", "store"):
+            if delta and latest_data and latest_data.get('storage') == 'chunked' \
+                    and latest_data.get('original_path') == str(current_db):
+                manifest = store_delta_snapshot(staged_db, project_sessions_dir / latest_data['db_file'], backup_file)
+            if manifest is None:
+                manifest = store_snapshot(staged_db, backup_file)
+    finally:
+        discard_staged(staged_db)
+    
+    # 保存元数据
+    metadata = {
+        'name': session_name,
+        'description': description,
+        'timestamp': timestamp,
+        'datetime': datetime.now().isoformat(),
+        'project': project_name,
+        'hash_folder': hash_folder,
+        'db_file': backup_file.name,
+        'storage': 'chunked',
+        'codec': manifest['codec'],
+        'json_file': None,
+        'size_kb': snapshot_size / 1024,
+        'stored_kb': manifest['stored_size'] / 1024,
+        'original_path': str(current_db),
+        'snapshot': snapshot_info,
+        'fingerprint': fingerprint,
+        'auto_saved': True
+    }
+    
+    meta_file = project_sessions_dir / f"{base_name}.meta.json"
+    with metrics.phase("auto_save", "metadata"):
+        write_metadata(meta_file, metadata)
+    FINGERPRINT_CACHE[str(current_db)] = fingerprint
+    metrics.inc("cursor_sessions_auto_saves_total", result="saved")
+    
+    return {
+        "status": "success",
+        "message": "自动保存成功",
+        "session_id": timestamp,
+        "name": session_name,
+        "size_kb": metadata['size_kb'],
+        "stored_kb": metadata['stored_kb']
+    }
+
+def save_snapshot(current_db: Path, hash_folder: str, project_name: str, name: str, description: str,
+                  job=None) -> dict:
+    """保存指定的会话数据库（手动保存，不检查是否有变化）"""
+    # 创建项目目录
+    project_sessions_dir = SESSIONS_DIR / project_name
+    project_sessions_dir.mkdir(exist_ok=True)
+    timestamp = next_timestamp(project_sessions_dir)
+    
+    # 创建安全的文件名
+    safe_name = "".join(c for c in name if c.isalnum() or c in (' ', '-', '_', '中', '文')).strip()
+    safe_name = safe_name.replace(' ', '_')[:50]
+    base_name = f"{timestamp}_{safe_name}"
+    
+    # 先通过在线备份得到一致性快照，再写入分块存储（JSON 导出按需生成）
+    staged_db = project_sessions_dir / f".{base_name}.staging.db"
+    backup_file = project_sessions_dir / f"{base_name}.manifest.json"
+    if job:
+        job.update(progress=0.05, message="生成快照")
+    try:
+        fingerprint = db_fingerprint(current_db)
+        with metrics.phase("save", "backup"):
+            snapshot_info = backup_db(current_db, staged_db, on_progress=job_stage(job, 0.05, 0.6))
+        snapshot_size = staged_db.stat().st_size
+        metrics.inc("cursor_sessions_bytes_copied_total", snapshot_size, operation="save")
+        with metrics.phase("save", "hash"):
+            fingerprint['content_hash'] = file_content_hash(staged_db)
+        if job:
+            job.update(progress=0.7, message="写入分块存储")
+        with metrics.phase("save", "store"):
+            manifest = store_snapshot(staged_db, backup_file)
+    except Exception as e:
+        raise RuntimeError(f"快照失败: {str(e)}") from e
+    finally:
+        discard_staged(staged_db)
+    
+    # 保存元数据
+    metadata = {
+        'name': name,
+        'description': description,
+        'timestamp': timestamp,
+        'datetime': datetime.now().isoformat(),
+        'project': project_name,
+        'hash_folder': hash_folder,
+        'db_file': backup_file.name,
+        'storage': 'chunked',
+        'codec': manifest['codec'],
+        'json_file': None,
+        'size_kb': snapshot_size / 1024,
+        'stored_kb': manifest['stored_size'] / 1024,
+        'original_path': str(current_db),
+        'snapshot': snapshot_info,
+        'fingerprint': fingerprint,
+        'auto_saved': False
+    }
+    
+    meta_file = project_sessions_dir / f"{base_name}.meta.json"
+    with metrics.phase("save", "metadata"):
+        write_metadata(meta_file, metadata)
+    
+    return {
+        "status": "success",
+        "message": "会话保存成功",
+        "session_id": timestamp,
+        "name": name,
+        "codec": metadata['codec'],
+        "size_kb": metadata['size_kb'],
+        "stored_kb": metadata['stored_kb']
+    }
+
+def restore_into(session_meta: dict, current_db: Path, project_name: str, job=None) -> dict:
+    """把快照还原到目标数据库所在目录的临时文件后原子替换；替换前的数据库保留为撤销点"""
+    staged_db = current_db.with_name(f".{current_db.name}.restore-{uuid.uuid4().hex[:8]}.tmp")
+    undo_db = current_db.with_name(f".{current_db.name}{RESTORE_UNDO_SUFFIX}")
+    if job:
+        job.update(progress=0.1, message="还原快照")
+    try:
+        with metrics.phase("restore", "materialize"):
+            copy_info = materialize_snapshot(session_meta, staged_db)
+            fsync_path(staged_db)
+        metrics.inc("cursor_sessions_bytes_copied_total", staged_db.stat().st_size, operation="restore")
+        if job:
+            job.update(progress=0.8, message="替换数据库")
+        with metrics.phase("restore", "swap"):
+            method = swap_in_db(staged_db, current_db, undo_db)
+    except Exception as e:
+        raise RuntimeError(f"恢复失败: {str(e)}") from e
+    finally:
+        discard_staged(staged_db)
+    
+    with restore_undo_lock:
+        records = load_restore_undo()
+        records[str(current_db)] = {
+            "db": str(current_db),
+            "undo_file": str(undo_db),
+            "project": project_name,
+            "session_id": session_meta['timestamp'],
+            "session_name": session_meta['name'],
+            "state": "restored",
+            "method": method,
+            "copy": copy_info,
+            "at": datetime.now().isoformat()
+        }
+        save_restore_undo(records)
+    
+    return {
+        "status": "success",
+        "message": "会话恢复成功，请重启 Cursor",
+        "session_name": session_meta['name'],
+        "undo_available": True
+    }
+
+def restore_undo_records(db: Optional[str] = None) -> List[dict]:
+    """可撤销的恢复（最近的在前，可只取指定数据库的）；state 为 undone 表示已撤销，再次撤销即重新应用恢复"""
+    return sorted((record for record in load_restore_undo().values()
+                   if (not db or record['db'] == db) and Path(record['undo_file']).exists()),
+                  key=lambda record: record['at'], reverse=True)
+
+def revert_restore(db: str) -> dict:
+    """交换数据库与它的撤销点，不复制数据；没有撤销点时抛出 LookupError"""
+    with restore_undo_lock:
+        records = load_restore_undo()
+        record = records.get(db)
+        if not record or not Path(record['undo_file']).exists():
+            raise LookupError("没有可撤销的恢复")
+        
+        target_db, undo_db = Path(db), Path(record['undo_file'])
+        swap_db = undo_db.with_name(undo_db.name + ".swap")
+        try:
+            with metrics.phase("restore", "undo"):
+                swap_in_db(undo_db, target_db, swap_db)
+                # 交换前的当前数据库成为新的撤销点
+                os.replace(swap_db, undo_db)
+                if Path(str(swap_db) + '-wal').exists():
+                    os.replace(Path(str(swap_db) + '-wal'), Path(str(undo_db) + '-wal'))
+        except Exception as e:
+            raise RuntimeError(f"撤销失败: {str(e)}") from e
+        
+        record['state'] = "undone" if record['state'] == "restored" else "restored"
+        record['at'] = datetime.now().isoformat()
+        save_restore_undo(records)
+    
+    return {
+        "status": "success",
+        "message": "已撤销恢复，请重启 Cursor" if record['state'] == "undone" else "已重新应用恢复，请重启 Cursor",
+        "db": db,
+        "state": record['state'],
+        "session_name": record['session_name']
+    }
+
+def diff_snapshots(meta_a: dict, meta_b: dict, limit: int = DIFF_ROW_LIMIT, job=None) -> dict:
+    """还原两个快照并逐表比较（meta_a 为旧版本；内容哈希相同时直接判定相同，无需还原）"""
+    sessions = {
+        side: {"id": meta['timestamp'], "name": meta.get('name'), "project": meta.get('project'),
+               "datetime": meta.get('datetime'), "original_path": meta.get('original_path')}
+        for side, meta in (("from", meta_a), ("to", meta_b))
+    }
+    hash_a = (meta_a.get('fingerprint') or {}).get('content_hash')
+    if hash_a and hash_a == (meta_b.get('fingerprint') or {}).get('content_hash'):
+        summary = {"added": 0, "removed": 0, "changed": 0, "unchanged": None, "tables_added": [], "tables_removed": []}
+        return dict(sessions, status="success", identical=True, summary=summary, tables={})
+    
+    token = uuid.uuid4().hex[:8]
+    staged = [meta['project_dir'] / f".diff_{meta['timestamp']}_{token}.staging.db" for meta in (meta_a, meta_b)]
+    try:
+        if job:
+            job.update(progress=0.1, message="还原快照")
+        with metrics.phase("diff", "materialize"):
+            for meta, staged_db in zip((meta_a, meta_b), staged):
+                materialize_snapshot(meta, staged_db)
+        if job:
+            job.update(progress=0.5, message="比较数据")
+        with metrics.phase("diff", "compare"):
+            diff = diff_databases(staged[0], staged[1], limit)
+    except Exception as e:
+        raise RuntimeError(f"比较失败: {str(e)}") from e
+    finally:
+        for staged_db in staged:
+            discard_staged(staged_db)
+    
+    summary = diff['summary']
+    identical = not (summary['added'] or summary['removed'] or summary['changed']
+                     or summary['tables_added'] or summary['tables_removed'])
+    return dict(sessions, status="success", identical=identical, **diff)
+
+def pack_targets(project: Optional[str] = None) -> List[str]:
+    """需要打包的项目：指定的项目，或所有有快照的项目（只剩包文件的项目也需要改写去除死记录）"""
+    if project:
+        return [project]
+    projects = {meta['project_dir'].name for meta in query_sessions()}
+    projects.update(parse_pack_name(pack_file.name)[0] for pack_file in PACKS_DIR.glob("*.pack"))
+    return sorted(project for project in projects if project)
+
+def pack_project(project: str, older_than_days: float, job=None) -> dict:
+    """把项目冷快照引用的散放分块追加到项目的包文件，删除散放文件和冷快照的 JSON 导出缓存
+
+    新保存的分块总是散放写入，打包只在此处进行；打包后包文件中死记录超过 PACK_COMPACT_RATIO 时改写为新一代
+    """
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+    hashes = set()
+    json_removed = 0
+    cold = query_sessions(project_dir=project, before=cutoff)
+    for meta in cold:
+        if meta.get('storage') != 'chunked':
+            continue
+        try:
+            hashes.update(manifest_chunks(load_manifest(meta['project_dir'] / meta['db_file'])))
+        except FileNotFoundError:
+            continue
+        # JSON 导出只是缓存，冷快照需要时再生成
+        if meta.get('json_file'):
+            json_file = meta['project_dir'] / meta['json_file']
+            if json_file.exists():
+                json_file.unlink()
+                json_removed += 1
+            meta['json_file'] = None
+            meta.pop('json_source', None)
+            write_metadata(meta['meta_file'], meta)
+    
+    PACKS_DIR.mkdir(parents=True, exist_ok=True)
+    packs = project_packs(project)
+    pack_name = packs[-1] if packs else f"{project}.1.pack"
+    pending = sorted(hashes)
+    packed = 0
+    conn = open_store()
+    try:
+        # 分批持有写锁：先追加并同步包文件，再提交索引，最后删除散放文件（中断时最多留下死记录或重复文件）
+        for start in range(0, len(pending), PACK_BATCH):
+            if job:
+                job.update(progress=0.9 * start / len(pending), message=f"打包分块 {start}/{len(pending)}")
+            moved = []
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                records = []
+                for chunk_hash in pending[start:start + PACK_BATCH]:
+                    row = conn.execute("SELECT codec, pack FROM chunks WHERE hash = ?", (chunk_hash,)).fetchone()
+                    if not row or row[1]:
+                        continue
+                    chunk_file = chunk_path(chunk_hash, row[0])
+                    try:
+                        records.append((chunk_hash, row[0], chunk_file.read_bytes()))
+                    except FileNotFoundError:
+                        continue
+                    moved.append(chunk_file)
+                if records:
+                    append_pack_records(conn, pack_name, records)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            for chunk_file in moved:
+                chunk_file.unlink(missing_ok=True)
+            packed += len(moved)
+        
+        compacted = compact_project_packs(conn, project, job)
+        pack_stats = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(stored_size), 0) FROM chunks WHERE pack IN "
+            "(SELECT value FROM json_each(?))", (json.dumps(project_packs(project)),)
+        ).fetchone()
+    finally:
+        conn.close()
+    
+    pack_bytes = sum((PACKS_DIR / name).stat().st_size for name in project_packs(project))
+    return {
+        "status": "success",
+        "message": f"已打包 {packed} 个分块",
+        "project": project,
+        "cold_snapshots": len(cold),
+        "chunks_packed": packed,
+        "files_removed": packed + json_removed,
+        "json_removed": json_removed,
+        "packs": project_packs(project),
+        "pack_kb": round(pack_bytes / 1024, 1),
+        "live_chunks": pack_stats[0],
+        "live_kb": round(pack_stats[1] / 1024, 1),
+        "compacted": compacted
+    }
+
+def compact_project_packs(conn, project: str, job=None) -> bool:
+    """死记录（已释放的分块）超过 PACK_COMPACT_RATIO 时，把项目所有包文件的有效记录改写进新一代包文件"""
+    packs = project_packs(project)
+    if not packs:
+        return False
+    total = sum((PACKS_DIR / name).stat().st_size for name in packs)
+    rows = conn.execute("SELECT COUNT(*), COALESCE(SUM(stored_size), 0) FROM chunks WHERE pack IN "
+                        "(SELECT value FROM json_each(?))", (json.dumps(packs),)).fetchone()
+    live = rows[0] * PACK_RECORD.size + rows[1]
+    if total - live <= total * PACK_COMPACT_RATIO:
+        return False
+    if not rows[0]:
+        for name in packs:
+            (PACKS_DIR / name).unlink(missing_ok=True)
+        return True
+    
+    if job:
+        job.update(progress=0.9, message="改写包文件")
+    new_pack = f"{project}.{parse_pack_name(packs[-1])[1] + 1}.pack"
+    # 改写期间持有写锁；读取方若在提交后才打开旧包文件，会重新查询位置读取新包文件
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        live_rows = conn.execute(
+            "SELECT hash, codec, pack, pack_offset, stored_size FROM chunks WHERE pack IN "
+            "(SELECT value FROM json_each(?)) ORDER BY pack, pack_offset", (json.dumps(packs),)
+        ).fetchall()
+        
+        def live_records():
+            for chunk_hash, codec, pack, offset, length in live_rows:
+                with open(PACKS_DIR / pack, 'rb') as f:
+                    f.seek(offset)
+                    yield chunk_hash, codec, f.read(length)
+        
+        append_pack_records(conn, new_pack, live_records())
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if (PACKS_DIR / new_pack).exists():
+            (PACKS_DIR / new_pack).unlink()
+        raise
+    for name in packs:
+        (PACKS_DIR / name).unlink(missing_ok=True)
+    return True
+
+def rebuild_catalog() -> int:
+    """从 .meta.json 文件完整重建会话索引，返回会话数
+
+    清空和重新扫描在同一个写事务中完成：其他进程（如 CLI 与 Web 后端同时运行）的读取只会看到重建前或重建后的索引，
+    写入元数据则等待重建提交后再更新索引
+    """
+    conn = open_catalog()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM sessions")
+        conn.execute("DELETE FROM project_dirs")
+        sync_catalog(conn)
+        return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    finally:
+        conn.close()
+
+def recompress_chunks(codec: str, job=None) -> dict:
+    """把其他格式的分块重新压缩为 codec（压缩后没有变小的分块保持原样，并记住已尝试过该格式）"""
+    conn = open_store()
+    try:
+        pending = [row[0] for row in conn.execute(
+            "SELECT hash FROM chunks WHERE codec != ? AND COALESCE(tried_codec, '') != ?", (codec, codec))]
+        before = after = recompressed = 0
+        # 分批持有写锁，避免长时间阻塞保存；旧文件在提交后才删除，回滚时删除新写入的文件，
+        # 索引指向的文件始终存在
+        for start in range(0, len(pending), 256):
+            if job:
+                job.update(progress=0.9 * start / len(pending), message="重新压缩分块")
+            written, obsolete = [], []
+            batch_before = batch_after = 0
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chunk_hash in pending[start:start + 256]:
+                    row = conn.execute("SELECT codec, stored_size, pack FROM chunks WHERE hash = ?",
+                                       (chunk_hash,)).fetchone()
+                    if not row or row[0] == codec:
+                        continue
+                    # 先在内存中压缩，格式不变（数据不可压缩）时不改写文件
+                    encoded, new_codec = encode_chunk(read_chunk(conn, chunk_hash), codec)
+                    if new_codec == row[0]:
+                        conn.execute("UPDATE chunks SET tried_codec = ? WHERE hash = ?", (codec, chunk_hash))
+                        continue
+                    write_encoded_chunk(chunk_hash, encoded, new_codec)
+                    written.append(chunk_path(chunk_hash, new_codec))
+                    # 包文件中的旧记录成为死记录，重新压缩后的分块先散放，下次打包时再进入包文件
+                    conn.execute("UPDATE chunks SET codec = ?, stored_size = ?, pack = NULL, pack_offset = NULL, "
+                                 "tried_codec = ? WHERE hash = ?", (new_codec, len(encoded), codec, chunk_hash))
+                    if not row[2]:
+                        obsolete.append(chunk_path(chunk_hash, row[0]))
+                    batch_before += row[1] or 0
+                    batch_after += len(encoded)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                    for chunk_file in written:
+                        chunk_file.unlink(missing_ok=True)
+                raise
+            for chunk_file in obsolete:
+                chunk_file.unlink(missing_ok=True)
+            before += batch_before
+            after += batch_after
+            recompressed += len(written)
+    finally:
+        conn.close()
+    
+    return {
+        "status": "success",
+        "message": f"已重新压缩 {recompressed} 个分块",
+        "codec": codec,
+        "chunks_recompressed": recompressed,
+        "bytes_before": before,
+        "bytes_after": after
+    }
+
+def snapshot_codec(codecs) -> str:
+    """由快照各分块的实际格式得出快照的压缩格式：不可压缩而原样存储的分块不计，多种格式并存时为 mixed"""
+    compressed = set(codecs) - {'none'}
+    if not compressed:
+        return 'none'
+    return compressed.pop() if len(compressed) == 1 else 'mixed'
+
+def recompress_targets() -> List[str]:
+    """有快照的项目"""
+    return sorted({meta['project_dir'].name for meta in query_sessions()})
+
+def recompress_project(project: str, codec: str, job=None) -> dict:
+    """将项目中旧的完整 .db 快照转为 codec 压缩的分块，并按分块的实际格式和大小更新各快照的元数据
+
+    清单本身保持不变，以免使 JSON 导出缓存失效；应在分块重新压缩之后执行
+    """
+    converted = updated = 0
+    sessions = query_sessions(project_dir=project)
+    for i, meta in enumerate(sessions):
+        if job:
+            job.update(progress=i / len(sessions), message="更新快照")
+        changed = False
+        if meta.get('storage') != 'chunked':
+            db_path = meta['project_dir'] / meta['db_file']
+            if not db_path.exists():
+                continue
+            base_name = meta['meta_file'].name[:-len('.meta.json')]
+            manifest_file = meta['project_dir'] / f"{base_name}.manifest.json"
+            store_snapshot(db_path, manifest_file, codec)
+            meta.update({'db_file': manifest_file.name, 'storage': 'chunked'})
+            write_metadata(meta['meta_file'], meta)
+            db_path.unlink()
+            converted += 1
+            changed = True
+        try:
+            chunks = manifest_chunks(load_manifest(meta['project_dir'] / meta['db_file']))
+        except FileNotFoundError:
+            continue
+        conn = open_store()
+        try:
+            rows = {row[0]: row[1:] for row in conn.execute(
+                "SELECT hash, codec, stored_size FROM chunks WHERE hash IN (SELECT value FROM json_each(?))",
+                (json.dumps(sorted(set(chunks))),))}
+        finally:
+            conn.close()
+        stored_kb = sum(rows[chunk_hash][1] for chunk_hash in chunks if chunk_hash in rows) / 1024
+        chunk_codec = snapshot_codec(row[0] for row in rows.values())
+        if meta.get('codec') != chunk_codec or meta.get('stored_kb') != stored_kb:
+            meta.update({'codec': chunk_codec, 'stored_kb': stored_kb})
+            write_metadata(meta['meta_file'], meta)
+            changed = True
+        updated += changed
+    
+    return {
+        "status": "success",
+        "message": f"已更新 {updated} 个快照",
+        "project": project,
+        "snapshots_converted": converted,
+        "snapshots_updated": updated
+    }
+
+def recompress_snapshots(codec: str, job=None) -> dict:
+    """重新压缩分块存储，再逐个项目转换旧快照并更新元数据（CLI 使用；Web 后端分别在存储和各项目的任务队列中执行）"""
+    result = recompress_chunks(codec, job)
+    projects = {project: recompress_project(project, codec) for project in recompress_targets()}
+    return dict(result, message="重新压缩完成",
+                snapshots_converted=sum(item['snapshots_converted'] for item in projects.values()),
+                projects=projects)